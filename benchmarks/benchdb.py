@@ -0,0 +1,640 @@
+"""Databases for the benchmarks: synthetic sites, served by a temporary
+PostgreSQL cluster or by an in-process stand-in.
+
+A site has one or more vsites, each with `accounts` users in projects
+of `groupSize`.  Every project has a group of the same name.  Rows are
+numbered within a vsite, and row j was modified j seconds after a base
+time a month back, so (modified, key) order is row order.  touch()
+modifies a fraction of the users and groups, for incremental updates.
+
+Both databases provide the vs_user_accounts, vs_groups,
+vs_group_members and virtual_sites_allowed views queried by the
+agents, with connect() and touch()."""
+
+import bisect
+import datetime
+import os, os.path
+import re
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from hpcagent.DBHelpers import DB_timestamp_seconds
+
+
+class SiteData(object):
+    """The shape of a synthetic site."""
+
+    def __init__(self, sitename="BENCH", vsites=("vs0",), accounts=10000,
+                 groupSize=50, passwordType="ssha"):
+        self.sitename = sitename
+        self.vsites = list(vsites)
+        self.accounts = accounts
+        self.groupSize = groupSize
+        self.groups = (accounts + groupSize - 1) // groupSize
+        self.passwordType = passwordType
+        # Whole seconds, so row times are exact in microseconds.
+        self.base = int(time.time()) - 30*86400
+
+    def touch_step(self, fraction):
+        """Touch every k-th row, for a `fraction` of them; None for none."""
+        if fraction <= 0:
+            return None
+        return max(1, int(round(1.0/fraction)))
+
+    def touch_rows(self, n, fraction):
+        k = self.touch_step(fraction)
+        if k is None:
+            return []
+        return range(0, n, k)
+
+
+# -- stand-in --
+
+def _us(ts):
+    """A timestamp, as a datetime, text or seconds, in microseconds."""
+    if isinstance(ts, (int, long, float)):
+        return int(round(ts*1e6))
+    # A psycopg2 adapter, from DBTimestamp.
+    t = DB_timestamp_seconds(getattr(ts, "adapted", ts))
+    if t is None:
+        raise ValueError("not a timestamp: %r" % (ts,))
+    return int(round(t*1e6))
+
+def _datetime(us):
+    s, f = divmod(us, 1000000)
+    return datetime.datetime.fromtimestamp(s).replace(microsecond=f)
+
+
+class _Table(object):
+    """Rows of one view, for each vsite, in (modified, key) order.
+
+    Row j of a vsite was modified at base+j seconds, unless touched.
+    Touched rows follow all the others, in the order touched."""
+
+    def __init__(self, data, n, columns):
+        self.data = data
+        self.n = n
+        self.columns = columns      # name -> fn(vsName, j)
+        self.modified = {}          # touched j -> microseconds
+        self.touched = []           # [(microseconds, j)], ascending
+
+    def touch(self, rows, now):
+        us = _us(now)
+        for i, j in enumerate(rows):
+            self.modified[j] = us + 10*i
+        self.touched = sorted([(m, j) for j, m in self.modified.items()])
+
+    def modified_us(self, j):
+        try:
+            return self.modified[j]
+        except KeyError:
+            return (self.data.base + j) * 1000000
+
+    def scan(self, lo=None, rows=None):
+        """Yield j, in order, for rows modified at or after `lo`
+        microseconds; only those in range(*rows), if given."""
+        if rows is None:
+            rows = (0, self.n)
+        first, stop = rows
+        if lo is not None:
+            first = max(first, -(-(lo - self.data.base*1000000) // 1000000))
+        modified = self.modified
+        for j in xrange(first, stop):
+            if j not in modified:
+                yield j
+        i = 0
+        if lo is not None:
+            i = bisect.bisect_left(self.touched, (lo, -1))
+        for m, j in self.touched[i:]:
+            if rows[0] <= j < rows[1]:
+                yield j
+
+
+class StandInSite(object):
+    """A synthetic site served from memory.
+
+    Rows are computed as they are read, so the stand-in takes no more
+    memory for a million accounts than for ten thousand."""
+
+    name = "stand-in"
+
+    def __init__(self, data):
+        self.data = data
+        d = data
+        gs = d.groupSize
+        user = lambda j: "u%07d" % j
+        proj = lambda j: "p%05d" % (j // gs)
+        self.users = _Table(d, d.accounts, {
+            "sitename": lambda vs, j: d.sitename,
+            "vsname": lambda vs, j: vs,
+            "passwordtype": lambda vs, j: d.passwordType,
+            "uid": lambda vs, j: 10000 + j,
+            "username": lambda vs, j: user(j),
+            "gid": lambda vs, j: 5000 + j // gs,
+            "groupname": lambda vs, j: proj(j),
+            "password": lambda vs, j: "{SSHA}%032x" % j,
+            "name": lambda vs, j: "User %d" % j,
+            "shell": lambda vs, j: "/bin/bash",
+            "homedirectory": lambda vs, j: "/home/" + user(j),
+            "quota": lambda vs, j: 0,
+            "useraccountstate": lambda vs, j: "A",
+            "passwordmustchange": lambda vs, j: False,
+            "projid": lambda vs, j: j // gs,
+            "projname": lambda vs, j: proj(j),
+            "projgroupname": lambda vs, j: proj(j),
+            "lastactive": lambda vs, j: None,
+            "created": lambda vs, j: _datetime(d.base*1000000),
+            })
+        self.groups = _Table(d, d.groups, {
+            "sitename": lambda vs, g: d.sitename,
+            "vsname": lambda vs, g: vs,
+            "gid": lambda vs, g: 5000 + g,
+            "groupname": lambda vs, g: "p%05d" % g,
+            "groupstate": lambda vs, g: "A",
+            })
+        # Membership rows are numbered as the users are.
+        self.members = _Table(d, d.accounts, {
+            "sitename": lambda vs, j: d.sitename,
+            "vsname": lambda vs, j: vs,
+            "groupname": lambda vs, j: proj(j),
+            "username": lambda vs, j: user(j),
+            })
+        self.views = {"vs_user_accounts": self.users,
+                      "vs_groups": self.groups,
+                      "vs_group_members": self.members}
+
+    def connect(self):
+        return StandInConnection(self)
+
+    def touch(self, fraction):
+        now = time.time()
+        self.users.touch(self.data.touch_rows(self.data.accounts, fraction),
+                         now)
+        self.groups.touch(self.data.touch_rows(self.data.groups, fraction),
+                          now)
+
+    def close(self):
+        pass
+
+
+# Placeholders, as left by psycopg2-style or PREPAREd queries.
+_paramRE = re.compile(r"%\((\w+)\)s|%s|\$(\d+)")
+_PH = r"(\$\d+)"
+_tupleCondRE = re.compile(r"\(\s*(?:\w+\.)?(\w+)\s*,\s*(?:\w+\.)?(\w+)\s*\)"
+                          r"\s*>=\s*\(\s*" + _PH + r"\s*,\s*" + _PH + r"\s*\)")
+_condRE = re.compile(r"(?:\w+\.)?(\w+)\s*(=|>=|<=|>|<)\s*" + _PH)
+_columnCondRE = re.compile(r"(?:\w+\.)?(\w+)\s*=\s*(?:\w+\.)?(\w+)")
+
+
+def _split_top(text):
+    """Split at commas outside parentheses."""
+    R = []
+    depth = 0
+    start = 0
+    for i, c in enumerate(text):
+        if c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "," and depth == 0:
+            R.append(text[start:i])
+            start = i + 1
+    R.append(text[start:])
+    return [s.strip() for s in R]
+
+
+def _find_array(q):
+    """(start, end) of an ARRAY(...) subquery in `q`, or None."""
+    m = re.search(r"ARRAY\s*\(", q, re.I)
+    if m is None:
+        return None
+    depth = 0
+    for i in xrange(m.end()-1, len(q)):
+        if q[i] == "(":
+            depth += 1
+        elif q[i] == ")":
+            depth -= 1
+            if depth == 0:
+                return (m.start(), i+1)
+    raise ValueError("unbalanced ARRAY subquery")
+
+
+class _Select(object):
+    """A parsed SELECT over one view, with ANDed conditions."""
+
+    def __init__(self, q):
+        self.array = None
+        self.arrayColumn = None
+        span = _find_array(q)
+        if span is not None:
+            sub = q[span[0]:span[1]]
+            q = q[:span[0]] + "__array__" + q[span[1]:]
+            self.array = _Select(sub[sub.index("(")+1:-1])
+        m = re.match(r"\s*SELECT\s+(.*?)\s+FROM\s+(\w+)(?:\s+(?!WHERE\b|ORDER\b)(\w+))?"
+                     r"(?:\s+WHERE\s+(.*?))?(?:\s+ORDER\s+BY\s+.*)?\s*$",
+                     q, re.I | re.S)
+        if m is None:
+            raise ValueError("cannot run query: %s" % q)
+        self.view = m.group(2).lower()
+        self.columns = []
+        for item in _split_top(m.group(1)):
+            am = re.match(r"(.*?)\s+AS\s+(\w+)$", item, re.I | re.S)
+            if am is not None:
+                self.columns.append(am.group(2).lower())
+                if am.group(1).strip() == "__array__":
+                    self.arrayColumn = am.group(2).lower()
+            else:
+                self.columns.append(item.split(".")[-1].lower())
+        where = m.group(4) or ""
+        self.tupleConds = _tupleCondRE.findall(where)
+        where = _tupleCondRE.sub("", where)
+        self.conds = [(c.lower(), op, ph) for c, op, ph in _condRE.findall(where)]
+        where = _condRE.sub("", where)
+        # Correlations with the enclosing query, e.g. m.vsName=g.vsName.
+        self.joins = [(a.lower(), b.lower())
+                      for a, b in _columnCondRE.findall(where)]
+
+
+class StandInCursor(object):
+    """The parts of a psycopg2 cursor used by the agents."""
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+        self.description = None
+        self.itersize = 2000
+        self.closed = False
+        self._rows = iter(())
+
+    def execute(self, q, params=None):
+        q, args = self._normalize(q, params)
+        word = q.split(None, 1)[0].upper()
+        if word == "PREPARE":
+            m = re.match(r"\s*PREPARE\s+(\w+)\s+AS\s+(.*)$", q, re.I | re.S)
+            self.connection.prepared[m.group(1)] = m.group(2)
+            self._set([], [])
+            return
+        if word == "EXECUTE":
+            m = re.match(r"\s*EXECUTE\s+(\w+)", q, re.I)
+            q = self.connection.prepared[m.group(1)]
+        elif word in ("LISTEN", "UNLISTEN", "DEALLOCATE", "BEGIN", "COMMIT"):
+            self._set([], [])
+            return
+        if re.match(r"\s*SELECT\s+now\(\)", q, re.I):
+            self._set(["now"], iter([(datetime.datetime.now(),)]))
+            return
+        if re.match(r"\s*SELECT\s+1\s*$", q, re.I):
+            self._set(["?column?"], iter([(1,)]))
+            return
+        sel = _Select(q)
+        self._set(sel.columns, self.connection.site_rows(sel, args))
+
+    def _normalize(self, q, params):
+        """Number the placeholders $1, $2..., giving their values."""
+        if isinstance(params, dict):
+            names = []
+            def number(m):
+                if m.group(2) is not None:
+                    return m.group(0)
+                if m.group(1) not in names:
+                    names.append(m.group(1))
+                return "$%d" % (names.index(m.group(1))+1,)
+            q = _paramRE.sub(number, q)
+            return q, [params[n] for n in names]
+        if params:
+            n = [0]
+            def number(m):
+                n[0] += 1
+                return "$%d" % n[0]
+            q = _paramRE.sub(number, q)
+            return q, list(params)
+        return q, []
+
+    def _set(self, columns, rows):
+        self.description = tuple([(c, None, None, None, None, None, None)
+                                  for c in columns]) or None
+        self._rows = iter(rows)
+
+    def fetchone(self):
+        try:
+            return self._rows.next()
+        except StopIteration:
+            return None
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.itersize
+        R = []
+        for r in self._rows:
+            R.append(r)
+            if len(R) >= size:
+                break
+        return R
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def close(self):
+        self.closed = True
+        self._rows = iter(())
+
+
+class StandInConnection(object):
+    """The parts of a psycopg2 connection used by the agents."""
+
+    def __init__(self, site):
+        self.site = site
+        self.prepared = {}
+        self.notifies = []
+        self.isolation_level = 1
+        self.closed = 0
+
+    def cursor(self, name=None, withhold=False):
+        return StandInCursor(self, name)
+
+    def set_isolation_level(self, level):
+        self.isolation_level = level
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def poll(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+    def site_rows(self, sel, args):
+        """Run a parsed SELECT, yielding row tuples."""
+        site = self.site
+        d = site.data
+        if sel.view == "virtual_sites_allowed":
+            return self._filter_plain([(d.sitename, vs) for vs in d.vsites],
+                                      ["sitename", "vsname"], sel, args)
+        table = site.views[sel.view]
+        return self._scan(table, sel, args, {})
+
+    def _filter_plain(self, rows, names, sel, args):
+        idx = dict([(n, i) for i, n in enumerate(names)])
+        for r in rows:
+            if all([r[idx[c]] == args[int(ph[1:])-1]
+                    for c, op, ph in sel.conds]):
+                yield tuple([r[idx[c]] for c in sel.columns])
+
+    def _scan(self, table, sel, args, outer):
+        """Rows of `table` meeting the conditions of `sel`; `outer`
+        holds the values of an enclosing row, for correlations."""
+        eq = {}
+        lo = None
+        bounds = []
+        for c, op, ph in sel.conds:
+            v = args[int(ph[1:])-1]
+            if c == "modified":
+                v = _us(v)
+                if op in (">", ">="):
+                    lo = max(lo, v)
+                bounds.append((op, v))
+            elif op == "=":
+                eq[c] = v
+            else:
+                raise ValueError("unsupported condition on %s" % c)
+        resume = None
+        for c1, c2, ph1, ph2 in sel.tupleConds:
+            resume = (_us(args[int(ph1[1:])-1]), args[int(ph2[1:])-1], c2)
+            lo = max(lo, resume[0])
+        for a, b in sel.joins:
+            if a in outer:
+                eq[b] = outer[a]
+            elif b in outer:
+                eq[a] = outer[b]
+
+        d = self.site.data
+        if eq.get("sitename", d.sitename) != d.sitename:
+            return
+        if "vsname" in eq:
+            vsites = [vs for vs in d.vsites if vs == eq["vsname"]]
+        else:
+            vsites = d.vsites
+        cols = table.columns
+        checks = [(cols[c], v) for c, v in eq.items()
+                  if c not in ("sitename", "vsname")]
+        rows = None
+        if table is self.site.members and "groupname" in eq:
+            # Members of a group are consecutive rows.
+            g = int(eq["groupname"][1:])
+            rows = (g*d.groupSize, min(table.n, (g+1)*d.groupSize))
+        getters = []
+        for c in sel.columns:
+            if c == "modified":
+                getters.append(lambda vs, j: _datetime(table.modified_us(j)))
+            elif c == sel.arrayColumn:
+                getters.append(self._array_getter(table, sel, args))
+            else:
+                getters.append(cols[c])
+
+        for vs in vsites:
+            for j in table.scan(lo, rows):
+                if checks and not all([f(vs, j) == v for f, v in checks]):
+                    continue
+                if bounds or resume:
+                    m = table.modified_us(j)
+                    if not all([_compare(m, op, v) for op, v in bounds]):
+                        continue
+                    if resume is not None and \
+                       (m, cols[resume[2]](vs, j)) < resume[:2]:
+                        continue
+                yield tuple([f(vs, j) for f in getters])
+
+    def _array_getter(self, table, sel, args):
+        sub = sel.array
+        members = self.site.views[sub.view]
+        def get(vs, j):
+            outer = {"sitename": self.site.data.sitename, "vsname": vs}
+            for c in ("groupname", "gid"):
+                if c in table.columns:
+                    outer[c] = table.columns[c](vs, j)
+            return [r[0] for r in self._scan(members, sub, args, outer)]
+        return get
+
+
+def _compare(a, op, b):
+    if op == ">":
+        return a > b
+    if op == ">=":
+        return a >= b
+    if op == "<=":
+        return a <= b
+    if op == "<":
+        return a < b
+    return a == b
+
+
+# -- PostgreSQL --
+
+def find_pg_bindir(bindir=None):
+    """Find the directory holding initdb and pg_ctl, or None."""
+    candidates = []
+    if bindir is not None:
+        candidates.append(bindir)
+    candidates.extend(os.environ.get("PATH", "").split(os.pathsep))
+    for base in ("/usr/lib/postgresql", "/usr/pgsql"):
+        if os.path.isdir(base):
+            versions = os.listdir(base)
+            versions.sort(reverse=True)
+            candidates.extend([os.path.join(base, v, "bin")
+                               for v in versions])
+    for d in candidates:
+        if os.path.isfile(os.path.join(d, "initdb")) and \
+           os.path.isfile(os.path.join(d, "pg_ctl")):
+            return d
+    return None
+
+
+class TempCluster(object):
+    """A throwaway PostgreSQL cluster in `directory`.
+
+    It listens only on a Unix socket in that directory, and runs
+    without fsync: the benchmarks measure the agents, not the disk."""
+
+    def __init__(self, directory, bindir):
+        self.directory = directory
+        self.bindir = bindir
+        self.dataDir = os.path.join(directory, "data")
+        self.user = "bench"
+
+    def _run(self, *args):
+        cmd = [os.path.join(self.bindir, args[0])] + list(args[1:])
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT, close_fds=True)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            raise RuntimeError("%s failed:\n%s" % (" ".join(cmd), out))
+
+    def start(self):
+        self._run("initdb", "-D", self.dataDir, "-A", "trust",
+                  "-U", self.user, "-E", "UTF8")
+        self._run("pg_ctl", "-D", self.dataDir, "-w",
+                  "-l", os.path.join(self.directory, "postgres.log"),
+                  "-o", "-k %s -c listen_addresses='' -c fsync=off "
+                        "-c synchronous_commit=off -c full_page_writes=off"
+                        % self.directory,
+                  "start")
+
+    def stop(self):
+        self._run("pg_ctl", "-D", self.dataDir, "-w", "-m", "fast", "stop")
+
+    def connect_info(self):
+        """Keywords for DB_connect, as from the agents' configuration."""
+        return {"host": self.directory, "user": self.user,
+                "database": "postgres"}
+
+
+_SCHEMA = """
+CREATE TABLE bench_users (
+    siteName text, vsName text, passwordType text,
+    uid integer, userName text, gid integer, groupName text,
+    password text, name text, shell text, homeDirectory text,
+    quota integer, userAccountState text, passwordMustChange boolean,
+    modified timestamptz, projid integer, projName text,
+    projGroupName text, lastActive timestamptz, created timestamptz);
+CREATE TABLE bench_groups (
+    siteName text, vsName text, gid integer, groupName text,
+    groupState text, modified timestamptz);
+CREATE TABLE bench_group_members (
+    siteName text, vsName text, groupName text, userName text,
+    modified timestamptz);
+CREATE TABLE bench_vsites (siteName text, vsName text);
+CREATE VIEW vs_user_accounts AS SELECT * FROM bench_users;
+CREATE VIEW vs_groups AS SELECT * FROM bench_groups;
+CREATE VIEW vs_group_members AS SELECT * FROM bench_group_members;
+CREATE VIEW virtual_sites_allowed AS SELECT * FROM bench_vsites;
+"""
+
+_INDEXES = """
+CREATE INDEX bench_users_scan
+    ON bench_users (siteName, vsName, modified, uid);
+CREATE INDEX bench_groups_scan
+    ON bench_groups (siteName, vsName, modified, gid);
+CREATE INDEX bench_group_members_group
+    ON bench_group_members (siteName, vsName, groupName);
+ANALYZE;
+"""
+
+
+class PostgresSite(object):
+    """A synthetic site loaded into a PostgreSQL database."""
+
+    name = "postgresql"
+
+    def __init__(self, data, connectInfo, cluster=None):
+        import psycopg2
+        self.data = data
+        self.connectInfo = connectInfo
+        self.cluster = cluster
+        self._psycopg2 = psycopg2
+
+    def connect(self):
+        conn = self._psycopg2.connect(**self.connectInfo)
+        conn.set_isolation_level(0)
+        return conn
+
+    def load(self):
+        d = self.data
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute(_SCHEMA)
+        p = {"site": d.sitename, "vsites": d.vsites, "n": d.accounts,
+             "gs": d.groupSize, "ng": d.groups, "pw": d.passwordType,
+             "base": datetime.datetime.fromtimestamp(d.base)}
+        cur.execute("""INSERT INTO bench_vsites
+                       SELECT %(site)s, unnest(%(vsites)s)""", p)
+        cur.execute("""
+            INSERT INTO bench_users
+            SELECT %(site)s, vs, %(pw)s,
+                   10000+j, 'u'||lpad(j::text, 7, '0'),
+                   5000+j/%(gs)s, 'p'||lpad((j/%(gs)s)::text, 5, '0'),
+                   '{SSHA}'||lpad(to_hex(j), 32, '0'), 'User '||j,
+                   '/bin/bash', '/home/u'||lpad(j::text, 7, '0'),
+                   0, 'A', false,
+                   %(base)s::timestamptz + j * interval '1 second',
+                   j/%(gs)s, 'p'||lpad((j/%(gs)s)::text, 5, '0'),
+                   'p'||lpad((j/%(gs)s)::text, 5, '0'),
+                   NULL, %(base)s::timestamptz
+            FROM unnest(%(vsites)s) vs, generate_series(0, %(n)s-1) j""", p)
+        cur.execute("""
+            INSERT INTO bench_groups
+            SELECT %(site)s, vs, 5000+g, 'p'||lpad(g::text, 5, '0'), 'A',
+                   %(base)s::timestamptz + g * interval '1 second'
+            FROM unnest(%(vsites)s) vs, generate_series(0, %(ng)s-1) g""", p)
+        cur.execute("""
+            INSERT INTO bench_group_members
+            SELECT siteName, vsName, groupName, userName, modified
+            FROM bench_users""")
+        cur.execute(_INDEXES)
+        conn.close()
+
+    def touch(self, fraction):
+        k = self.data.touch_step(fraction)
+        if k is None:
+            return
+        conn = self.connect()
+        cur = conn.cursor()
+        cur.execute("""UPDATE bench_users SET modified = clock_timestamp()
+                       WHERE (uid-10000) %% %s = 0""", (k,))
+        cur.execute("""UPDATE bench_groups SET modified = clock_timestamp()
+                       WHERE (gid-5000) %% %s = 0""", (k,))
+        conn.close()
+
+    def close(self):
+        if self.cluster is not None:
+            self.cluster.stop()
@@ -0,0 +1,138 @@
+#! /usr/bin/env python
+
+"""Benchmark: LDAP synchronization throughput against round-trip latency.
+
+Runs the LDAP agent's LdapVSite, unchanged, over a synthetic site in
+the stand-in database of benchdb.py, writing to the in-memory LDAP
+backend.  For each latency given, the backend waits that long on each
+round trip; the agent bootstraps an empty directory, then applies an
+incremental update after a fraction of the rows is touched.  For each
+pass it reports rows per second, the LDAP operations made, and the
+share of the time spent waiting on round trips, which is the most
+batching or pipelining could save."""
+
+import os, os.path, sys
+import shutil
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from benchdb import *
+from sitebench import TimedVSite, BenchAgentMixin, PHASES
+from hpcagent.LdapBackend import MemoryDirectory
+from ldapagent import LdapVSite, LdapUpdateAgent
+
+OPS = ("bind", "search", "add", "modify", "delete")
+
+
+class BenchLdapVSite(TimedVSite, LdapVSite): pass
+class BenchLdapAgent(BenchAgentMixin, LdapUpdateAgent): pass
+
+
+def write_config(fname, stateDir, data, uri, latency):
+    f = open(fname, "w")
+    f.write("[connection]\n")
+    f.write("sitename = %s\n" % data.sitename)
+    f.write("statedirectory = %s\n" % stateDir)
+    f.write("loglevel = warning\n")
+    f.write("password_type = %s\n" % data.passwordType)
+    f.write("metrics_interval = 0\n")
+    for vs in data.vsites:
+        f.write("\n[%s]\n" % vs)
+        f.write("uri = %s/%s\n" % (uri, vs))
+        f.write("dn = dc=%s,dc=bench\n" % vs)
+        f.write("admin = cn=admin,dc=%s,dc=bench\n" % vs)
+        f.write("password = secret\n")
+        f.write("backend = memory\n")
+        f.write("backend_latency = %r\n" % latency)
+    f.close()
+
+
+def report_pass(name, elapsed, agent, directories):
+    ops = {}
+    for d in directories:
+        for op, n in d.ops.items():
+            ops[op] = ops.get(op, 0) + n
+    trips = sum(ops.values())
+    waited = sum([d.waited for d in directories])
+    rows = agent.rows
+    print "  %-12s %9d rows %9.3f s %10.0f rows/s %6.2f trips/row " \
+          "%5.1f%% waiting" % \
+          (name, rows, elapsed, rows/max(elapsed, 1e-9),
+           trips/float(max(rows, 1)), 100.0*waited/max(elapsed, 1e-9))
+    print "  %12s %s" % ("", "  ".join(["%s %d" % (op, ops.get(op, 0))
+                                        for op in OPS]))
+    print "  %12s %s" % ("", "  ".join(["%s %.3f" % (p, agent.phaseTimes.get(p, 0.0))
+                                        for p in PHASES]))
+
+
+def run(i, latency, options, workDir):
+    data = SiteData(vsites=["vs%d" % v for v in range(options.vsites)],
+                    accounts=options.accounts, groupSize=options.groupSize)
+    site = StandInSite(data)
+    directory = os.path.join(workDir, "run%d" % i)
+    stateDir = os.path.join(directory, "state")
+    os.makedirs(stateDir)
+    cfg = os.path.join(directory, "bench.cfg")
+    uri = "memory://run%d" % i
+    write_config(cfg, stateDir, data, uri, latency)
+
+    BenchLdapAgent.benchSite = site
+    sys.argv = [sys.argv[0], "-c", cfg]
+    agent = BenchLdapAgent("benchldap%d" % i, BenchLdapVSite)
+    agent.enable_bootstrap(force=True)
+    cur = agent.get_cursor()
+    agent.get_vsites(cur)
+    cur.close()
+    directories = [MemoryDirectory.get("%s/%s" % (uri, vs))
+                   for vs in data.vsites]
+
+    print "latency %.3f ms: %d vsites of %d accounts" % \
+          (latency*1000, len(data.vsites), data.accounts)
+    for name, fraction in (("bootstrap", None),
+                           ("incremental", options.changes)):
+        if fraction is not None:
+            site.touch(fraction)
+        for d in directories:
+            d.reset_counts()
+        agent.reset_figures()
+        started = time.time()
+        agent.site_update()
+        report_pass(name, time.time() - started, agent, directories)
+    sys.stdout.flush()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--accounts", type="int", dest="accounts",
+                      default=2000, help="accounts in each vsite")
+    parser.add_option("--vsites", type="int", dest="vsites", default=1,
+                      help="number of vsites")
+    parser.add_option("--group-size", type="int", dest="groupSize",
+                      default=50, help="accounts in each project group")
+    parser.add_option("--changes", type="float", dest="changes",
+                      default=0.05,
+                      help="fraction of rows changed for the incremental "
+                           "update")
+    parser.add_option("-l", "--latencies", dest="latencies",
+                      default="0,0.1,0.5,2",
+                      help="comma-separated round-trip latencies, in ms")
+    (options, args) = parser.parse_args()
+    try:
+        latencies = [float(l)/1000 for l in options.latencies.split(",")]
+    except ValueError:
+        parser.error("bad latency list: %s" % options.latencies)
+
+    workDir = tempfile.mkdtemp(prefix="ldapbench-")
+    try:
+        for i, latency in enumerate(latencies):
+            run(i, latency, options, workDir)
+    finally:
+        shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
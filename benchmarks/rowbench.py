@@ -0,0 +1,70 @@
+#! /usr/bin/env python
+
+"""Micro-benchmark: Row against the older RowDict.
+
+Builds rows shaped like the vs_user_accounts results read by the
+agents, then times building them and the lookups update_users makes."""
+
+import os, sys
+import timeit
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from hpcagent.DBHelpers import Row, RowDict, DB_row_schema
+
+# Columns of VSiteProxyAgent.start_get_user_information, as psycopg2
+# reports them.
+COLUMNS = ["uid", "username", "gid", "groupname", "password", "name",
+           "shell", "homedirectory", "quota", "useraccountstate",
+           "passwordmustchange", "modified", "projid", "projname",
+           "projgroupname", "lastactive", "created"]
+
+DESC = tuple([(c, None, None, None, None, None, None) for c in COLUMNS])
+
+
+def make_rows(n):
+    return [(1000+i, "user%d" % i, 100, "users", "xyzzy", "User %d" % i,
+             "/bin/bash", "/home/user%d" % i, 0, "A", False,
+             "2012-01-01 00:00:00", i % 50, "proj%d" % (i % 50),
+             "projgrp%d" % (i % 50), None, None)
+            for i in xrange(n)]
+
+
+def use_rowdict(R):
+    for r in R:
+        u = RowDict(DESC, r)
+        u['userName'], u['uid'], u['groupName'], u['gid']
+        u['homeDirectory'], u['projName'], u['projid'], u['projGroupName']
+        u[1], u[9], u[10]
+
+
+def use_row(R):
+    for r in R:
+        u = Row(DB_row_schema(DESC), r)
+        u['userName'], u['uid'], u['groupName'], u['gid']
+        u['homeDirectory'], u['projName'], u['projid'], u['projGroupName']
+        u[1], u[9], u[10]
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("-n", "--rows", type="int", dest="rows", default=10000,
+                      help="number of rows per pass")
+    parser.add_option("-r", "--repeat", type="int", dest="repeat", default=5,
+                      help="number of passes; the best is reported")
+    (options, args) = parser.parse_args()
+
+    R = make_rows(options.rows)
+    results = []
+    for name, fn in (("RowDict", use_rowdict), ("Row", use_row)):
+        t = min(timeit.repeat(lambda: fn(R), number=1,
+                              repeat=options.repeat))
+        results.append((name, t))
+        print "%-8s %8.3f s  %10.0f rows/s" % (name, t, options.rows/t)
+    print "Speedup: %.2fx" % (results[0][1]/results[1][1],)
+
+
+if __name__ == "__main__":
+    main()
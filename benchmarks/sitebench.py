@@ -0,0 +1,327 @@
+#! /usr/bin/env python
+
+"""Benchmark: site updates of each kind of agent, over a synthetic site.
+
+Builds a site with ACCOUNTS accounts in each vsite, in a temporary
+PostgreSQL cluster if initdb and pg_ctl are found, else (or with
+--stand-in) in the in-process stand-in of benchdb.py.  Then, for each
+kind of agent, bootstraps the site with site_update, touches a
+fraction of the rows and runs an incremental update.  For each pass it
+reports rows per second and the time spent in prepare_update,
+update_groups, update_users and finish_update, and then the peak RSS.
+
+The agents read the change sets as ldapagent.py, hdagent.py and
+proxyagent.py do, but apply them to nothing, so the timings are those
+of the agent framework and the database.  Each kind of agent runs in
+a process of its own, so that its peak RSS is its own."""
+
+import os, os.path, sys
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from optparse import OptionParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                os.pardir))
+
+from benchdb import *
+from hpcagent.DBHelpers import *
+from hpcagent.SiteAuthAgent import VSiteAuthAgent, SiteAuthAgent
+from hpcagent.SiteFSAgent import VSiteFSAgent, SiteFSAgent
+from hpcagent.SiteProxyAgent import VSiteProxyAgent, SiteProxyAgent
+
+PHASES = ("prepare_update", "update_groups", "update_users", "finish_update")
+
+
+class TimedVSite(object):
+    """Time the phases of vsite updates, and count the rows applied,
+    into the agent's `phaseTimes` and `rows`."""
+
+    def _timed(self, phase, fn, *args):
+        started = time.time()
+        try:
+            return fn(*args)
+        finally:
+            times = self.aHandle.phaseTimes
+            times[phase] = times.get(phase, 0.0) + time.time() - started
+
+    def prepare_update(self, cur):
+        return self._timed("prepare_update",
+                           super(TimedVSite, self).prepare_update, cur)
+
+    def update_groups(self, cur, end=None):
+        return self._timed("update_groups",
+                           super(TimedVSite, self).update_groups, cur, end)
+
+    def update_users(self, cur, end=None):
+        return self._timed("update_users",
+                           super(TimedVSite, self).update_users, cur, end)
+
+    def finish_update(self, cur, completed, end=None):
+        return self._timed("finish_update",
+                           super(TimedVSite, self).finish_update,
+                           cur, completed, end)
+
+    def checkpoint(self, kind, modified, key):
+        self.aHandle.rows += 1
+        super(TimedVSite, self).checkpoint(kind, modified, key)
+
+
+class AuthReader(VSiteAuthAgent):
+    """Reads the change sets as LdapVSite does, with no directory."""
+
+    def update_groups(self, cur, end=None):
+        gcur = self.open_stream(cur)
+        self.start_get_group_membership(gcur, start=self.timeStamp, end=end,
+                                        resume=self.get_resume_point("groups"))
+        for g in gcur:
+            self.checkpoint("groups", g[3], g[0])
+            d = {'objectClass': ['posixGroup'],
+                 'cn': [g[1]],
+                 'gidNumber': [str(g[0])],
+                 'memberUid': list(g[4])}
+
+    def update_users(self, cur, end=None):
+        ucur = self.open_stream(cur)
+        self.start_get_user_information(ucur, start=self.timeStamp, end=end,
+                                        resume=self.get_resume_point("users"))
+        while True:
+            u = DB_get_next_row(ucur)
+            if u is None:
+                break
+            self.checkpoint("users", u['modified'], u['uid'])
+            d = {'objectClass': ['account', 'posixAccount'],
+                 'uid': [u[1]],
+                 'cn': [u[5]],
+                 'gecos': [u[5]],
+                 'uidNumber': [str(u[0])],
+                 'gidNumber': [str(u[2])],
+                 'loginShell': [u[6]],
+                 'homeDirectory': [u[7]]}
+            if u['passwordMustChange']:
+                d['loginShell'] = '/bin/false'
+            elif u[4] is not None:
+                d['userPassword'] = [u[4]]
+
+
+class FSReader(VSiteFSAgent):
+    """Reads the change sets as HomeDirVSite does, creating nothing."""
+
+    def update_users(self, cur, end=None):
+        ucur = self.open_stream(cur)
+        self.start_get_user_information(ucur, start=self.timeStamp, end=end,
+                                        resume=self.get_resume_point("users"))
+        while True:
+            u = DB_get_next_row(ucur)
+            if u is None:
+                break
+            self.checkpoint("users", u['modified'], u['uid'])
+            if u['userAccountState'] != "A":
+                continue
+            u['homepath'] = hpath = u['homeDirectory']
+            os.path.isdir(hpath)
+
+
+class ProxyReader(VSiteProxyAgent):
+    """Reads the change sets as ProxyVSite does, running no proxies."""
+
+    def update_users(self, cur, end=None):
+        ucur = self.open_stream(cur)
+        self.start_get_user_information(ucur, start=self.timeStamp, end=end,
+                                        resume=self.get_resume_point("users"))
+        while True:
+            u = DB_get_next_row(ucur)
+            if u is None:
+                break
+            self.checkpoint("users", u['modified'], u['uid'])
+            cmd = ['/usr/bin/env']
+            for n in u.keys():
+                if n != 'password':
+                    cmd.append('HPCMAN_%s=%s' % (n, u[n]))
+
+
+class BenchAuthVSite(TimedVSite, AuthReader): pass
+class BenchFSVSite(TimedVSite, FSReader): pass
+class BenchProxyVSite(TimedVSite, ProxyReader): pass
+
+
+class BenchAgentMixin(object):
+    """Connect to the benchmark's database, and collect the figures."""
+
+    benchSite = None
+
+    def open_connection(self):
+        return self.benchSite.connect()
+
+    def reset_figures(self):
+        self.phaseTimes = {}
+        self.rows = 0
+
+
+class BenchAuthAgent(BenchAgentMixin, SiteAuthAgent): pass
+class BenchFSAgent(BenchAgentMixin, SiteFSAgent): pass
+class BenchProxyAgent(BenchAgentMixin, SiteProxyAgent): pass
+
+AGENTS = {
+    "auth": (BenchAuthAgent, BenchAuthVSite),
+    "fs": (BenchFSAgent, BenchFSVSite),
+    "proxy": (BenchProxyAgent, BenchProxyVSite),
+    }
+
+
+def define_options():
+    parser = OptionParser()
+    parser.add_option("-n", "--accounts", type="int", dest="accounts",
+                      default=10000, help="accounts in each vsite")
+    parser.add_option("--vsites", type="int", dest="vsites", default=1,
+                      help="number of vsites")
+    parser.add_option("--group-size", type="int", dest="groupSize",
+                      default=50, help="accounts in each project group")
+    parser.add_option("--changes", type="float", dest="changes",
+                      default=0.01,
+                      help="fraction of rows changed for the incremental "
+                           "update")
+    parser.add_option("-a", "--agents", dest="agents",
+                      default=",".join(sorted(AGENTS)),
+                      help="comma-separated kinds of agent to run")
+    parser.add_option("--stand-in", action="store_true", dest="standIn",
+                      default=False,
+                      help="use the in-process stand-in, not PostgreSQL")
+    parser.add_option("--pg-bindir", dest="pgBindir",
+                      help="directory holding initdb and pg_ctl")
+    parser.add_option("--fetch-batch-size", dest="fetchBatchSize",
+                      help="the agents' 'fetch_batch_size'")
+    parser.add_option("--server-side-cursors", dest="serverSideCursors",
+                      help="the agents' 'server_side_cursors'")
+    parser.add_option("--state-store", dest="stateStore",
+                      help="the agents' 'state_store'")
+    parser.add_option("--keep", action="store_true", dest="keep",
+                      default=False, help="keep the working directory")
+    # Used between the parent and its children.
+    parser.add_option("--child", dest="child", help="(internal)")
+    parser.add_option("--work-dir", dest="workDir", help="(internal)")
+    parser.add_option("--pg-host", dest="pgHost", help="(internal)")
+    return parser
+
+
+def site_data(options):
+    return SiteData(vsites=["vs%d" % i for i in range(options.vsites)],
+                    accounts=options.accounts, groupSize=options.groupSize)
+
+
+def write_config(fname, stateDir, data, options):
+    f = open(fname, "w")
+    f.write("[connection]\n")
+    f.write("sitename = %s\n" % data.sitename)
+    f.write("statedirectory = %s\n" % stateDir)
+    f.write("loglevel = warning\n")
+    f.write("password_type = %s\n" % data.passwordType)
+    f.write("metrics_interval = 0\n")
+    for name, value in (("fetch_batch_size", options.fetchBatchSize),
+                        ("server_side_cursors", options.serverSideCursors),
+                        ("state_store", options.stateStore)):
+        if value is not None:
+            f.write("%s = %s\n" % (name, value))
+    f.close()
+
+
+def report_pass(name, elapsed, agent):
+    rows = agent.rows
+    print "  %-12s %9d rows %9.3f s %10.0f rows/s" % \
+          (name, rows, elapsed, rows/max(elapsed, 1e-9))
+    print "  %12s %s" % ("", "  ".join(["%s %.3f" % (p, agent.phaseTimes.get(p, 0.0))
+                                        for p in PHASES]))
+
+
+def run_child(options):
+    """Run one kind of agent: bootstrap, then an incremental update."""
+    kind = options.child
+    data = site_data(options)
+    if options.pgHost is None:
+        site = StandInSite(data)
+    else:
+        site = PostgresSite(data, {"host": options.pgHost, "user": "bench",
+                                   "database": "postgres"})
+    directory = os.path.join(options.workDir, kind)
+    stateDir = os.path.join(directory, "state")
+    os.makedirs(stateDir)
+    cfg = os.path.join(directory, "bench.cfg")
+    write_config(cfg, stateDir, data, options)
+
+    AgentClass, VSiteClass = AGENTS[kind]
+    AgentClass.benchSite = site
+    sys.argv = [sys.argv[0], "-c", cfg]
+    agent = AgentClass("bench" + kind, VSiteClass)
+    agent.enable_bootstrap(force=True)
+    cur = agent.get_cursor()
+    agent.get_vsites(cur)
+    cur.close()
+
+    print "%s: %s, %d vsites of %d accounts" % \
+          (kind, site.name, len(data.vsites), data.accounts)
+    agent.reset_figures()
+    started = time.time()
+    agent.site_update()
+    report_pass("bootstrap", time.time() - started, agent)
+
+    site.touch(options.changes)
+    agent.reset_figures()
+    started = time.time()
+    agent.site_update()
+    report_pass("incremental", time.time() - started, agent)
+
+    print "  peak RSS %d kB" % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sys.stdout.flush()
+
+
+def main():
+    parser = define_options()
+    (options, args) = parser.parse_args()
+    if options.child is not None:
+        run_child(options)
+        return
+
+    kinds = [k.strip() for k in options.agents.split(",") if k.strip()]
+    for kind in kinds:
+        if kind not in AGENTS:
+            parser.error("unknown kind of agent: %s" % kind)
+
+    workDir = tempfile.mkdtemp(prefix="sitebench-")
+    childArgs = sys.argv[1:] + ["--work-dir", workDir]
+    site = None
+    try:
+        if not options.standIn:
+            bindir = find_pg_bindir(options.pgBindir)
+            if bindir is None:
+                print "initdb and pg_ctl not found; using the stand-in."
+            else:
+                cluster = TempCluster(os.path.join(workDir, "pg"), bindir)
+                os.mkdir(cluster.directory)
+                cluster.start()
+                site = PostgresSite(site_data(options), cluster.connect_info(),
+                                    cluster)
+                started = time.time()
+                site.load()
+                print "Loaded %d vsites of %d accounts in %.1f s" % \
+                      (options.vsites, options.accounts, time.time() - started)
+                childArgs += ["--pg-host", cluster.directory]
+        sys.stdout.flush()
+
+        for kind in kinds:
+            rc = subprocess.call([sys.executable, os.path.abspath(__file__)] +
+                                 childArgs + ["--child", kind])
+            if rc != 0:
+                print "%s: failed, exit code %d" % (kind, rc)
+    finally:
+        if site is not None:
+            site.close()
+        if options.keep:
+            print "Working directory kept: %s" % workDir
+        else:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
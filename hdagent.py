@@ -153,7 +153,9 @@ class HomeDirVSite(VSiteFSAgent):
 
         # Get cursor to user information, filtered by timestamp.
         try:
-            self.start_get_user_information(cur, start=ts, end=end)
+            ucur = self.open_stream(cur)
+            self.start_get_user_information(ucur, start=ts, end=end,
+                                            resume=self.get_resume_point("users"))
         except DBDatabaseError:
             logger.info("Unable to query user information.")
             raise
@@ -161,12 +163,13 @@ class HomeDirVSite(VSiteFSAgent):
         # Iterate over selected users.
         while True:
             try:
-                u = DB_get_next_row(cur)
+                u = DB_get_next_row(ucur)
             except DBDatabaseError:
                 logger.info("Unable to fetch user information")
                 raise
             if u is None:
                 break
+            self.checkpoint("users", u['modified'], u['uid'])
 
             #userAccountState = u[6]
             userAccountState = u['userAccountState']
@@ -1,15 +1,20 @@
 """Common code for agents."""
 
 __all__ = [
-    "AgentError", "Agent", "AgentDatabaseError"
+    "AgentError", "Agent", "AgentDatabaseError",
+    "StateStore", "FileStateStore", "SQLiteStateStore", "OverlayStateStore"
     ]
 
 import ConfigParser
 import logging, logging.handlers
 from optparse import OptionParser
 import os, os.path, sys
+import signal
+import threading
+import time
 
 from DBHelpers import *
+from Diagnostics import *
 import psycopg2, psycopg2.extras
 
 _hasSSLMode = True
@@ -20,6 +25,202 @@ class AgentError(Exception):
 class AgentDatabaseError(AgentError): pass
 
 
+class StateStore(object):
+    """Small named values (e.g. timestamps) kept across restarts.
+
+    Values are strings, cached in memory, so reads do not touch the
+    disk.  Changes are written through durably; between hold() and
+    release() they are collected and written at once on release."""
+
+    def __init__(self):
+        self._cache = {}
+        self._dirty = {}
+        self._held = 0
+        self._lock = threading.RLock()
+
+    def get(self, key):
+        """Get a value, or None if it was never set."""
+        self._lock.acquire()
+        try:
+            try:
+                return self._cache[key]
+            except KeyError:
+                v = self._cache[key] = self._load(key)
+                return v
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, sync=False):
+        """Set a value; None deletes it.
+
+        With `sync`, the value is written at once, even when held."""
+        self._lock.acquire()
+        try:
+            self._cache[key] = value
+            if sync:
+                self._store({key: value})
+                self._dirty.pop(key, None)
+                return
+            self._dirty[key] = value
+            if self._held == 0:
+                self._flush()
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self.set(key, None)
+
+    def hold(self):
+        """Defer writing changes until the matching release()."""
+        self._lock.acquire()
+        self._held += 1
+        self._lock.release()
+
+    def release(self):
+        """Write the changes collected since hold()."""
+        self._lock.acquire()
+        try:
+            self._held -= 1
+            if self._held == 0:
+                self._flush()
+        finally:
+            self._lock.release()
+
+    def _flush(self):
+        # Changes stay pending until written, so that a failed write
+        # (e.g. a full disk) is retried by the next flush.
+        if self._dirty:
+            self._store(self._dirty)
+            self._dirty = {}
+
+    def _load(self, key):
+        """Read a value not in the cache."""
+        raise NotImplementedError
+
+    def _store(self, changes):
+        """Durably write a dictionary of changed values."""
+        raise NotImplementedError
+
+
+class FileStateStore(StateStore):
+    """State kept as one file per key, named by `fileNameFn(key)`.
+
+    Each file is replaced atomically: written to a temporary file,
+    synced, then renamed into place."""
+
+    def __init__(self, fileNameFn):
+        StateStore.__init__(self)
+        self.fileNameFn = fileNameFn
+
+    def _load(self, key):
+        try:
+            f = open(self.fileNameFn(key), "r")
+            r = f.readline()
+            f.close()
+        except IOError:
+            return None
+        return r[:-1]
+
+    def _store(self, changes):
+        dirs = set()
+        for key, value in changes.items():
+            fname = self.fileNameFn(key)
+            if value is None:
+                try:
+                    os.unlink(fname)
+                except OSError:
+                    pass
+            else:
+                tmpName = fname + ".tmp"
+                f = open(tmpName, "w")
+                try:
+                    f.write(value+"\n")
+                    f.flush()
+                    os.fsync(f.fileno())
+                finally:
+                    f.close()
+                os.rename(tmpName, fname)
+            dirs.add(os.path.dirname(fname) or ".")
+        for d in dirs:
+            fd = os.open(d, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class SQLiteStateStore(StateStore):
+    """State kept in a single SQLite database.
+
+    All changes collected between hold() and release() are written in
+    one transaction."""
+
+    def __init__(self, fileName):
+        import sqlite3
+        StateStore.__init__(self)
+        db = self._db = sqlite3.connect(fileName, check_same_thread=False)
+        db.execute("""CREATE TABLE IF NOT EXISTS state
+                          (key TEXT PRIMARY KEY, value TEXT NOT NULL)""")
+        db.commit()
+        for key, value in db.execute("SELECT key, value FROM state"):
+            self._cache[self._from_db_key(key)] = str(value)
+
+    def _to_db_key(self, key):
+        if key is None:
+            return ""
+        return key
+
+    def _from_db_key(self, key):
+        if key == "":
+            return None
+        return str(key)
+
+    def _load(self, key):
+        # Everything was loaded when the store was opened.
+        return None
+
+    def _store(self, changes):
+        db = self._db
+        try:
+            for key, value in changes.items():
+                if value is None:
+                    db.execute("DELETE FROM state WHERE key=?",
+                               (self._to_db_key(key),))
+                else:
+                    db.execute("INSERT OR REPLACE INTO state VALUES (?, ?)",
+                               (self._to_db_key(key), value))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+
+class OverlayStateStore(StateStore):
+    """Changes kept in memory, over a store that is only read.
+
+    This lets updates be repeated from the same timestamps without
+    recording them, e.g. for profiling."""
+
+    def __init__(self, base):
+        StateStore.__init__(self)
+        self.base = base
+
+    def reset(self):
+        """Forget the changes, going back to the values of the base."""
+        self._lock.acquire()
+        try:
+            self._cache = {}
+            self._dirty = {}
+        finally:
+            self._lock.release()
+
+    def _load(self, key):
+        return self.base.get(key)
+
+    def _store(self, changes):
+        pass
+
+
 class Agent(object):
     """Base class for agents."""
 
@@ -33,6 +234,9 @@ class Agent(object):
         self.define_options()
         parser = self.parser
         (self.options, self.args) = parser.parse_args()
+        if self.options.profileCycles is not None and \
+           self.options.profileCycles < 1:
+            parser.error("--profile needs a positive number of cycles")
 
         # Create an configuration file parser.
         self.configParser = cp = ConfigParser.SafeConfigParser()
@@ -78,6 +282,14 @@ class Agent(object):
         # Initialize state relating to the database connection.
         self.conn = None
         self.reconnectDBTime = 0
+        self.statements = DBStatementCache()
+
+        # Open the store of timestamps.  This happens after entering
+        # daemon mode, which closes all descriptors.
+        self.stateStore = self.open_state_store()
+
+        # Diagnostics on SIGUSR1 and SIGUSR2.
+        self.install_diagnostics()
 
     # -- options --
 
@@ -96,6 +308,10 @@ class Agent(object):
         parser.add_option("-d", "--daemon",
                           action="store_true", dest="daemonFlag",
                           help="run this agent as a daemon")
+        parser.add_option("--profile",
+                          action="store", type="int", dest="profileCycles",
+                          metavar="N",
+                          help="profile N update cycles, then exit")
 
     # -- get configuration data --
 
@@ -111,11 +327,20 @@ class Agent(object):
         self.get_config_data_agent_state()
         self.get_config_data_logging()
         self.get_config_data_database_connection()
+        self.get_config_data_diagnostics()
 
     def get_config_data_agent_state(self):
         """Get agent-specific state information."""
         cp = self.configParser
         self.stateDir = cp.get(self.CONSECT, "statedirectory")
+        try:
+            self.stateStoreType = cp.get(self.CONSECT, "state_store").lower()
+        except:
+            self.stateStoreType = "files"
+        if self.stateStoreType not in ("files", "sqlite"):
+            logging.fatal("Invalid value for 'state_store': %s",
+                          self.stateStoreType)
+            sys.exit(1)
 
 
     def get_config_data_logging(self):
@@ -171,6 +396,61 @@ class Agent(object):
 
         self.db_connect_info = kw
 
+        # Number of rows to fetch per round trip when streaming results.
+        try:
+            fbs = cp.get(self.CONSECT, "fetch_batch_size")
+        except:
+            self.fetchBatchSize = DB_DEFAULT_BATCH_SIZE
+        else:
+            try:
+                self.fetchBatchSize = int(fbs)
+                assert self.fetchBatchSize > 0
+            except:
+                logging.fatal("Invalid value for 'fetch_batch_size': %s", fbs)
+                sys.exit(1)
+
+        # When to stream results through server-side cursors: "always",
+        # "bootstrap" (only for scans from the dawn of time) or "never".
+        # Queries run on ordinary cursors use prepared statements.
+        try:
+            self.serverSideCursors = cp.get(self.CONSECT,
+                                            "server_side_cursors").lower()
+        except:
+            self.serverSideCursors = "bootstrap"
+        if self.serverSideCursors not in ("always", "bootstrap", "never"):
+            logging.fatal("Invalid value for 'server_side_cursors': %s",
+                          self.serverSideCursors)
+            sys.exit(1)
+
+
+    def get_config_data_diagnostics(self):
+        """Get settings for the diagnostics run on signals."""
+        cp = self.configParser
+        # CPU seconds between stack samples.
+        try:
+            si = cp.get(self.CONSECT, "sample_interval")
+        except:
+            self.sampleInterval = 0.01
+        else:
+            try:
+                self.sampleInterval = float(si)
+                assert self.sampleInterval > 0
+            except:
+                logging.fatal("Invalid value for 'sample_interval': %s", si)
+                sys.exit(1)
+        # Seconds the stack sampler runs for, unless stopped sooner.
+        try:
+            sd = cp.get(self.CONSECT, "sample_duration")
+        except:
+            self.sampleDuration = 60.0
+        else:
+            try:
+                self.sampleDuration = float(sd)
+                assert self.sampleDuration > 0
+            except:
+                logging.fatal("Invalid value for 'sample_duration': %s", sd)
+                sys.exit(1)
+
 
     # -- logging --
 
@@ -196,18 +476,22 @@ class Agent(object):
 
     # -- database --
 
+    def open_connection(self):
+        """Make a new connection to the database."""
+        try:
+            conn = DB_connect(**self.db_connect_info)
+            conn.set_isolation_level(0)
+        except DBDatabaseError:
+            self.logger.info("Failed to connect to database.")
+            raise
+        self.logger.info("Connected to database")
+        return conn
+
+
     def get_connection(self):
         """Get or make a connection object to the database."""
         if self.conn is None:
-            try:
-                conn = DB_connect(**self.db_connect_info)
-                conn.set_isolation_level(0)
-                self.conn = conn
-            except DBDatabaseError:
-                self.logger.info("Failed to connect to database.")
-                raise
-            else:
-                self.logger.info("Connected to database")
+            self.conn = self.open_connection()
         return self.conn
 
 
@@ -236,15 +520,40 @@ class Agent(object):
             except:
                 pass
 
-        # Close the connection itself.
+        # Close the connection itself.  Its prepared statements go too.
         if self.conn is not None:
+            self.statements.invalidate(self.conn)
             try:
-                conn.close()
+                self.conn.close()
             except:
                 pass
         self.conn = None
 
 
+    def check_connection(self):
+        """Cheaply check that the database connection still works."""
+
+        conn = self.conn
+        if conn is None or conn.closed:
+            return False
+        cur = None
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchall()
+        except DBDatabaseError:
+            self.logger.info("Database connection failed liveness check.")
+            ok = False
+        else:
+            ok = True
+        if cur is not None:
+            try:
+                cur.close()
+            except:
+                pass
+        return ok
+
+
     def db_timestamp(self, year,month,day, hour,minutes,seconds, tzinfo=None):
         """Create a timestamp for the database."""
         return DBTimestamp(year,month,day, hour,minutes,seconds, tzinfo)
@@ -266,22 +575,33 @@ class Agent(object):
         return os.path.join(self.stateDir, fn)
 
 
+    def open_state_store(self):
+        """Open the store selected by 'state_store'.
+
+        "files" keeps the timestamp files used by earlier versions;
+        "sqlite" keeps everything in one database file beside them."""
+        if self.stateStoreType == "sqlite":
+            fname = os.path.splitext(self.get_timestamp_filename())[0]
+            return SQLiteStateStore(fname + ".state")
+        return FileStateStore(self.get_timestamp_filename)
+
+
+    def has_timestamp(self, subkey=None):
+        """Check whether a timestamp has been recorded."""
+        return self.stateStore.get(subkey) is not None
+
+
     def get_timestamp(self, subkey=None):
         """Get the timestamp from when we last updated things."""
 
-        fname = self.get_timestamp_filename(subkey)
-        try:
-            f = open(fname, 'r')
-            r = f.readline()
-            f.close()
-        except IOError:
+        r = self.stateStore.get(subkey)
+        if r is None:
             return DBTimestamp(1900,1,1, 0,0,0)
-
-        return r[:-1]
+        return r
 
 
     def set_timestamp(self, cur, subkey=None, ts=None):
-        """Write a timestamp file.
+        """Record a timestamp.
 
         This is tied to a cursor, since we want database time of the
         current transaction."""
@@ -293,10 +613,95 @@ class Agent(object):
         else:
             t = ts
 
-        fname = self.get_timestamp_filename(subkey)
-        f = open(fname, "w")
-        f.write(str(t)+"\n")
-        f.close()
+        self.stateStore.set(subkey, str(t))
+
+
+    # -- diagnostics --
+
+    def get_diagnostics_filename(self, kind):
+        """Name a diagnostics output file, in the state directory."""
+        fn = "%s-%s-%d-%s.txt" % (self.agentKey, kind, os.getpid(),
+                                  time.strftime("%Y%m%d-%H%M%S"))
+        return os.path.join(self.stateDir, fn)
+
+
+    def install_diagnostics(self):
+        """Handle SIGUSR1 and SIGUSR2.
+
+        SIGUSR1 starts the stack sampler, for 'sample_duration' seconds,
+        or stops it sooner; either way the folded stacks it collected are
+        written.  SIGUSR2 writes a memory snapshot.
+        Interrupted system calls are restarted, so connections are not
+        disturbed."""
+        self.sampler = StackSampler(self.sampleInterval, self.sampleDuration)
+        self.lastCensus = None
+        for signum, fn in ((signal.SIGUSR1, self.toggle_sampler),
+                           (signal.SIGUSR2, self.memory_snapshot)):
+            signal.signal(signum,
+                          lambda signum, frame, fn=fn: self.run_diagnostic(fn))
+            signal.siginterrupt(signum, False)
+
+
+    def run_diagnostic(self, fn):
+        """Run a diagnostic asked for by a signal.  Agents with an event
+        loop defer it to the loop."""
+        fn()
+
+
+    def toggle_sampler(self):
+        """Start the stack sampler, or stop it and write its samples."""
+        if self.sampler.running:
+            self.stop_sampler()
+        else:
+            self.start_sampler()
+
+
+    def start_sampler(self):
+        """Start the stack sampler, to stop when its time is up."""
+        sampler = self.sampler
+        sampler.start(lambda: self.run_diagnostic(self.stop_sampler))
+        self.logger.warning("Stack sampling started, every %g CPU seconds "
+                            "for %g seconds.", sampler.interval,
+                            sampler.duration)
+
+
+    def stop_sampler(self):
+        """Stop the stack sampler, if running, and write its samples."""
+        sampler = self.sampler
+        if not sampler.running:
+            return
+        sampler.stop()
+        fname = self.get_diagnostics_filename("stacks")
+        try:
+            sampler.write(fname)
+        except (IOError, OSError):
+            self.logger.exception("Failed writing stack samples to %s", fname)
+        else:
+            self.logger.warning("Stack sampling stopped after %d samples "
+                                "in %.1f seconds; written to %s",
+                                sampler.samples, time.time()-sampler.started,
+                                fname)
+
+
+    def memory_snapshot(self):
+        """Write a census of objects by type, with the growth since the
+        last snapshot.  Allocation tracing starts with the first."""
+        t0 = time.time()
+        tracing = trace_allocations()
+        census = memory_census()
+        fname = self.get_diagnostics_filename("memory")
+        try:
+            write_memory_report(fname, census, self.lastCensus)
+        except (IOError, OSError):
+            self.logger.exception("Failed writing memory snapshot to %s", fname)
+            return
+        self.lastCensus = census
+        if tracing:
+            note = ""
+        else:
+            note = " (allocations are not traced)"
+        self.logger.warning("Memory snapshot written to %s in %.2f seconds%s",
+                            fname, time.time()-t0, note)
 
 
     # -- service interface --
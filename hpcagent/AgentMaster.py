@@ -1,32 +1,43 @@
 """Model connections to masters."""
 
-import socket, time, xdrlib
+import socket, time
 from ConnectSet import Connection, ConnectionSet
+from DBHelpers import DB_timestamp_seconds
+from Metrics import registry, LAG_BUCKETS
+from WireProtocol import *
 
 __all__ = [
     "MasterAgentConnection", "MasterAgentSet"
     ]
 
+_notifyLag = registry.histogram(
+    "hpcagent_master_notify_lag_seconds",
+    "Time from a vsite's update timestamp at the master to the "
+    "notification arriving, by agent and vsite.",
+    ("agent", "vsite"), buckets=LAG_BUCKETS)
+
+
 class MasterAgentConnection(Connection):
     """Model a connection to a master."""
 
+    peerType = "master"
+
     def __init__(self, addr, aHandle):
         Connection.__init__(self, addr, aHandle)
         self._connectTime = 0  # Dawn of time -- we're late!
+        self._connecting = False
+        self._synced = set()
+        self._reader = MessageReader(unpack_notify, aHandle.masterProtocol)
 
 
     def handle_disconnect(self, aHandle):
         """Prepare for a fresh connection to the master."""
 
-        try:
-            if self._s is not None:
-                self._s.close()
-        except:
-            pass
-        self._s = None
+        self.close_socket(aHandle)
         self._connectTime = time.time() + aHandle.masterRetryInterval
-        self._rbuf = ""
-        self._wbuf = ""
+        self._rbuf.clear()
+        self._wqueue.clear()
+        self.schedule(aHandle)
         aHandle.logger.warn("Connection to master failed; next retry at %d",
                     self._connectTime)
 
@@ -34,21 +45,17 @@ class MasterAgentConnection(Connection):
     def handle_input(self, aHandle):
         """Process input."""
 
-        # FIXME: We should modify to store ENTIRE messages as one
-        # string, then unpack pieces out of that.  Then we can
-        # determine whether the message broken, or incomplete.
-
         while True:
-            u = xdrlib.Unpacker(self._rbuf)
             try:
-                vSite = u.unpack_string()
-                ts = u.unpack_string()
-            except:
-                # FIXME: Presuming it is incomplete.
+                msg = self._reader.next_message(self._rbuf)
+            except ProtocolError, e:
+                aHandle.logger.error("Protocol error from master at %s: %s",
+                                     repr(self._addr), e)
+                self.handle_disconnect(aHandle)
                 return
-            self._rbuf = self._rbuf[u.get_position():]
-
-            self.process_input_data(aHandle, vSite, ts)
+            if msg is None:
+                return
+            self.process_input_data(aHandle, *msg)
 
 
     def process_input_data(self, aHandle, vSite, ts):
@@ -63,56 +70,73 @@ class MasterAgentConnection(Connection):
         # there is a database connection.  But somehow need to associate
         # this timestamp with the vsite.
 
-        try:
-            vh = aHandle.vHandles[vSite]
-        except KeyError:
+        if vSite not in aHandle.vHandles:
             logger.error("Update received for unrecognized vSite '%s'",
                          vSite)
             return
-        cur = None
-        try:
-            cur = aHandle.get_cursor()
-            vh.vsite_update(cur, ts)
-            cur.close()
-        except DBDatabaseError:
-            # Note: All vSites are notified when the database
-            # connection is restored.
-            #
-            aHandle.close_connection(cur=cur)
-            logger.info("Database connection apparently died; restart at %d",
-                        aHandle.reconnectDBTime)
-        except UpdateVSiteError:
-            logger.exception("Agent update error for vSite '%s'", vSite)
-            try:
-                cur.close()
-            except:
-                pass
+
+        # The first timestamp for each vsite only brings us up to date
+        # on connecting; later ones follow updates at the master.
+        if vSite in self._synced:
+            tsSeconds = DB_timestamp_seconds(ts)
+            if tsSeconds is not None:
+                _notifyLag.observe(max(0.0, time.time() - tsSeconds),
+                                   {"master": "%s:%s" % self._addr},
+                                   agent=aHandle.agentKey, vsite=vSite)
+        else:
+            self._synced.add(vSite)
+        aHandle.trace_event("notify", time.time(), vSite, "master")
+        # Note: All vSites are notified when the database connection
+        # is restored.
+        aHandle.start_site_update(endDict={vSite: ts}, vsNames=[vSite])
         
 
     def work_if_ready(self, now, aHandle):
-        """Connect to master if unconnected, and scheduled."""
+        """Connect to master if unconnected, and scheduled.
 
-        if self._s is None and self._connectTime <= now:
-            logger = aHandle.logger
-            try:
-                s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                s.connect(self._addr)
-            except:
-                self.handle_disconnect(aHandle)
-                return
-            self._s = s
-            p = xdrlib.Packer()
-            p.pack_string(aHandle.sitename)
-            p.pack_list(aHandle.vSites, p.pack_string)
-            self._wbuf += p.get_buffer()
-            logger.debug("Connection welcome queued to master.")
-
-
-    def compute_wake_time(self, currentWakeTime):
-        if self._s is None:
-            print "Compting wake time"
-            currentWakeTime = min(currentWakeTime, self._connectTime)
-        return currentWakeTime
+        Connecting (name lookup included) can block for a long time,
+        so it is done by the agent's executor."""
+
+        if self._s is None and not self._connecting and \
+           self._connectTime <= now:
+            self._connecting = True
+            aHandle.executor.submit(
+                self._connect, (),
+                lambda s, excInfo: self.finish_connect(s, excInfo, aHandle))
+
+
+    def _connect(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            s.connect(self._addr)
+        except:
+            s.close()
+            raise
+        return s
+
+
+    def finish_connect(self, s, excInfo, aHandle):
+        """Send the welcome, once connected to the master."""
+
+        self._connecting = False
+        if excInfo is not None:
+            self.handle_disconnect(aHandle)
+            return
+        self._s = s
+        self._synced = set()
+        protocol = self._reader.protocol
+        self._wqueue.append(preamble(protocol) +
+                            frame(pack_welcome(aHandle.sitename,
+                                               aHandle.vSites),
+                                  protocol))
+        self.attach(aHandle)
+        aHandle.logger.debug("Connection welcome queued to master.")
+
+
+    def schedule(self, aHandle):
+        """Arrange for work_if_ready to run at the next connect time."""
+
+        aHandle.eventLoop.schedule(("master", self), self._connectTime)
             
             
 class MasterAgentSet(ConnectionSet):
@@ -121,10 +145,10 @@ class MasterAgentSet(ConnectionSet):
     def __init__(self):
         ConnectionSet.__init__(self)
 
-    def compute_wake_time(self, currentWakeTime):
-        for c in self._conns:
-            currentWakeTime = c.compute_wake_time(currentWakeTime)
-        return currentWakeTime
+    def schedule(self, aHandle):
+        """Schedule connection attempts to all the masters."""
+        for c in self._conns.values():
+            c.schedule(aHandle)
 
 
 #    def add_master(self, hostAddr, port, aHandle):
@@ -1,7 +1,11 @@
 """ Slave connections"""
 
-import socket, xdrlib
+import collections, socket, time
 from ConnectSet import Connection, ConnectionSet, ConnectionError
+from DBHelpers import DB_timestamp_seconds
+from EventLoop import EVENT_READ
+from Metrics import registry, LAG_BUCKETS
+from WireProtocol import *
 
 from Agent import AgentError
 
@@ -19,6 +23,16 @@ class SlaveConnectionError(SlaveError): pass
 
 class SlaveProtocolError(SlaveConnectionError): pass
 
+_notifyLag = registry.histogram(
+    "hpcagent_slave_notify_lag_seconds",
+    "Time from a vsite's update timestamp to the notification being "
+    "written to a slave, by agent and vsite.",
+    ("agent", "vsite"), buckets=LAG_BUCKETS)
+_notifiesSuperseded = registry.counter(
+    "hpcagent_slave_notifies_superseded_total",
+    "Notifications to slaves replaced by a newer one for the same vsite "
+    "before they could be written.")
+
 
 def _testListSubset(candSub, candSuper):
     """Test if elements of 'candSub' are all elements of 'candSuper'."""
@@ -33,78 +47,135 @@ def _testListSubset(candSub, candSuper):
 class SlaveAgentConnection(Connection):
     """Model a connection to an enslaved agent."""
 
-    def __init__(self, s, addr, aHandle):
+    peerType = "slave"
+
+    def __init__(self, s, addr, aHandle, slaveSet=None):
         Connection.__init__(self, addr, aHandle)
         self._s = s
         self._vSites = []
+        # The set indexing this slave by the vsites it follows.
+        self._slaveSet = slaveSet
+        self._exemplar = {"slave": "%s:%s" % addr[:2]}
+        # Notifications waiting for the slave to take more output:
+        # vsName -> (data, child, tsSeconds), the newest for each vsite.
+        self._pending = collections.OrderedDict()
+        # The slave's first bytes tell which protocol it speaks.
+        self._reader = MessageReader(unpack_welcome)
         aHandle.logger.debug("New slave connection from %s", repr(addr))
 
+    # The protocol the slave speaks; None until it is known.
+    protocol = property(lambda self: self._reader.protocol)
+
 
     def handle_disconnect(self, aHandle):
         """Disconnect a slave."""
-        try:
-            self._s.close()
-        except:
-            pass
-        self._s = None
+        self.close_socket(aHandle)
         raise SlaveConnectionError
 
 
     def handle_input(self, aHandle):
         """Handle input from slave."""
         while True:
-            rbuf = self._rbuf
             try:
-                u = xdrlib.Unpacker(rbuf)
-                slaveSite = u.unpack_string()
-                slaveVSites = u.unpack_list(u.unpack_string)
-            except:
-                # No, it is not complete.
+                msg = self._reader.next_message(self._rbuf)
+            except ProtocolError, e:
+                aHandle.logger.warning("Protocol error from slave at %s: %s",
+                                       repr(self._addr), e)
+                self.close_socket(aHandle)
+                raise SlaveProtocolError(str(e))
+            if msg is None:
                 return
-            self._rbuf = rbuf[u.get_position():]
-            self.process_input_data(aHandle, slaveSite, slaveVSites)
+            self.process_input_data(aHandle, *msg)
 
 
     def process_input_data(self, aHandle, slaveSite, slaveVSites):
 
         logger = aHandle.logger
-        s = self._s
 
         # Make sure we can serve this slave.
         if slaveSite != aHandle.sitename:
             logger.warning("Slave belongs to wrong site.")
-            s.close()
-            self._s = None
+            self.close_socket(aHandle)
             raise SlaveSiteError
         if not _testListSubset(slaveVSites, aHandle.vSites):
             logger.warning("Slave has vSites not managed by this agent.")
-            s.close()
-            self._s = None
+            self.close_socket(aHandle)
             raise SlaveSiteError
 
         # Store the list of vSites for which this slave needs information.
+        if self._slaveSet is not None:
+            self._slaveSet.subscribe(self, slaveVSites)
         self._vSites = slaveVSites
 
-        # Send the timestamp to each VSite.
+        # Send the timestamp to each VSite.  A vsite never updated has
+        # none to send yet.
         for vsName in slaveVSites:
+            if not aHandle.has_timestamp(vsName):
+                continue
             ts = aHandle.vHandles[vsName].get_timestamp()
             self.notify_vsite(vsName, aHandle, ts)
     
 
-    def notify_vsite(self, vsName, aHandle, ts):
-        """Tell slave to notify a vSite to update to the specified time."""
+    def notify_vsite(self, vsName, aHandle, ts, tsSeconds=None):
+        """Tell slave to notify a vSite to update to the specified time.
+
+        Given `tsSeconds`, the time of `ts`, the lag until the
+        notification is written is recorded."""
         aHandle.logger.debug("Connection notify for %s sent to %s",
                              vsName, repr(self._addr))
         if vsName in self._vSites:
-            p = xdrlib.Packer()
-            p.pack_string(vsName)
-            p.pack_string(ts)
-            self._wbuf += p.get_buffer()
-            aHandle.logger.debug("Connection to %s has %d bytes queued",
-                                 repr(self._addr), len(self._wbuf))
-
-    def __hash__(self):
-        return hash(self._s)
+            child = None
+            if tsSeconds is not None:
+                child = _notifyLag.labels(agent=aHandle.agentKey,
+                                          vsite=vsName)
+            self.queue_notify(vsName,
+                              frame(pack_notify(vsName, ts), self.protocol),
+                              aHandle, child, tsSeconds)
+            aHandle.logger.debug("Connection to %s has %d bytes in %d "
+                                 "messages queued, %d vsites pending",
+                                 repr(self._addr), len(self._wqueue),
+                                 self._wqueue.messages, len(self._pending))
+
+
+    def queue_notify(self, vsName, data, aHandle, child=None,
+                     tsSeconds=None):
+        """Hold a notification for `vsName`, `data` being framed for this
+        slave, until the slave can take it.
+
+        A notification still held for the vsite is replaced, so however
+        far behind the slave falls, it gets at most one per vsite once
+        it catches up.  Given the lag histogram `child` and `tsSeconds`,
+        the time of the notification's timestamp, the lag until it is
+        written is recorded."""
+        pending = self._pending
+        if vsName in pending:
+            _notifiesSuperseded.inc()
+        elif not pending and len(self._wqueue) == 0:
+            self.want_write(aHandle)
+        pending[vsName] = (data, child, tsSeconds)
+
+
+    def fill_output(self, aHandle):
+        """Queue the notifications held, now the slave can take them."""
+        pending = self._pending
+        for data, child, tsSeconds in pending.itervalues():
+            onWritten = None
+            if child is not None:
+                onWritten = self._lag_observer(child, tsSeconds)
+            self.queue_output(data, aHandle, onWritten)
+        pending.clear()
+
+
+    def _lag_observer(self, child, tsSeconds):
+        exemplar = self._exemplar
+        return lambda: child.observe(max(0.0, time.time() - tsSeconds),
+                                     exemplar)
+
+
+    def queued_bytes(self):
+        """Output waiting for the slave, the notifications held included."""
+        return len(self._wqueue) + \
+               sum([len(p[0]) for p in self._pending.itervalues()])
 
 
 
@@ -121,40 +192,81 @@ class SlaveAgentSet(ConnectionSet):
         s.listen(5)
         self._s = s
 
-    def prepare_select(self, r, w):
-        """Prepare lists for select."""
-
-        ConnectionSet.prepare_select(self, r, w)
+        # vsName -> set of the connections of slaves following it.
+        self._subscribers = {}
 
-        # Always listen to the connection socket.
-        r.append(self._s)
+    def start(self, aHandle):
+        """Begin accepting slave connections in the event loop."""
 
+        aHandle.eventLoop.register(self._s, EVENT_READ,
+                                   lambda events: self.handle_accept(aHandle))
 
-    def read_if_ready(self, r, aHandle):
-        """Read from whatever connections are ready."""
 
-        ConnectionSet.read_if_ready(self, r, aHandle)
+    def handle_accept(self, aHandle):
+        """Accept a pending connection request."""
 
         logger = aHandle.logger
+        try:
+            s,addr = self._s.accept()
+            s.setblocking(0)
+        except:
+            logger.exception("Failed to accept new slave connection.")
+        else:
+            logger.info("Accepted connection from slave.")
+            c = SlaveAgentConnection(s, addr, aHandle, self)
+            self.insert_connection(c)
+            self.attach(c, aHandle)
 
-        # See if there is a connection request.
-        if self._s in r:
-            try:
-                s,addr = self._s.accept()
-                s.setblocking(0)
-            except:
-                logger.exception("Failed to accept new slave connection.")
-            else:
-                logger.info("Accepted connection from slave.")
-                c = SlaveAgentConnection(s, addr, aHandle)
-                self.insert_connection(c)
+
+    def remove_connection(self, c):
+        """Forget a slave, and the vsites it followed."""
+
+        ConnectionSet.remove_connection(self, c)
+        self.unsubscribe(c)
+
+
+    def subscribe(self, c, vsNames):
+        """Note that slave `c` follows the vsites `vsNames`, and only those."""
+
+        self.unsubscribe(c)
+        for vsName in vsNames:
+            self._subscribers.setdefault(vsName, set()).add(c)
+
+
+    def unsubscribe(self, c):
+        """Forget the vsites slave `c` followed."""
+
+        for vsName in c._vSites:
+            subs = self._subscribers.get(vsName)
+            if subs is not None:
+                subs.discard(c)
+                if not subs:
+                    del self._subscribers[vsName]
 
 
     def notify_vsite(self, vsName, aHandle):
-        """Notify slaves that a vsite needs updating."""
+        """Notify slaves that a vsite needs updating.
+
+        The notification is encoded once, and framed once for each
+        protocol spoken; the slaves following the vsite share it."""
 
+        subs = self._subscribers.get(vsName)
+        if not subs:
+            aHandle.logger.debug("No agents follow vsite %s", vsName)
+            return
         ts = aHandle.vHandles[vsName].get_timestamp()
-        aHandle.logger.debug("Notify agents about vsite %s", vsName)
-        for c in self._conns.values():
-            c.notify_vsite(vsName, aHandle, ts)
+        tsSeconds = DB_timestamp_seconds(ts)
+        child = None
+        if tsSeconds is not None:
+            child = _notifyLag.labels(agent=aHandle.agentKey, vsite=vsName)
+        body = pack_notify(vsName, ts)
+        framed = {}
+        for c in subs:
+            protocol = c.protocol
+            data = framed.get(protocol)
+            if data is None:
+                data = framed[protocol] = frame(body, protocol)
+            c.queue_notify(vsName, data, aHandle, child, tsSeconds)
+        aHandle.logger.debug("Notified %d agents about vsite %s",
+                             len(subs), vsName)
 
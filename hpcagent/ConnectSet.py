@@ -1,23 +1,115 @@
 """Connections and sets of connections."""
 
+import collections
+import itertools
+
 __all__ = [
-    "Connection", "ConnectionSet",
+    "Connection", "ConnectionSet", "WriteQueue",
     "ConnectionError"
     ]
 
+from EventLoop import EVENT_READ, EVENT_WRITE
+from Metrics import registry as _registry
+from WireProtocol import ReceiveBuffer
+
+_bytesRead = _registry.counter(
+    "hpcagent_connection_read_bytes_total",
+    "Bytes read from peer agents.", ("peer",))
+_bytesWritten = _registry.counter(
+    "hpcagent_connection_written_bytes_total",
+    "Bytes written to peer agents.", ("peer",))
+_messagesWritten = _registry.counter(
+    "hpcagent_connection_written_messages_total",
+    "Messages written in full to peer agents.", ("peer",))
+_queuedBytes = _registry.histogram(
+    "hpcagent_connection_queued_bytes",
+    "Output waiting for a peer agent, each time more is queued.",
+    ("peer",),
+    buckets=(64, 256, 1024, 4096, 16384, 65536, 262144, 1048576))
+
 
 class ConnectionError(Exception):
     pass
 
 
+class WriteQueue(object):
+    """Output waiting for a peer: a deque of messages, the first of
+    which may be partly written.
+
+    Python 2 sockets have no sendmsg(), so send() gathers small messages
+    at the head into one string of up to SEND_SIZE bytes; a large one is
+    sent in place through a buffer.  Either way each byte is copied at
+    most once, however long the backlog."""
+
+    SEND_SIZE = 65536
+
+    def __init__(self):
+        self._chunks = collections.deque()
+        self._offset = 0
+        self.bytes = 0              # queued
+        self.messages = 0           # queued, counting one partly written
+        self.bytesWritten = 0
+        self.messagesWritten = 0
+
+    def __len__(self):
+        return self.bytes
+
+    def append(self, data):
+        if data:
+            self._chunks.append(data)
+            self.bytes += len(data)
+            self.messages += 1
+
+    def clear(self):
+        self._chunks.clear()
+        self._offset = 0
+        self.bytes = 0
+        self.messages = 0
+
+    def send(self, s):
+        """Send what socket `s` takes.  Returns the bytes sent, and the
+        messages completed."""
+        chunks = self._chunks
+        head = chunks[0]
+        if len(chunks) == 1 or len(head) - self._offset >= self.SEND_SIZE:
+            data = buffer(head, self._offset)
+        else:
+            parts = [head[self._offset:]]
+            size = len(parts[0])
+            for c in itertools.islice(chunks, 1, None):
+                if size >= self.SEND_SIZE:
+                    break
+                parts.append(c)
+                size += len(c)
+            data = "".join(parts)
+        sent = s.send(data)
+
+        self.bytes -= sent
+        self.bytesWritten += sent
+        n = self._offset + sent
+        done = 0
+        while chunks and n >= len(chunks[0]):
+            n -= len(chunks.popleft())
+            done += 1
+        self._offset = n
+        self.messages -= done
+        self.messagesWritten += done
+        return sent, done
+
+
 class Connection(object):
     """Model a connection to a remote peer."""
 
+    # Kind of peer, for metrics.
+    peerType = "peer"
+
     def __init__(self, addr, aHandle):
         self._addr = addr
         self._s = None
-        self._rbuf = ""
-        self._wbuf = ""
+        self._rbuf = ReceiveBuffer()
+        self._wqueue = WriteQueue()
+        self._written = 0
+        self._marks = collections.deque()
 
 
     def handle_disconnect(self, aHandle):
@@ -32,51 +124,131 @@ class Connection(object):
         raise NotImplementedError
 
 
-    def prepare_select(self, r, w):
-        """Prepare selection sets for readers, writers."""
+    def attach(self, aHandle, callback=None):
+        """Watch the socket in the agent's event loop.
+
+        `callback(events)` handles events; by default handle_events."""
+
+        if callback is None:
+            callback = lambda events: self.handle_events(events, aHandle)
+        events = EVENT_READ
+        if len(self._wqueue) > 0:
+            events |= EVENT_WRITE
+        aHandle.eventLoop.register(self._s, events, callback)
+
+    def detach(self, aHandle):
+        """Stop watching the socket.  This must precede closing it."""
 
         if self._s is not None:
-            r.append(self._s)
-        if len(self._wbuf) > 0:
-            w.append(self._s)
+            aHandle.eventLoop.unregister(self._s)
+
+    def close_socket(self, aHandle):
+        """Stop watching and close the socket."""
 
-    def write_if_ready(self, w, aHandle):
         s = self._s
-        if s not in w:
+        if s is None:
             return
-        wbuf = self._wbuf
-        assert len(wbuf) > 0
+        self.detach(aHandle)
+        try:
+            s.close()
+        except:
+            pass
+        self._s = None
+        self._written = 0
+        self._marks.clear()
+
+    def queued_bytes(self):
+        """Output waiting to be written to the peer."""
+
+        return len(self._wqueue)
+
+    def fill_output(self, aHandle):
+        """Queue output held back until the peer can take it.  Called
+        when the socket is writable and the write queue empty."""
+
+        pass
+
+    def want_write(self, aHandle):
+        """Have the event loop report when the socket is writable."""
+
+        s = self._s
+        loop = aHandle.eventLoop
+        if s is not None and loop.is_registered(s):
+            loop.modify(s, EVENT_READ|EVENT_WRITE)
+
+    def queue_output(self, data, aHandle, onWritten=None):
+        """Queue `data` to be written once the peer can take it.
+
+        `onWritten()` is called once all of `data` has been written."""
+
+        wq = self._wqueue
+        wasEmpty = len(wq) == 0
+        wq.append(data)
+        if onWritten is not None:
+            self._marks.append((self._written + len(wq), onWritten))
+        _queuedBytes.observe(len(wq), peer=self.peerType)
+        s = self._s
+        loop = aHandle.eventLoop
+        if wasEmpty and s is not None and loop.is_registered(s):
+            loop.modify(s, EVENT_READ|EVENT_WRITE)
+
+    def handle_events(self, events, aHandle):
+        """Handle readiness of the socket."""
+
+        if events & EVENT_READ:
+            self.handle_readable(aHandle)
+        if events & EVENT_WRITE and self._s is not None:
+            if len(self._wqueue) == 0:
+                self.fill_output(aHandle)
+            if len(self._wqueue) > 0:
+                self.handle_writable(aHandle)
+            else:
+                aHandle.eventLoop.modify(self._s, EVENT_READ)
+
+    def handle_writable(self, aHandle):
+        """Write as much queued output as the peer takes."""
+        s = self._s
+        wq = self._wqueue
         try:
-            sent = s.send(wbuf)
+            sent, done = wq.send(s)
         except:
             self.handle_disconnect(aHandle)
             return
-        self._wbuf = wbuf[sent:]
-        aHandle.logger.debug("Wrote to peer at %s: %s (%d of %d bytes)",
-                                 repr(self._addr), repr(wbuf[sent:]), sent, len(wbuf))
-
-    def read_if_ready(self, r, aHandle):
+        self._written += sent
+        _bytesWritten.inc(sent, peer=self.peerType)
+        if done:
+            _messagesWritten.inc(done, peer=self.peerType)
+        marks = self._marks
+        while marks and marks[0][0] <= self._written:
+            marks.popleft()[1]()
+        aHandle.logger.debug("Wrote %d bytes to peer at %s; %d bytes in "
+                             "%d messages left", sent, repr(self._addr),
+                             len(wq), wq.messages)
+        if len(wq) == 0:
+            self.fill_output(aHandle)
+            if len(wq) == 0:
+                aHandle.eventLoop.modify(s, EVENT_READ)
+
+    def handle_readable(self, aHandle):
         """Process pending input, or disconnection."""
         s = self._s
-        if s not in r:
-            return
         logger = aHandle.logger
 
         # Get the latest data.
         try:
             # FIXME: Configurable buffer size (?)
-            rbuf = s.recv(4096)
+            n = self._rbuf.recv_from(s, 4096)
         except:
             # Something weird with this socket!
             logger.exception("Exception thrown, socket to %s",
                              repr(self._addr))
             self.handle_disconnect(aHandle)
             return
-        if len(rbuf) == 0:
+        if n == 0:
             logger.info("Connection to %s was closed", repr(self._addr))
             self.handle_disconnect(aHandle)
             return
-        self._rbuf += rbuf
+        _bytesRead.inc(n, peer=self.peerType)
         self.handle_input(aHandle)
 
     def work_if_ready(self, now, aHandle):
@@ -91,36 +263,39 @@ class ConnectionSet(object):
     def __init__(self):
         self._conns = {}
 
-    def prepare_select(self, r, w):
-        """Prepare selection sets for readers, writers."""
-
-        for c in self._conns.values():
-            c.prepare_select(r, w)
-
     def insert_connection(self, c):
         """Insert a new managed connection."""
 
         self._conns[c] = c
 
 
-    def write_if_ready(self, w, aHandle):
-        """Write to whatever connections are ready."""
+    def remove_connection(self, c):
+        """Forget a connection, which has been closed."""
 
-        for c in self._conns.values():
-            try:
-                c.write_if_ready(w, aHandle)
-            except ConnectionError:
-                del self._conns[c]
+        self._conns.pop(c, None)
 
 
-    def read_if_ready(self, r, aHandle):
-        """Read from whatever connections are ready."""
+    def attach(self, c, aHandle):
+        """Watch a connection's socket; drop the connection on error."""
+
+        c.attach(aHandle,
+                 lambda events: self.handle_events(c, events, aHandle))
+
+
+    def handle_events(self, c, events, aHandle):
+        """Handle readiness of a connection's socket."""
+
+        try:
+            c.handle_events(events, aHandle)
+        except ConnectionError:
+            c.close_socket(aHandle)
+            self.remove_connection(c)
+
+    def queued_bytes(self):
+        """Total output waiting to be written to the connections."""
+
+        return sum([c.queued_bytes() for c in self._conns.values()])
 
-        for c in self._conns.values():
-            try:
-                c.read_if_ready(r, aHandle)
-            except ConnectionError:
-                del self._conns[c]
 
     def work_if_ready(self, now, aHandle):
         """Attempt all scheduled connections."""
@@ -1,6 +1,12 @@
 """Database abstraction and helpers."""
 
+import calendar
+import datetime
 from itertools import chain, count, izip
+import re
+import time
+
+from Metrics import registry as _registry
 
 # Interface to psycopg2.
 import psycopg2
@@ -12,9 +18,27 @@ DBOperationalError = psycopg2.OperationalError
 __all__ = [
     "DB_connect", "DB_cleanup", "DBTimestamp",
     "DBDatabaseError", "DBOperationalError",
-    "DB_get_next_row"
+    "DB_get_next_row", "DB_stream_cursor", "DB_row_schema", "Row",
+    "DB_DEFAULT_BATCH_SIZE", "DBStatementCache",
+    "DB_timestamp_seconds"
     ]
 
+# Number of rows transferred per round trip by streaming cursors.
+DB_DEFAULT_BATCH_SIZE = 1000
+
+# Source of unique names for server-side cursors.
+_streamCounter = count(1)
+
+_rowsFetched = _registry.counter(
+    "hpcagent_db_rows_fetched_total",
+    "Rows fetched with DB_get_next_row.").labels()
+_fetchSeconds = _registry.histogram(
+    "hpcagent_db_fetch_seconds",
+    "Time to fetch a batch of rows from a streaming cursor.").labels()
+_querySeconds = _registry.histogram(
+    "hpcagent_db_query_seconds",
+    "Time to run a prepared statement, by statement.", ("statement",))
+
 def DB_cleanup(conn, cur=None):
     if cur is not None:
         try:
@@ -28,8 +52,133 @@ def DB_cleanup(conn, cur=None):
             pass
 
 
+class RowSchema(object):
+    """Column layout shared by all the rows of a result set.
+
+    `index` maps column positions and names to positions.  Names are
+    matched without regard to case; each spelling used is added to
+    the map the first time it is looked up."""
+
+    __slots__ = ("names", "index")
+
+    def __init__(self, desc):
+        self.names = names = tuple([d[0] for d in desc])
+        index = dict(izip(names, count()))
+        index.update(izip(xrange(len(names)), count()))
+        self.index = index
+
+    def lookup(self, cn):
+        """Find the position of a column name not yet in the map."""
+        if not isinstance(cn, basestring):
+            raise KeyError(cn)
+        i = self.index.get(cn.lower())
+        if i is None:
+            raise KeyError(cn)
+        self.index[cn] = i
+        return i
+
+
+class Row(object):
+    """A row, indexed by column position or (case-insensitive) name.
+
+    This behaves like the dictionary RowDict built, but only holds
+    the column values and a reference to the shared RowSchema.  Values
+    stored under new names are kept aside in `_extra`."""
+
+    __slots__ = ("_schema", "_cols", "_extra")
+
+    def __init__(self, schema, cols):
+        self._schema = schema
+        self._cols = cols
+        self._extra = None
+
+    def __getitem__(self, cn):
+        try:
+            return self._cols[self._schema.index[cn]]
+        except KeyError:
+            pass
+        try:
+            return self._cols[self._schema.lookup(cn)]
+        except KeyError:
+            if self._extra is None or not isinstance(cn, basestring):
+                raise
+            return self._extra[cn.lower()]
+
+    def __setitem__(self, cn, val):
+        try:
+            i = self._schema.index[cn]
+        except KeyError:
+            try:
+                i = self._schema.lookup(cn)
+            except KeyError:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[cn.lower()] = val
+                return
+        cols = list(self._cols)
+        cols[i] = val
+        self._cols = cols
+
+    def get(self, cn, default=None):
+        try:
+            return self[cn]
+        except KeyError:
+            return default
+
+    def has_key(self, cn):
+        try:
+            self[cn]
+        except KeyError:
+            return False
+        return True
+
+    __contains__ = has_key
+
+    def keys(self):
+        k = range(len(self._cols))
+        k.extend(self._schema.names)
+        if self._extra is not None:
+            k.extend(self._extra.keys())
+        return k
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __repr__(self):
+        return "Row(%r)" % (dict(self.items()),)
+
+
+# Schemas of recently seen cursor descriptions, keyed by id().  The
+# description is kept with its schema, so its id cannot be reused.
+_schemaCache = {}
+_SCHEMA_CACHE_SIZE = 16
+
+def DB_row_schema(desc):
+    """Get the RowSchema for a cursor description."""
+
+    try:
+        d, schema = _schemaCache[id(desc)]
+        if d is desc:
+            return schema
+    except KeyError:
+        pass
+    if len(_schemaCache) >= _SCHEMA_CACHE_SIZE:
+        _schemaCache.clear()
+    schema = RowSchema(desc)
+    _schemaCache[id(desc)] = (desc, schema)
+    return schema
+
+
 class RowDict(dict):
-    """Dictionary built from a row and its description."""
+    """Dictionary built from a row and its description.
+
+    Superseded by Row; kept for comparison by benchmarks/rowbench.py."""
 
     def __init__(self, desc, cols):
         """Build a dictionary for a row."""
@@ -48,10 +197,170 @@ class RowDict(dict):
         dict.__setitem__(self, cn.lower(), val)
 
 
+# Matches the text of a timestamp, with optional time zone offset.
+_timestampRE = re.compile(r"(\d{4})-(\d\d)-(\d\d)[ T](\d\d):(\d\d):(\d\d)"
+                          r"(\.\d+)?\s*(Z|([+-])(\d\d)(?::?(\d\d))?"
+                          r"(?::?(\d\d))?)?$")
+
+def DB_timestamp_seconds(ts):
+    """Convert a timestamp, or its text, to seconds since the epoch.
+
+    Timestamps without a time zone are taken as local time.  Returns
+    None if `ts` is not understood."""
+
+    if isinstance(ts, datetime.datetime):
+        if ts.tzinfo is not None and ts.utcoffset() is not None:
+            t = calendar.timegm(ts.utctimetuple())
+        else:
+            t = time.mktime(ts.timetuple())
+        return t + ts.microsecond / 1e6
+    m = _timestampRE.match(str(ts).strip())
+    if m is None:
+        return None
+    fields = tuple([int(f) for f in m.group(1, 2, 3, 4, 5, 6)])
+    frac = float(m.group(7) or 0)
+    if m.group(8) is None:
+        return time.mktime(fields + (0, 0, -1)) + frac
+    offset = 0
+    if m.group(9) is not None:
+        offset = int(m.group(10))*3600 + int(m.group(11) or 0)*60 + \
+                 int(m.group(12) or 0)
+        if m.group(9) == "-":
+            offset = -offset
+    return calendar.timegm(fields + (0, 0, 0)) - offset + frac
+
+
 def DB_get_next_row(cur):
-    """Get a row from a cursor.  Returns a dict, or None."""
+    """Get a row from a cursor.  Returns a Row, or None."""
 
     r = cur.fetchone()
     if r is None:
         return r
-    return RowDict(cur.description, r)
+    _rowsFetched.inc()
+    return Row(DB_row_schema(cur.description), r)
+
+
+class DBStreamCursor(object):
+    """Stream a result set through a server-side (named) cursor.
+
+    Rows are fetched from the server `batchSize` at a time, so only one
+    batch is held in memory.  The cursor is declared WITH HOLD, which
+    lets it be used on a connection in autocommit mode.  Only the parts
+    of the cursor interface used by the agents are provided."""
+
+    def __init__(self, conn, batchSize=DB_DEFAULT_BATCH_SIZE):
+        name = "hpcagent_stream_%d" % next(_streamCounter)
+        self._cur = conn.cursor(name, withhold=True)
+        self._cur.itersize = batchSize
+        self.batchSize = batchSize
+        self._batch = []
+        self._pos = 0
+
+    name = property(lambda self: self._cur.name)
+    connection = property(lambda self: self._cur.connection)
+    description = property(lambda self: self._cur.description)
+
+    def execute(self, q, params=None):
+        self._batch = []
+        self._pos = 0
+        self._cur.execute(q, params)
+
+    def fetchone(self):
+        if self._pos >= len(self._batch):
+            started = time.time()
+            self._batch = self._cur.fetchmany(self.batchSize)
+            _fetchSeconds.observe(time.time() - started)
+            self._pos = 0
+            if not self._batch:
+                return None
+        r = self._batch[self._pos]
+        self._pos += 1
+        return r
+
+    def fetchall(self):
+        R = self._batch[self._pos:]
+        self._batch = []
+        self._pos = 0
+        R.extend(self._cur.fetchall())
+        return R
+
+    def __iter__(self):
+        while True:
+            r = self.fetchone()
+            if r is None:
+                return
+            yield r
+
+    def close(self):
+        self._batch = []
+        try:
+            self._cur.close()
+        except:
+            pass
+
+
+def DB_stream_cursor(conn, batchSize=DB_DEFAULT_BATCH_SIZE):
+    """Open a cursor that streams its results in batches."""
+
+    return DBStreamCursor(conn, batchSize)
+
+
+# Matches the named placeholders used in queries, e.g. %(vsName)s.
+_placeholderRE = re.compile(r"%\((\w+)\)s")
+
+# Source of unique names for prepared statements.
+_statementCounter = count(1)
+
+class DBStatementCache(object):
+    """Registry of prepared statements for each database connection.
+
+    A query is prepared the first time it is run on a connection under
+    a given key, then run with EXECUTE.  The key must identify the text
+    of the query, e.g. its shape with or without optional conditions.
+    Call invalidate() when a connection is closed."""
+
+    def __init__(self):
+        self._stmts = {}
+
+    def execute(self, cur, key, q, params):
+        """Run query `q`, with named parameters, as a prepared statement."""
+
+        # A server-side cursor can only be declared for a plain query.
+        if getattr(cur, "name", None) is not None:
+            cur.execute(q, params)
+            return
+
+        if isinstance(key, tuple):
+            label = key[0]
+        else:
+            label = key
+        started = time.time()
+
+        stmts = self._stmts.setdefault(cur.connection, {})
+        try:
+            stmtName, argNames = stmts[key]
+        except KeyError:
+            stmtName = "hpcagent_stmt_%d" % next(_statementCounter)
+            argNames = []
+            def number(m):
+                n = m.group(1)
+                if n not in argNames:
+                    argNames.append(n)
+                return "$%d" % (argNames.index(n)+1,)
+            pq = _placeholderRE.sub(number, q).replace("%%", "%")
+            cur.execute("PREPARE %s AS %s" % (stmtName, pq))
+            stmts[key] = (stmtName, argNames)
+
+        if argNames:
+            cur.execute("EXECUTE %s (%s)" %
+                        (stmtName,
+                         ", ".join(["%%(%s)s" % n for n in argNames])),
+                        params)
+        else:
+            cur.execute("EXECUTE %s" % (stmtName,))
+        _querySeconds.observe(time.time() - started, statement=label)
+
+    def invalidate(self, conn):
+        """Forget the statements prepared on a connection."""
+
+        self._stmts.pop(conn, None)
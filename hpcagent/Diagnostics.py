@@ -0,0 +1,208 @@
+"""Diagnostics for running agents: a stack sampler and memory census."""
+
+import gc
+import os, os.path
+import signal
+import sys
+import threading
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+__all__ = [
+    "StackSampler", "memory_census", "process_memory",
+    "trace_allocations", "write_memory_report"
+    ]
+
+
+class StackSampler(object):
+    """Sample the stacks of all threads on a profiling timer.
+
+    Each time the process has used `interval` seconds of CPU, the stack
+    of every thread is counted.  An idle agent is not sampled.  Counts
+    are kept in the "folded" form read by flame graph tools: frames
+    from the thread name down to the leaf, separated by semicolons.
+
+    Sampling is not free: each sample walks every thread's stack, and
+    each SIGPROF also wakes an event loop that has a signal wakeup
+    descriptor, up to 1/`interval` times a second while any thread is
+    busy.  So sampling stops after `duration` seconds, if given: the
+    first tick past it disarms the timer and calls the `onExpire` given
+    to start(), which should then call stop().
+
+    Signal handlers run in the main thread, so start() and stop() must
+    be called there."""
+
+    def __init__(self, interval=0.01, duration=None):
+        self.interval = interval
+        self.duration = duration
+        self.running = False
+        self.counts = {}
+        self.samples = 0
+        self.started = None
+        self.deadline = None
+        self._onExpire = None
+        self._names = {}
+
+    def start(self, onExpire=None):
+        self.counts = {}
+        self.samples = 0
+        self.started = time.time()
+        if self.duration is None:
+            self.deadline = None
+        else:
+            self.deadline = self.started + self.duration
+        self._onExpire = onExpire
+        self._oldHandler = signal.signal(signal.SIGPROF, self._sample)
+        # Let interrupted system calls carry on.
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._oldHandler or signal.SIG_DFL)
+        self.running = False
+        self.deadline = None
+        self._onExpire = None
+
+    def _thread_name(self, ident):
+        try:
+            return self._names[ident]
+        except KeyError:
+            self._names = dict([(t.ident, t.getName())
+                                for t in threading.enumerate()])
+            return self._names.get(ident, "thread-%s" % ident)
+
+    def _sample(self, signum, frame):
+        if self.deadline is not None and time.time() >= self.deadline:
+            # The window is over: no more ticks.
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            self.deadline = None
+            if self._onExpire is not None:
+                self._onExpire()
+            return
+        main = threading.currentThread().ident
+        counts = self.counts
+        for ident, f in sys._current_frames().items():
+            if ident == main:
+                # Skip this handler; start at the interrupted frame.
+                f = frame
+            stack = []
+            while f is not None:
+                code = f.f_code
+                stack.append("%s:%s" % (os.path.basename(code.co_filename),
+                                        code.co_name))
+                f = f.f_back
+            stack.append(self._thread_name(ident))
+            stack.reverse()
+            key = ";".join(stack)
+            counts[key] = counts.get(key, 0) + 1
+        self.samples += 1
+
+    def write(self, fname):
+        """Write the folded stacks, most frequent first."""
+        items = self.counts.items()
+        items.sort(key=lambda kv: -kv[1])
+        f = open(fname, "w")
+        try:
+            for key, n in items:
+                f.write("%s %d\n" % (key, n))
+        finally:
+            f.close()
+
+
+def memory_census():
+    """Count objects tracked by the garbage collector, by type.
+
+    Returns {type name: [count, bytes]}, the bytes being the shallow
+    sizes of the objects."""
+    census = {}
+    for o in gc.get_objects():
+        t = type(o)
+        name = "%s.%s" % (getattr(t, "__module__", "?"), t.__name__)
+        try:
+            size = sys.getsizeof(o)
+        except:
+            size = 0
+        try:
+            c = census[name]
+        except KeyError:
+            census[name] = [1, size]
+        else:
+            c[0] += 1
+            c[1] += size
+    return census
+
+
+def process_memory():
+    """Get {"VmRSS": kB, "VmHWM": kB, ...} for this process, where the
+    system provides them."""
+    R = {}
+    try:
+        f = open("/proc/self/status")
+    except IOError:
+        return R
+    try:
+        for line in f:
+            if line.startswith("Vm"):
+                k, v = line.split(":", 1)
+                R[k] = v.strip()
+    finally:
+        f.close()
+    return R
+
+
+def trace_allocations(nFrames=10):
+    """Start tracing allocations with tracemalloc, where Python has it.
+
+    Returns whether allocations are traced.  Only allocations made
+    after tracing starts are seen in reports."""
+    if tracemalloc is None:
+        return False
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(nFrames)
+    return True
+
+
+def write_memory_report(fname, census, lastCensus=None, top=50):
+    """Write a memory report: process sizes, the largest types in
+    `census`, and the types that grew most since `lastCensus`."""
+    f = open(fname, "w")
+    try:
+        f.write("Memory snapshot of pid %d at %s\n\n" %
+                (os.getpid(), time.ctime()))
+        for k, v in sorted(process_memory().items()):
+            f.write("%-10s %s\n" % (k + ":", v))
+        f.write("\n%d gc-tracked objects, %d bytes (shallow)\n" %
+                (sum([c[0] for c in census.values()]),
+                 sum([c[1] for c in census.values()])))
+
+        f.write("\nLargest types:\n%12s %14s  %s\n" % ("count", "bytes", "type"))
+        items = census.items()
+        items.sort(key=lambda kv: -kv[1][1])
+        for name, (n, size) in items[:top]:
+            f.write("%12d %14d  %s\n" % (n, size, name))
+
+        if lastCensus is not None:
+            f.write("\nGrowth since last snapshot:\n%12s %14s  %s\n" %
+                    ("count", "bytes", "type"))
+            growth = []
+            for name, (n, size) in census.items():
+                n0, size0 = lastCensus.get(name, (0, 0))
+                if n != n0 or size != size0:
+                    growth.append((size - size0, n - n0, name))
+            growth.sort(reverse=True)
+            for dsize, dn, name in growth[:top]:
+                f.write("%+12d %+14d  %s\n" % (dn, dsize, name))
+
+        if tracemalloc is not None and tracemalloc.is_tracing():
+            f.write("\nAllocations by line (tracemalloc):\n")
+            stats = tracemalloc.take_snapshot().statistics("lineno")
+            for stat in stats[:top]:
+                f.write("%s\n" % (stat,))
+    finally:
+        f.close()
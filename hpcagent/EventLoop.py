@@ -0,0 +1,352 @@
+"""Event loop: persistent descriptor registrations and a timer heap."""
+
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import Queue
+import select
+import sys
+import threading
+
+__all__ = [
+    "EventLoop", "Executor", "Selector", "TimerHeap",
+    "EVENT_READ", "EVENT_WRITE"
+    ]
+
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+def _fileno(fileobj):
+    if isinstance(fileobj, (int, long)):
+        return fileobj
+    return fileobj.fileno()
+
+
+class Selector(object):
+    """Wait for events on registered file objects.
+
+    Registrations persist between calls to select(), which costs time
+    in proportion to the number of ready descriptors.  Uses epoll where
+    available, then poll, then select.  Each registration carries a
+    `data` value, returned with its events."""
+
+    def __init__(self):
+        self._fds = {}      # fd -> [fileobj, events, data]
+        self._objs = {}     # fileobj -> fd
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._in, self._out = select.EPOLLIN, select.EPOLLOUT
+            self._err = select.EPOLLERR | select.EPOLLHUP
+            self._msec = False
+        elif hasattr(select, "poll"):
+            self._poller = select.poll()
+            self._in, self._out = select.POLLIN, select.POLLOUT
+            self._err = select.POLLERR | select.POLLHUP | select.POLLNVAL
+            self._msec = True
+        else:
+            self._poller = None
+
+    def _mask(self, events):
+        m = 0
+        if events & EVENT_READ:
+            m |= self._in
+        if events & EVENT_WRITE:
+            m |= self._out
+        return m
+
+    def register(self, fileobj, events, data=None):
+        fd = _fileno(fileobj)
+        if fd in self._fds:
+            raise KeyError("descriptor %d is already registered" % fd)
+        self._fds[fd] = [fileobj, events, data]
+        self._objs[fileobj] = fd
+        if self._poller is not None:
+            self._poller.register(fd, self._mask(events))
+
+    def modify(self, fileobj, events, data=None):
+        fd = self._objs[fileobj]
+        reg = self._fds[fd]
+        if data is not None:
+            reg[2] = data
+        if reg[1] != events:
+            reg[1] = events
+            if self._poller is not None:
+                self._poller.modify(fd, self._mask(events))
+
+    def unregister(self, fileobj):
+        """Stop watching `fileobj`.  Call this before closing it."""
+        fd = self._objs.pop(fileobj, None)
+        if fd is None or self._fds.get(fd, [None])[0] is not fileobj:
+            return
+        del self._fds[fd]
+        if self._poller is not None:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, OSError, KeyError, ValueError):
+                pass
+
+    def is_registered(self, fileobj):
+        return fileobj in self._objs
+
+    def select(self, timeout=None):
+        """Wait up to `timeout` seconds; return [(data, events)]."""
+        try:
+            if self._poller is None:
+                return self._select(timeout)
+            if self._msec:
+                if timeout is not None:
+                    timeout = int(timeout*1000 + 0.5)
+            elif timeout is None:
+                timeout = -1
+            ready = self._poller.poll(timeout)
+        except (select.error, IOError, OSError), e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+        R = []
+        for fd, m in ready:
+            reg = self._fds.get(fd)
+            if reg is None:
+                continue
+            events = 0
+            if m & (self._in | self._err):
+                events |= EVENT_READ
+            if m & self._out:
+                events |= EVENT_WRITE
+            R.append((reg[2], events & (reg[1] | EVENT_READ)))
+        return R
+
+    def _select(self, timeout):
+        r = [fd for fd, reg in self._fds.items() if reg[1] & EVENT_READ]
+        w = [fd for fd, reg in self._fds.items() if reg[1] & EVENT_WRITE]
+        r, w, x = select.select(r, w, [], timeout)
+        ready = {}
+        for fd in r:
+            ready[fd] = ready.get(fd, 0) | EVENT_READ
+        for fd in w:
+            ready[fd] = ready.get(fd, 0) | EVENT_WRITE
+        return [(self._fds[fd][2], events) for fd, events in ready.items()
+                if fd in self._fds]
+
+
+class TimerHeap(object):
+    """Timers, each named by a hashable key, kept in a min-heap.
+
+    Scheduling a key again replaces its previous time.  Replaced and
+    cancelled entries are left in the heap and skipped when they come
+    up.  Safe to schedule from other threads."""
+
+    def __init__(self):
+        self._heap = []
+        self._when = {}
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def schedule(self, key, when):
+        self._lock.acquire()
+        try:
+            self._when[key] = when
+            heapq.heappush(self._heap, (when, next(self._seq), key))
+            if len(self._heap) > 2*len(self._when) + 64:
+                self._compact()
+        finally:
+            self._lock.release()
+
+    def cancel(self, key):
+        self._lock.acquire()
+        try:
+            self._when.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def get(self, key):
+        """When `key` is scheduled, or None."""
+        return self._when.get(key)
+
+    def _compact(self):
+        self._heap = [e for e in self._heap if self._when.get(e[2]) == e[0]]
+        heapq.heapify(self._heap)
+
+    def _discard_stale(self):
+        heap = self._heap
+        while heap and self._when.get(heap[0][2]) != heap[0][0]:
+            heapq.heappop(heap)
+
+    def next_time(self):
+        """Time of the earliest timer, or None."""
+        self._lock.acquire()
+        try:
+            self._discard_stale()
+            if self._heap:
+                return self._heap[0][0]
+            return None
+        finally:
+            self._lock.release()
+
+    def pop_due(self, now):
+        """Remove and return the keys of timers due by `now`, in order."""
+        keys = []
+        self._lock.acquire()
+        try:
+            heap = self._heap
+            while True:
+                self._discard_stale()
+                if not heap or heap[0][0] > now:
+                    break
+                when, seq, key = heapq.heappop(heap)
+                del self._when[key]
+                keys.append(key)
+        finally:
+            self._lock.release()
+        return keys
+
+
+class EventLoop(object):
+    """A Selector together with a TimerHeap.
+
+    Other threads hand work to the loop's thread with
+    call_soon_threadsafe(), which wakes the loop through a pipe."""
+
+    def __init__(self):
+        self.selector = Selector()
+        self.timers = TimerHeap()
+        self.thread = threading.currentThread()
+        self._calls = collections.deque()
+        self._wakeR, self._wakeW = os.pipe()
+        for fd in (self._wakeR, self._wakeW):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+        self.register(self._wakeR, EVENT_READ, self._handle_wakeup)
+
+    def register(self, fileobj, events, callback):
+        """Watch `fileobj`; `callback(events)` is called when ready."""
+        self.selector.register(fileobj, events, callback)
+
+    def modify(self, fileobj, events):
+        self.selector.modify(fileobj, events)
+
+    def unregister(self, fileobj):
+        self.selector.unregister(fileobj)
+
+    def is_registered(self, fileobj):
+        return self.selector.is_registered(fileobj)
+
+    def schedule(self, key, when):
+        self.timers.schedule(key, when)
+
+    def cancel(self, key):
+        self.timers.cancel(key)
+
+    def timeout(self, now, maxTimeout):
+        """Seconds until the next timer, but no more than `maxTimeout`."""
+        t = self.timers.next_time()
+        if t is None:
+            return maxTimeout
+        return max(0.0, min(maxTimeout, t - now))
+
+    def is_loop_thread(self):
+        return threading.currentThread() is self.thread
+
+    def call_soon_threadsafe(self, fn, *args):
+        """Have the loop's thread call `fn(*args)` on its next pass."""
+        self._calls.append((fn, args))
+        self.wakeup()
+
+    def wakeup_fd(self):
+        """A descriptor whose writing wakes the loop, for
+        signal.set_wakeup_fd()."""
+        return self._wakeW
+
+    def wakeup(self):
+        """Make a waiting poll() return."""
+        try:
+            os.write(self._wakeW, "\0")
+        except OSError, e:
+            # A full pipe will wake the loop anyway.
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def _handle_wakeup(self, events):
+        try:
+            while os.read(self._wakeR, 4096):
+                pass
+        except OSError, e:
+            if e.errno not in (errno.EAGAIN, errno.EINTR):
+                raise
+
+    def run_calls(self):
+        """Make the calls requested by other threads."""
+        calls = self._calls
+        while calls:
+            fn, args = calls.popleft()
+            fn(*args)
+
+    def poll(self, timeout):
+        """Wait for events, calling the callbacks of ready objects."""
+        if self._calls:
+            timeout = 0
+        for callback, events in self.selector.select(timeout):
+            callback(events)
+        self.run_calls()
+
+    def pop_due(self, now):
+        return self.timers.pop_due(now)
+
+
+class Executor(object):
+    """Run blocking calls on worker threads, off the event loop.
+
+    submit() queues a call; when it returns, `callback(result, excInfo)`
+    is called in the loop's thread, `excInfo` being sys.exc_info() if
+    the call raised, else None.  Threads are started on first use."""
+
+    def __init__(self, loop, nThreads=1, name="executor"):
+        self.loop = loop
+        self.nThreads = nThreads
+        self.name = name
+        self._queue = Queue.Queue()
+        self._threads = []
+
+    def submit(self, fn, args=(), callback=None):
+        if len(self._threads) < self.nThreads:
+            t = threading.Thread(target=self._worker,
+                                 name="%s-%d" % (self.name,
+                                                 len(self._threads)))
+            t.setDaemon(True)
+            self._threads.append(t)
+            t.start()
+        self._queue.put((fn, args, callback))
+
+    def pending(self):
+        """Approximate number of calls waiting for a thread."""
+        return self._queue.qsize()
+
+    def shutdown(self):
+        """Stop the threads once queued calls are done."""
+        for t in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            fn, args, callback = item
+            try:
+                result = fn(*args)
+                excInfo = None
+            except:
+                result = None
+                excInfo = sys.exc_info()
+            if callback is not None:
+                self.loop.call_soon_threadsafe(callback, result, excInfo)
+            # Drop references before waiting for more work.
+            item = fn = args = callback = result = excInfo = None
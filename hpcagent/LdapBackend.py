@@ -0,0 +1,264 @@
+"""LDAP backends for the LDAP agent: python-ldap, or a directory in memory.
+
+A backend offers the few synchronous operations the agent makes, each
+one round trip to the server: search_base(), add(), modify() and
+delete().  Entries are dictionaries of attribute names to lists of
+values.  Failures raise LdapError; a missing entry raises
+NoSuchObject."""
+
+import sys
+import threading
+import time
+
+__all__ = [
+    "LdapError", "NoSuchObject", "AlreadyExists",
+    "LdapBackend", "PythonLdapBackend", "MemoryLdapBackend",
+    "MemoryDirectory", "open_ldap_backend", "add_modlist", "modify_modlist",
+    "LDAP_BACKENDS"
+    ]
+
+# Kinds of backend, as named by the 'backend' option.
+LDAP_BACKENDS = ("ldap", "memory")
+
+# Modification operations, as python-ldap numbers them.
+MOD_ADD = 0
+MOD_DELETE = 1
+MOD_REPLACE = 2
+
+
+class LdapError(Exception):
+    """Error from an LDAP backend."""
+
+class NoSuchObject(LdapError): pass
+
+class AlreadyExists(LdapError): pass
+
+
+def _values(v):
+    if isinstance(v, basestring):
+        v = [v]
+    return [x for x in v if x is not None]
+
+def add_modlist(entry):
+    """The modification list adding `entry`, as ldap.modlist.addModlist."""
+    return [(attr, _values(v)) for attr, v in entry.items() if _values(v)]
+
+def modify_modlist(old, new, ignoreOldExistent=0):
+    """The modification list turning `old` into `new`, as
+    ldap.modlist.modifyModlist.  Attribute names are compared without
+    regard to case; with `ignoreOldExistent`, attributes only in `old`
+    are kept."""
+    oldByName = dict([(attr.lower(), (attr, _values(v)))
+                      for attr, v in old.items()])
+    R = []
+    seen = set()
+    for attr, v in new.items():
+        nv = _values(v)
+        key = attr.lower()
+        seen.add(key)
+        ov = oldByName.get(key, (attr, []))[1]
+        if not nv:
+            if ov:
+                R.append((MOD_DELETE, attr, None))
+        elif not ov:
+            R.append((MOD_ADD, attr, nv))
+        elif sorted(ov) != sorted(nv):
+            R.append((MOD_DELETE, attr, None))
+            R.append((MOD_ADD, attr, nv))
+    if not ignoreOldExistent:
+        for key, (attr, ov) in oldByName.items():
+            if key not in seen and ov:
+                R.append((MOD_DELETE, attr, None))
+    return R
+
+
+class LdapBackend(object):
+    """Operations on a directory, each one round trip."""
+
+    def search_base(self, dn):
+        """Get the entry at `dn`."""
+        raise NotImplementedError
+
+    def add(self, dn, entry):
+        """Create the entry at `dn`."""
+        raise NotImplementedError
+
+    def modify(self, dn, old, new, ignoreOldExistent=0):
+        """Change the entry at `dn` from `old` to `new`.  Returns the
+        modification list sent, which is empty if nothing changed."""
+        raise NotImplementedError
+
+    def delete(self, dn):
+        """Remove the entry at `dn`."""
+        raise NotImplementedError
+
+    def unbind(self):
+        pass
+
+
+class PythonLdapBackend(LdapBackend):
+    """A server reached through python-ldap."""
+
+    def __init__(self, uri, who, cred):
+        import ldap, ldap.modlist
+        self._ldap = ldap
+        try:
+            self._l = ldap.initialize(uri)
+            self._l.bind_s(who, cred)
+        except ldap.LDAPError, e:
+            raise LdapError, e, sys.exc_info()[2]
+
+    def _call(self, fn, *args):
+        ldap = self._ldap
+        try:
+            return fn(*args)
+        except ldap.NO_SUCH_OBJECT, e:
+            raise NoSuchObject, e, sys.exc_info()[2]
+        except ldap.ALREADY_EXISTS, e:
+            raise AlreadyExists, e, sys.exc_info()[2]
+        except ldap.LDAPError, e:
+            raise LdapError, e, sys.exc_info()[2]
+
+    def search_base(self, dn):
+        return self._call(self._l.search_s, dn, self._ldap.SCOPE_BASE)[0][1]
+
+    def add(self, dn, entry):
+        self._call(self._l.add_s, dn, self._ldap.modlist.addModlist(entry))
+
+    def modify(self, dn, old, new, ignoreOldExistent=0):
+        modList = self._ldap.modlist.modifyModlist(old, new,
+                                                   ignore_oldexistent=ignoreOldExistent)
+        if modList:
+            self._call(self._l.modify_s, dn, modList)
+        return modList
+
+    def delete(self, dn):
+        self._call(self._l.delete_s, dn)
+
+    def unbind(self):
+        try:
+            self._l.unbind_s()
+        except self._ldap.LDAPError:
+            pass
+
+
+class MemoryDirectory(object):
+    """Entries kept in memory, by DN, with a count of operations and
+    the time spent in injected latency.
+
+    get() returns the directory for a URI, so that the agent's
+    successive connections see the same entries."""
+
+    _directories = {}
+    _registryLock = threading.Lock()
+
+    def __init__(self):
+        self.entries = {}
+        self.ops = {}
+        self.waited = 0.0
+        self.lock = threading.Lock()
+
+    def get(cls, uri):
+        cls._registryLock.acquire()
+        try:
+            try:
+                return cls._directories[uri]
+            except KeyError:
+                d = cls._directories[uri] = cls()
+                return d
+        finally:
+            cls._registryLock.release()
+    get = classmethod(get)
+
+    def count(self, op):
+        self.ops[op] = self.ops.get(op, 0) + 1
+
+    def reset_counts(self):
+        self.ops = {}
+        self.waited = 0.0
+
+
+class MemoryLdapBackend(LdapBackend):
+    """A directory held in memory, with `latency` seconds added to each
+    round trip, to stand in for a server at some distance."""
+
+    def __init__(self, directory, latency=0.0):
+        self.directory = directory
+        self.latency = latency
+        self._round_trip("bind")
+
+    def _round_trip(self, op):
+        self.directory.count(op)
+        if self.latency > 0:
+            started = time.time()
+            time.sleep(self.latency)
+            self.directory.waited += time.time() - started
+
+    def search_base(self, dn):
+        self._round_trip("search")
+        d = self.directory
+        d.lock.acquire()
+        try:
+            try:
+                entry = d.entries[dn.lower()][1]
+            except KeyError:
+                raise NoSuchObject(dn)
+            return dict([(attr, list(v)) for attr, v in entry.items()])
+        finally:
+            d.lock.release()
+
+    def add(self, dn, entry):
+        self._round_trip("add")
+        d = self.directory
+        d.lock.acquire()
+        try:
+            if dn.lower() in d.entries:
+                raise AlreadyExists(dn)
+            d.entries[dn.lower()] = (dn, dict(add_modlist(entry)))
+        finally:
+            d.lock.release()
+
+    def modify(self, dn, old, new, ignoreOldExistent=0):
+        modList = modify_modlist(old, new, ignoreOldExistent)
+        if not modList:
+            return modList
+        self._round_trip("modify")
+        d = self.directory
+        d.lock.acquire()
+        try:
+            try:
+                entry = d.entries[dn.lower()][1]
+            except KeyError:
+                raise NoSuchObject(dn)
+            byName = dict([(attr.lower(), attr) for attr in entry])
+            for op, attr, v in modList:
+                name = byName.get(attr.lower(), attr)
+                if op == MOD_DELETE:
+                    entry.pop(name, None)
+                    byName.pop(attr.lower(), None)
+                elif op == MOD_ADD:
+                    entry[name] = entry.get(name, []) + list(v)
+                    byName[attr.lower()] = name
+                else:
+                    entry[name] = list(v)
+                    byName[attr.lower()] = name
+        finally:
+            d.lock.release()
+        return modList
+
+    def delete(self, dn):
+        self._round_trip("delete")
+        d = self.directory
+        d.lock.acquire()
+        try:
+            if d.entries.pop(dn.lower(), None) is None:
+                raise NoSuchObject(dn)
+        finally:
+            d.lock.release()
+
+
+def open_ldap_backend(kind, uri, who, cred, latency=0.0):
+    """Connect to a directory with the backend named by `kind`."""
+    if kind == "memory":
+        return MemoryLdapBackend(MemoryDirectory.get(uri), latency)
+    return PythonLdapBackend(uri, who, cred)
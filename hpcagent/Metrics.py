@@ -0,0 +1,332 @@
+"""Metrics: counters, gauges and histograms, exported as Prometheus text."""
+
+import bisect
+import errno
+import os, os.path
+import socket
+import threading
+import time
+
+from EventLoop import EVENT_READ, EVENT_WRITE
+
+__all__ = [
+    "MetricsRegistry", "MetricsServer", "registry",
+    "DEFAULT_BUCKETS", "LAG_BUCKETS"
+    ]
+
+# Latency buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5,
+                   1.0, 5.0, 10.0, 60.0, 300.0, 1800.0)
+
+# Propagation lag buckets, in seconds.
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+               900.0, 3600.0, 21600.0, 86400.0)
+
+
+def _escape(v):
+    return str(v).replace("\\", "\\\\").replace("\n", "\\n") \
+                 .replace('"', '\\"')
+
+def _format_labels(names, values, extra=""):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+def _format_exemplar(ex):
+    labels, v, t = ex
+    pairs = ['%s="%s"' % (n, _escape(labels[n])) for n in sorted(labels)]
+    return " # {%s} %s %.3f" % (",".join(pairs), _format_value(v), t)
+
+def _format_value(v):
+    if v == float("inf"):
+        return "+Inf"
+    if isinstance(v, float) and v == int(v) and abs(v) < 1e15:
+        return str(int(v))
+    return repr(v)
+
+
+class _Metric(object):
+    """A metric: one value (or histogram) per combination of labels."""
+
+    kind = None
+
+    def __init__(self, registry, name, help, labelNames, fn):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.fn = fn
+        self._lock = registry._lock
+        self._children = {}
+
+    def labels(self, **labels):
+        """Get the child for a combination of labels, to update it cheaply."""
+        key = tuple([labels[n] for n in self.labelNames])
+        try:
+            return self._children[key]
+        except KeyError:
+            self._lock.acquire()
+            try:
+                return self._children.setdefault(key, self._new_child())
+            finally:
+                self._lock.release()
+
+    def _samples(self):
+        """[(suffix, labelValues, extraLabel, value, exemplar)]."""
+        if self.fn is not None:
+            return [("", key, "", v, None) for key, v in self.fn()]
+        R = []
+        for key, child in sorted(self._children.items()):
+            R.extend([(suffix, key, extra, v, ex)
+                      for suffix, extra, v, ex in child.samples()])
+        return R
+
+    def render(self, openMetrics=False):
+        """Render in Prometheus text format, or OpenMetrics with exemplars."""
+        family = self.name
+        if openMetrics and self.kind == "counter" and \
+           family.endswith("_total"):
+            family = family[:-len("_total")]
+        lines = ["# HELP %s %s" % (family, self.help),
+                 "# TYPE %s %s" % (family, self.kind)]
+        for suffix, key, extra, v, ex in self._samples():
+            line = "%s%s%s %s" % (self.name, suffix,
+                                  _format_labels(self.labelNames, key, extra),
+                                  _format_value(v))
+            if openMetrics and ex is not None:
+                line += _format_exemplar(ex)
+            lines.append(line)
+        return "\n".join(lines)
+
+
+class _Value(object):
+    __slots__ = ("_lock", "value")
+
+    def __init__(self, lock):
+        self._lock = lock
+        self.value = 0
+
+    def inc(self, n=1):
+        self._lock.acquire()
+        self.value += n
+        self._lock.release()
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def set(self, v):
+        self.value = v
+
+    def samples(self):
+        return [("", "", self.value, None)]
+
+
+class _HistogramValue(object):
+    __slots__ = ("_lock", "buckets", "counts", "sum", "count", "exemplars")
+
+    def __init__(self, lock, buckets):
+        self._lock = lock
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.exemplars = [None] * (len(buckets) + 1)
+
+    def observe(self, v, exemplar=None):
+        """Count `v`.  An `exemplar` (a dict of labels, e.g. naming the
+        change observed) is kept as the latest example for its bucket."""
+        i = bisect.bisect_left(self.buckets, v)
+        self._lock.acquire()
+        self.counts[i] += 1
+        self.sum += v
+        self.count += 1
+        if exemplar is not None:
+            self.exemplars[i] = (exemplar, v, time.time())
+        self._lock.release()
+
+    def samples(self):
+        R = []
+        n = 0
+        for b, c, ex in zip(self.buckets + (float("inf"),), self.counts,
+                            self.exemplars):
+            n += c
+            R.append(("_bucket", 'le="%s"' % _format_value(float(b)), n, ex))
+        R.append(("_sum", "", self.sum, None))
+        R.append(("_count", "", self.count, None))
+        return R
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def inc(self, n=1, **labels):
+        self.labels(**labels).inc(n)
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value(self._lock)
+
+    def set(self, v, **labels):
+        self.labels(**labels).set(v)
+
+    def inc(self, n=1, **labels):
+        self.labels(**labels).inc(n)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labelNames, buckets):
+        _Metric.__init__(self, registry, name, help, labelNames, None)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self._lock, self.buckets)
+
+    def observe(self, v, exemplar=None, **labels):
+        self.labels(**labels).observe(v, exemplar)
+
+
+class MetricsRegistry(object):
+    """A named collection of metrics.
+
+    Asking again for a metric of the same name returns the existing
+    one, so modules may declare what they use at import.  A gauge or
+    counter given `fn` is computed when rendered: `fn()` returns a
+    list of (labelValues, value)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._order = []
+
+    def _get(self, cls, name, *args):
+        self._lock.acquire()
+        try:
+            m = self._metrics.get(name)
+            if m is None:
+                m = self._metrics[name] = cls(self, name, *args)
+                self._order.append(m)
+        finally:
+            self._lock.release()
+        if not isinstance(m, cls):
+            raise ValueError("metric %s is a %s" % (name, m.kind))
+        return m
+
+    def counter(self, name, help, labelNames=(), fn=None):
+        return self._get(Counter, name, help, labelNames, fn)
+
+    def gauge(self, name, help, labelNames=(), fn=None):
+        return self._get(Gauge, name, help, labelNames, fn)
+
+    def histogram(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelNames, buckets)
+
+    def render(self, openMetrics=False):
+        """The metrics in Prometheus text exposition format.
+
+        With `openMetrics`, use the OpenMetrics format instead, which
+        carries the exemplars of histograms."""
+        text = "\n".join([m.render(openMetrics) for m in list(self._order)])
+        if openMetrics:
+            return text + "\n# EOF\n"
+        return text + "\n"
+
+    def write_file(self, fname):
+        """Atomically replace `fname` with the rendered metrics."""
+        tmpName = fname + ".tmp"
+        f = open(tmpName, "w")
+        try:
+            f.write(self.render())
+        finally:
+            f.close()
+        os.rename(tmpName, fname)
+
+
+# The registry used by the agents.
+registry = MetricsRegistry()
+
+
+class MetricsServer(object):
+    """Serve a registry over HTTP from an event loop.
+
+    `addr` is a (host, port) pair, or the path of a Unix socket.  Any
+    request gets the metrics in reply; the connection is then closed.
+    A request accepting OpenMetrics gets that format, with exemplars."""
+
+    def __init__(self, registry, addr):
+        self.registry = registry
+        self.addr = addr
+        if isinstance(addr, tuple):
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        else:
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            if os.path.exists(addr):
+                os.unlink(addr)
+        s.bind(addr)
+        s.listen(5)
+        s.setblocking(0)
+        self._s = s
+        self._clients = {}  # socket -> [request, reply]
+
+    def start(self, loop):
+        self.loop = loop
+        loop.register(self._s, EVENT_READ, self._handle_accept)
+
+    def _handle_accept(self, events):
+        try:
+            s, addr = self._s.accept()
+        except socket.error:
+            return
+        s.setblocking(0)
+        self._clients[s] = ["", None]
+        self.loop.register(s, EVENT_READ, lambda events: self._handle_client(s, events))
+
+    def _close(self, s):
+        self.loop.unregister(s)
+        del self._clients[s]
+        try:
+            s.close()
+        except:
+            pass
+
+    def _handle_client(self, s, events):
+        state = self._clients[s]
+        try:
+            if state[1] is None:
+                data = s.recv(4096)
+                state[0] += data
+                if data and "\r\n\r\n" not in state[0] and \
+                   "\n\n" not in state[0] and len(state[0]) < 65536:
+                    return
+                if "application/openmetrics-text" in state[0]:
+                    body = self.registry.render(openMetrics=True)
+                    ctype = "application/openmetrics-text; version=1.0.0; " \
+                            "charset=utf-8"
+                else:
+                    body = self.registry.render()
+                    ctype = "text/plain; version=0.0.4"
+                state[1] = ("HTTP/1.0 200 OK\r\n"
+                            "Content-Type: %s\r\n"
+                            "Content-Length: %d\r\n"
+                            "Connection: close\r\n\r\n%s") % (ctype, len(body),
+                                                              body)
+                self.loop.modify(s, EVENT_WRITE)
+            sent = s.send(state[1])
+            state[1] = state[1][sent:]
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EINTR):
+                return
+            self._close(s)
+            return
+        if not state[1]:
+            self._close(s)
@@ -1,11 +1,17 @@
 """Common code for Site Agents."""
 
+import ConfigParser
+import cProfile
 import logging
 import os.path
-import select
+import pstats
+import Queue
+import random
+import signal
 import socket
 import subprocess
 import sys
+import threading
 import time
 import xdrlib
 
@@ -13,6 +19,10 @@ from Agent import *
 from DBHelpers import *
 from AgentSlave import *
 from AgentMaster import *
+from EventLoop import *
+from Metrics import *
+from Trace import *
+from WireProtocol import WIRE_PROTOCOLS
 
 __all__ = [
     # From SiteAgent
@@ -28,6 +38,36 @@ class VSiteError(AgentError): pass
 
 class UpdateVSiteError(VSiteError): pass
 
+_vsiteUpdates = registry.counter(
+    "hpcagent_vsite_updates_total",
+    "Vsite updates, by vsite and result.", ("vsite", "result"))
+_vsiteUpdateSeconds = registry.histogram(
+    "hpcagent_vsite_update_seconds",
+    "Time taken by vsite updates, by vsite.", ("vsite",))
+_vsiteLastSuccess = registry.gauge(
+    "hpcagent_vsite_last_success_timestamp_seconds",
+    "When each vsite last completed an update.", ("vsite",))
+_rowsProcessed = registry.counter(
+    "hpcagent_rows_processed_total",
+    "Change rows applied by vsite updates, by vsite and kind.",
+    ("vsite", "kind"))
+_propagationLag = registry.histogram(
+    "hpcagent_propagation_lag_seconds",
+    "Time from a change's modified time to its being applied, by agent, "
+    "vsite and kind.", ("agent", "vsite", "kind"), buckets=LAG_BUCKETS)
+_escapeSeconds = registry.histogram(
+    "hpcagent_escape_seconds",
+    "Time taken by escapes, by operation.", ("op",))
+_escapeFailures = registry.counter(
+    "hpcagent_escape_failures_total",
+    "Escapes exiting with a non-zero code, by operation.", ("op",))
+_notifiesReceived = registry.counter(
+    "hpcagent_notifies_received_total",
+    "Notifications received from the database.")
+_notifiesCoalesced = registry.counter(
+    "hpcagent_notifies_coalesced_total",
+    "Notifications merged into an update already pending.")
+
 
 class VSiteAgent(object):
     """Model a VSite updating instance."""
@@ -36,7 +76,14 @@ class VSiteAgent(object):
         self.vsName = vsName
         self.aHandle = aHandle
         self.is_bootstrapping = False
-        self.retryUpdateTime = None
+        self.is_full_scan = False
+        self._retryUpdateTime = None
+        self._streams = []
+        self._scanPoints = {}
+        self._scanCounts = {}
+        self._rowCounters = {}
+        self._lagHistograms = {}
+        self._lastRows = {}
         cp = aHandle.configParser
         try:
             self.updateRetryInterval = cp.getfloat(vsName,
@@ -44,8 +91,22 @@ class VSiteAgent(object):
         except:
             self.updateRetryInterval = None
 
+    def _set_retry_update_time(self, t):
+        self._retryUpdateTime = t
+        self.aHandle.schedule_vsite_retry(self.vsName, t)
+
+    # When to retry a failed update; None if no retry is due.  Setting
+    # it schedules (or cancels) a timer in the agent's event loop.
+    retryUpdateTime = property(lambda self: self._retryUpdateTime,
+                               _set_retry_update_time)
+
     def prepare_update(self, cur):
         self.timeStamp = self.get_timestamp()
+        self.is_full_scan = self.is_bootstrapping or \
+                            not self.aHandle.has_timestamp(self.vsName)
+        self._scanPoints = {}
+        self._scanCounts = {}
+        self._lastRows = {}
 
     def update_groups(self, cur, end=None):
         pass
@@ -55,15 +116,23 @@ class VSiteAgent(object):
 
     def finish_update(self, cur, completed, end=None):
 
+        self.close_streams()
+
+        if completed:
+            self.record_applied()
+        self._lastRows = {}
+
         if completed:
             # FIXME: Slight race -- Connection might die before commit.
             self.set_timestamp(cur)
-            self.aHandle.conn.commit()
+            self.clear_checkpoints()
+            cur.connection.commit()
 
             self.retryUpdateTime = None
             self.aHandle.notify_vsites(self.vsName)
 
         else:
+            self.save_checkpoints()
             if self.updateRetryInterval is not None:
                 self.retryUpdateTime = time.time() + self.updateRetryInterval
 
@@ -114,6 +183,135 @@ class VSiteAgent(object):
             self.retryUpdateTime = time.time() + self.updateRetryInterval
             raise
 
+    def open_stream(self, cur):
+        """Open a cursor for a change set, on the same connection as `cur`.
+
+        Depending on 'server_side_cursors', this streams the results
+        from the server, or is an ordinary cursor (which can run
+        prepared statements).  Streams still open are closed by
+        finish_update.  With --record, the rows read are recorded."""
+        aHandle = self.aHandle
+        mode = aHandle.serverSideCursors
+        if mode == "always" or (mode == "bootstrap" and self.is_full_scan):
+            scur = DB_stream_cursor(cur.connection, aHandle.fetchBatchSize)
+        else:
+            scur = cur.connection.cursor()
+        if aHandle.trace is not None:
+            scur = RecordingCursor(scur, aHandle.trace, self.vsName)
+        self._streams.append(scur)
+        return scur
+
+    def close_streams(self):
+        """Close any streaming cursors opened during this update."""
+        for scur in self._streams:
+            try:
+                scur.close()
+            except:
+                pass
+        self._streams = []
+
+    # -- resumable scans --
+    #
+    # Change sets are read in (modified, key) order, the key being uid
+    # or gid.  An update notes its position in each scan with
+    # checkpoint(); every 'checkpoint_interval' rows, and when the update
+    # fails, the position is saved.  A retry from the same timestamp
+    # then resumes the scan at that position instead of the start.  The
+    # row at the position is applied again, so rows sharing a key are
+    # never skipped.
+
+    def get_resume_key(self, kind):
+        return "%s-%s-resume" % (self.vsName, kind)
+
+    def get_scan_base(self):
+        """Identify the timestamp the current scans started from."""
+        if self.is_full_scan:
+            return "full"
+        return str(self.timeStamp)
+
+    def get_resume_point(self, kind):
+        """Get (modified, key) to resume a scan of `kind` rows, or None."""
+        self._scanCounts.setdefault(kind, 0)
+        cp = self.aHandle.stateStore.get(self.get_resume_key(kind))
+        if cp is None:
+            return None
+        try:
+            ts, modified, key = cp.rsplit("|", 2)
+            key = int(key)
+        except ValueError:
+            return None
+        if ts != self.get_scan_base():
+            return None
+        self.aHandle.logger.info("Resuming %s of vsite %s at (%s, %d)",
+                                 kind, self.vsName, modified, key)
+        return (modified, key)
+
+    def checkpoint(self, kind, modified, key):
+        """Note that a scan of `kind` rows has reached (modified, key).
+
+        This also marks the previous row of the scan as applied."""
+        if not self.is_full_scan:
+            self.record_applied(kind)
+            self._lastRows[kind] = (modified, key)
+        self._scanPoints[kind] = (modified, key)
+        try:
+            self._rowCounters[kind].inc()
+        except KeyError:
+            c = self._rowCounters[kind] = \
+                _rowsProcessed.labels(vsite=self.vsName, kind=kind)
+            c.inc()
+        n = self._scanCounts[kind] = self._scanCounts.get(kind, 0) + 1
+        interval = self.aHandle.checkpointInterval
+        if interval > 0 and n % interval == 0:
+            self.save_checkpoint(kind)
+
+    def record_applied(self, kind=None):
+        """Record the propagation lag of the last row of a scan of `kind`,
+        or of all scans, now that it has been applied.
+
+        The lag runs from the row's modified time in the database to
+        now; rows of a full scan are not counted."""
+        if kind is None:
+            kinds = self._lastRows.keys()
+        else:
+            kinds = [kind]
+        now = time.time()
+        for kind in kinds:
+            last = self._lastRows.pop(kind, None)
+            if last is None:
+                continue
+            modified, key = last
+            t = DB_timestamp_seconds(modified)
+            if t is None:
+                continue
+            try:
+                h = self._lagHistograms[kind]
+            except KeyError:
+                h = self._lagHistograms[kind] = \
+                    _propagationLag.labels(agent=self.aHandle.agentKey,
+                                           vsite=self.vsName, kind=kind)
+            h.observe(max(0.0, now - t), {"id": str(key)})
+
+    def save_checkpoint(self, kind):
+        modified, key = self._scanPoints[kind]
+        self.aHandle.stateStore.set(self.get_resume_key(kind),
+                                    "%s|%s|%s" % (self.get_scan_base(),
+                                                  modified, key),
+                                    sync=True)
+
+    def save_checkpoints(self):
+        """Save the position of every scan, e.g. when an update fails."""
+        for kind in self._scanPoints.keys():
+            self.save_checkpoint(kind)
+
+    def clear_checkpoints(self):
+        """Forget saved positions, once an update is complete."""
+        stateStore = self.aHandle.stateStore
+        for kind in self._scanCounts.keys():
+            key = self.get_resume_key(kind)
+            if stateStore.get(key) is not None:
+                stateStore.delete(key)
+
     def enable_bootstrap(self):
         """Begin the bootstrap process for this virtual site."""
         self.is_bootstrapping = True
@@ -142,11 +340,15 @@ class VSiteAgent(object):
             cmd.append( 'HPCMAN_%s=%s' % (n, u[n]) )
         cmd += filtPath.split()
         cmd.append(op)
+        started = time.time()
         try:
             rc = subprocess.call( cmd )
         except:
             logger.exception("Failed running filter %s", filtPath)
             rc = -1
+        _escapeSeconds.observe(time.time() - started, op=op)
+        if rc != 0:
+            _escapeFailures.inc(op=op)
         logger.info("Escape %s %s exit code %i", filtPath, op, rc)
         return rc
 
@@ -159,6 +361,35 @@ class SiteAgent(Agent):
         Agent.__init__(self, agentKey)
         self.is_bootstrapping = False
 
+        # Descriptors and timers are driven by one event loop.  Calls
+        # that may block for long are run by the executor.
+        self.eventLoop = EventLoop()
+        self.executor = Executor(self.eventLoop, self.executorThreads,
+                                 "blocking")
+
+        # Vsite updates run in order on their own thread, unless
+        # 'background_updates' is off.
+        self.updater = Executor(self.eventLoop, 1, "update")
+        self.fullUpdateQueued = False
+
+        # Updates requested by masters wait in one pass, to the newest
+        # timestamp asked for each vsite: vsName -> timestamp.
+        self.masterUpdates = {}
+        self.masterUpdateQueued = False
+        self.masterUpdatesLock = threading.Lock()
+
+        # Metrics that are computed when exported.
+        self.metrics = registry
+        self.metricsServer = None
+        registry.gauge("hpcagent_dirty_vsites",
+                       "Vsites with notifications not yet acted on.",
+                       fn=lambda: [((), len(self.dirtyVSites))])
+        registry.gauge("hpcagent_update_queue_length",
+                       "Site updates waiting for the update thread.",
+                       fn=lambda: [((), self.updater.pending())])
+        registry.gauge("hpcagent_write_queue_bytes",
+                       "Output waiting to be written, by kind of peer.",
+                       ("peer",), fn=self.get_queued_bytes)
 
         # Set up slave listening.
         if self.slaveListenerPort is None:
@@ -171,8 +402,32 @@ class SiteAgent(Agent):
         self.vSites = None
 
         # Some additional database attributes.
-        self.conn_reset_time = 0
+        self.resyncTime = 0
+        self.dbFailures = 0
         self.isolation_level = None
+        self.listening = False
+
+        # With 'vsite_update_workers' above one, vsites are updated in
+        # parallel by a pool of their own, each on an idle connection
+        # from workerConns.  What a worker would notify or schedule is
+        # kept in workerState, local to its thread, and returned with
+        # its result.
+        self.vsiteWorkers = Executor(self.eventLoop, self.vsiteUpdateWorkers,
+                                     "vsite")
+        self.workerConns = []
+        self.workerConnsLock = threading.Lock()
+        self.workerState = threading.local()
+
+        # Vsites with pending notifications: vsName -> [first, last]
+        # arrival times.  Also count what the coalescing saves.
+        self.dirtyVSites = {}
+        self.notifiesReceived = 0
+        self.notifiesCoalesced = 0
+
+        # The trace being recorded, with --record.
+        self.trace = None
+        if self.options.replaySpeed < 0:
+            self.parser.error("--replay-speed cannot be negative")
 
 
     # -- options --
@@ -185,6 +440,21 @@ class SiteAgent(Agent):
                           action="store_true", dest="bootstrapFlag",
                           default=False,
                           help="bootstrap this agent")
+        parser.add_option("--record",
+                          action="store", dest="recordFile",
+                          metavar="FILE",
+                          help="record notifications and change sets to "
+                               "the trace FILE")
+        parser.add_option("--replay",
+                          action="store", dest="replayFile",
+                          metavar="FILE",
+                          help="replay the updates in the trace FILE, "
+                               "with no database, then exit")
+        parser.add_option("--replay-speed",
+                          action="store", type="float", dest="replaySpeed",
+                          default=1.0, metavar="X",
+                          help="replay X times as fast as recorded; "
+                               "0 for no pauses (default 1)")
 
     # -- get configuration data --
 
@@ -196,6 +466,7 @@ class SiteAgent(Agent):
         self.get_config_data_masters()
         self.get_config_data_update_times()
         self.get_config_data_general_escapes()
+        self.get_config_data_metrics()
 
     def get_config_data_sitename(self):
         """Site agents require a specific site name."""
@@ -230,6 +501,15 @@ class SiteAgent(Agent):
                 logging.fatal("Invalid value for 'master_retry_interval': %s",
                               mrt)
                 sys.exit(1)
+        try:
+            self.masterProtocol = cp.get(self.CONSECT, "master_protocol")
+        except:
+            # Older masters cannot tell "framed" from a huge welcome.
+            self.masterProtocol = "xdr"
+        if self.masterProtocol not in WIRE_PROTOCOLS:
+            logging.fatal("Invalid value for 'master_protocol': %s",
+                          self.masterProtocol)
+            sys.exit(1)
         try:
             mp = cp.get(self.CONSECT, "master_agent")
         except:
@@ -255,6 +535,20 @@ class SiteAgent(Agent):
                 logging.fatal("Invalid value for 'databaseRetryInterval': %s", dbrt)
                 sys.exit(1)
 
+        # Upper bound on the reconnection backoff.
+        try:
+            dbrm = cp.get(self.CONSECT, "database_retry_max_interval")
+        except:
+            self.databaseRetryMaxInterval = max(900.0,
+                                                self.databaseRetryInterval)
+        else:
+            try:
+                self.databaseRetryMaxInterval = float(dbrm)
+            except:
+                logging.fatal("Invalid value for 'database_retry_max_interval': %s",
+                              dbrm)
+                sys.exit(1)
+
         # Get the maximum nap time
         try:
             mnap = cp.get(self.CONSECT, "maximum_nap_time")
@@ -267,7 +561,8 @@ class SiteAgent(Agent):
                 logging.float("Invalid value for 'maximum_nap_time': %s", mnap)
                 sys.exit(1)
 
-        # Get the update heartbeat.
+        # Get the update heartbeat: how often the connection is checked
+        # and, without a master, all vsites are resynchronized.
         try:
             uhb = cp.get(self.CONSECT, "update_heartbeat")
         except:
@@ -279,6 +574,102 @@ class SiteAgent(Agent):
                 logging.fatal("Invalid value for 'update_heartbeat': %s", uhb)
                 sys.exit(1)
 
+        # Get the number of threads for blocking calls.
+        try:
+            et = cp.get(self.CONSECT, "executor_threads")
+        except:
+            self.executorThreads = 2
+        else:
+            try:
+                self.executorThreads = int(et)
+                assert self.executorThreads > 0
+            except:
+                logging.fatal("Invalid value for 'executor_threads': %s", et)
+                sys.exit(1)
+
+        # Run vsite updates off the event loop's thread?
+        try:
+            self.backgroundUpdates = cp.getboolean(self.CONSECT,
+                                                   "background_updates")
+        except ConfigParser.NoOptionError:
+            self.backgroundUpdates = True
+        except:
+            logging.fatal("Invalid value for 'background_updates'")
+            sys.exit(1)
+
+        # Get the number of vsites that may be updated at once.
+        try:
+            vuw = cp.get(self.CONSECT, "vsite_update_workers")
+        except:
+            self.vsiteUpdateWorkers = 1
+        else:
+            try:
+                self.vsiteUpdateWorkers = int(vuw)
+                assert self.vsiteUpdateWorkers > 0
+            except:
+                logging.fatal("Invalid value for 'vsite_update_workers': %s", vuw)
+                sys.exit(1)
+
+        # Get how many rows are applied between saved scan positions.
+        try:
+            ci = cp.get(self.CONSECT, "checkpoint_interval")
+        except:
+            self.checkpointInterval = 1000
+        else:
+            try:
+                self.checkpointInterval = int(ci)
+            except:
+                logging.fatal("Invalid value for 'checkpoint_interval': %s", ci)
+                sys.exit(1)
+
+        # Notifications for a vsite are coalesced until none has come for
+        # 'notify_debounce' seconds, but for no more than 'notify_max_delay'.
+        try:
+            nd = cp.get(self.CONSECT, "notify_debounce")
+        except:
+            self.notifyDebounce = 0.0
+        else:
+            try:
+                self.notifyDebounce = float(nd)
+            except:
+                logging.fatal("Invalid value for 'notify_debounce': %s", nd)
+                sys.exit(1)
+        try:
+            nmd = cp.get(self.CONSECT, "notify_max_delay")
+        except:
+            self.notifyMaxDelay = max(10.0, self.notifyDebounce)
+        else:
+            try:
+                self.notifyMaxDelay = float(nmd)
+            except:
+                logging.fatal("Invalid value for 'notify_max_delay': %s", nmd)
+                sys.exit(1)
+
+
+    def get_config_data_metrics(self):
+        """Where and how often to export metrics."""
+        cp = self.configParser
+        try:
+            mi = cp.get(self.CONSECT, "metrics_interval")
+        except:
+            self.metricsInterval = 60.0
+        else:
+            try:
+                self.metricsInterval = float(mi)
+            except:
+                logging.fatal("Invalid value for 'metrics_interval': %s", mi)
+                sys.exit(1)
+        try:
+            ml = cp.get(self.CONSECT, "metrics_listen")
+        except:
+            self.metricsListen = None
+        else:
+            if ml.startswith("/"):
+                self.metricsListen = ml
+            else:
+                self.metricsListen = self._connection_split(ml,
+                                                            "metrics_listen",
+                                                            False)
 
     def get_config_data_general_escapes(self):
         """Get general information for escapes."""
@@ -300,6 +691,13 @@ class SiteAgent(Agent):
 
     # -- other...
 
+    def _set_resync_time(self, t):
+        self._resyncTime = t
+        self.eventLoop.schedule("heartbeat", t)
+
+    # When the next heartbeat is due.  Setting it schedules the timer.
+    resyncTime = property(lambda self: self._resyncTime, _set_resync_time)
+
     def get_vsites(self, cur):
         """Get all the virtual sites"""
 
@@ -321,6 +719,7 @@ class SiteAgent(Agent):
         self.vSites = vSites
         self.vHandles = vHandles
         self.logger.info("VSites served: %s", str(vSites)[1:-1])
+        self.trace_event("vsites", time.time(), vSites)
 
 
     def enable_bootstrap(self, force=False):
@@ -340,239 +739,837 @@ class SiteAgent(Agent):
             fn = fn + "-" + subkey
         return os.path.join(self.stateDir, fn+".timestamp")
 
+    # -- metrics --
+
+    def get_metrics_filename(self):
+        """The file the metrics are written to, in the state directory."""
+        fn = self.agentKey + "-" + self.sitename + ".prom"
+        return os.path.join(self.stateDir, fn)
+
+    def write_metrics(self, now):
+        """Write out the metrics, and schedule the next time."""
+        try:
+            self.metrics.write_file(self.get_metrics_filename())
+        except (IOError, OSError):
+            self.logger.exception("Unable to write metrics.")
+        self.eventLoop.schedule("metrics", now + self.metricsInterval)
+
+    def get_queued_bytes(self):
+        R = []
+        if self.slaveAgentSet is not None:
+            R.append((("slave",), self.slaveAgentSet.queued_bytes()))
+        if self.masterAgentSet is not None:
+            R.append((("master",), self.masterAgentSet.queued_bytes()))
+        return R
+
     # -- database --
 
     def get_connection(self):
         """Get a database connection, setting some attributes."""
+        isNew = self.conn is None
         conn = Agent.get_connection(self)
-        self.conn_time = time.time()
-        self.conn_reset_time = self.conn_time + self.update_heartbeat
+        if isNew:
+            self.conn_time = time.time()
+            self.resyncTime = self.conn_time + self.update_heartbeat
         self.isolation_level = conn.isolation_level
         return conn
 
 
     def close_connection(self, **kw):
-        """Close a database connection."""
+        """Close a database connection.
+
+        Unless 'reconnectInterval' is given, the next attempt to connect
+        backs off exponentially with repeated failures."""
+        if self.listening:
+            self.eventLoop.unregister(self.conn)
+            self.listening = False
         Agent.close_connection(self, **kw)
+        self.close_worker_connections()
         now = time.time()
-        self.conn_reset_time = now
-        reconnectInterval = kw.get('reconnectInterval',
-                                   self.databaseRetryInterval)
+        reconnectInterval = kw.get('reconnectInterval')
+        if reconnectInterval is None:
+            reconnectInterval = self.next_reconnect_interval()
         self.reconnectDBTime = now + reconnectInterval
+        self.eventLoop.schedule("db-connect", self.reconnectDBTime)
+        self.eventLoop.cancel("heartbeat")
         self.isolation_level = None
 
 
+    def listen_for_notifies(self, cur):
+        """LISTEN for changes, and watch the connection for notifies."""
+        cur.execute("LISTEN hpcman_site")
+        if not self.listening:
+            self.eventLoop.register(self.conn, EVENT_READ,
+                                    self.handle_database_input)
+            self.listening = True
+
+
+    def next_reconnect_interval(self):
+        """Compute the wait before reconnecting, and count the failure.
+
+        The wait doubles with each consecutive failure, up to
+        'database_retry_max_interval', and is jittered so that many
+        agents do not reconnect in step."""
+        n = min(self.dbFailures, 16)
+        self.dbFailures += 1
+        interval = min(self.databaseRetryMaxInterval,
+                       self.databaseRetryInterval * 2**n)
+        return interval * random.uniform(0.5, 1.0)
+
+
+    def get_worker_connection(self):
+        """Get an idle connection for a vsite update worker."""
+        self.workerConnsLock.acquire()
+        try:
+            if self.workerConns:
+                return self.workerConns.pop()
+        finally:
+            self.workerConnsLock.release()
+        return self.open_connection()
+
+
+    def release_worker_connection(self, conn, broken=False):
+        """Return a worker connection for reuse, or drop it if broken."""
+        if broken:
+            self.statements.invalidate(conn)
+            DB_cleanup(conn)
+        else:
+            self.workerConnsLock.acquire()
+            try:
+                self.workerConns.append(conn)
+            finally:
+                self.workerConnsLock.release()
+
+
+    def close_worker_connections(self):
+        """Close the idle worker connections.  Those in use are closed
+        by their workers, if broken, when they are released."""
+        self.workerConnsLock.acquire()
+        try:
+            conns = self.workerConns
+            self.workerConns = []
+        finally:
+            self.workerConnsLock.release()
+        for conn in conns:
+            self.release_worker_connection(conn, broken=True)
+
+
     # -- site and vsites --
     
-    def site_update(self, updateTime=None, endDict=None):
-        """Update all the configured vsites."""
+    def start_site_update(self, updateTime=None, endDict=None, vsNames=None):
+        """Start a site_update, from the event loop.
+
+        With 'background_updates', the update is queued for the update
+        thread, on a connection of its own, and the loop carries on
+        serving slaves and masters meanwhile.  Otherwise it runs here.
+        Either way, a database error closes the connection.
+
+        A pass with no `updateTime` covers the notifications marked so
+        far for its vsites.  Passes requested by masters, with `endDict`,
+        are merged while they wait."""
+        if updateTime is None:
+            if vsNames is None:
+                dirty = self.dirtyVSites.keys()
+            else:
+                dirty = [vsName for vsName in vsNames
+                         if vsName in self.dirtyVSites]
+            for vsName in dirty:
+                del self.dirtyVSites[vsName]
+                self.eventLoop.cancel(("dirty", vsName))
+        if not self.backgroundUpdates:
+            try:
+                self.site_update(updateTime, endDict, vsNames)
+            except DBDatabaseError:
+                self.close_connection()
+                self.logger.warn("Database connection broken; retry in %ds",
+                                 self.reconnectDBTime - time.time())
+            return
+        if updateTime is None and vsNames is None:
+            # One full pass waiting is enough.
+            if self.fullUpdateQueued:
+                return
+            self.fullUpdateQueued = True
+        elif updateTime is None and endDict is not None:
+            # One master pass waiting is enough, to the newest timestamps.
+            self.masterUpdatesLock.acquire()
+            try:
+                self.masterUpdates.update(endDict)
+                if self.masterUpdateQueued:
+                    return
+                self.masterUpdateQueued = True
+            finally:
+                self.masterUpdatesLock.release()
+            self.updater.submit(self._background_master_update, (),
+                                self.finish_site_update)
+            return
+        self.updater.submit(self._background_site_update,
+                            (updateTime, endDict, vsNames),
+                            self.finish_site_update)
+
+
+    def _background_site_update(self, updateTime, endDict, vsNames):
+        """Run site_update on the update thread."""
+        if updateTime is None and vsNames is None:
+            self.fullUpdateQueued = False
+        conn = self.get_worker_connection()
+        try:
+            self.site_update(updateTime, endDict, vsNames, conn=conn)
+        except:
+            # The connection may hold open streams, or be dead: drop it.
+            self.release_worker_connection(conn, broken=True)
+            raise
+        else:
+            self.release_worker_connection(conn)
+
+
+    def _background_master_update(self):
+        """Run the updates requested by masters, on the update thread."""
+        self.masterUpdatesLock.acquire()
+        try:
+            endDict = self.masterUpdates
+            self.masterUpdates = {}
+            self.masterUpdateQueued = False
+        finally:
+            self.masterUpdatesLock.release()
+        self._background_site_update(None, endDict, endDict.keys())
+
+
+    def finish_site_update(self, result, excInfo):
+        """Handle the end of a background update, in the loop's thread.
+
+        A database error there was on the update thread's connection,
+        which has been dropped.  The agent's own connection is closed
+        only if it fails a check too; otherwise the vsites are retried
+        on new worker connections, as they would be on reconnecting."""
+        if excInfo is None:
+            return
+        if issubclass(excInfo[0], DBDatabaseError):
+            self.logger.warn("Database error during update",
+                             exc_info=excInfo)
+            if self.conn is None:
+                return
+            if not self.check_connection():
+                self.close_connection()
+                self.logger.warn("Database connection closed; retry in %ds",
+                                 self.reconnectDBTime - time.time())
+                return
+            retryTime = time.time() + self.databaseRetryInterval
+            for vh in self.vHandles.values():
+                if vh.retryUpdateTime is None:
+                    vh.retryUpdateTime = retryTime
+        else:
+            self.logger.error("Unexpected error during update",
+                              exc_info=excInfo)
+
+
+    def site_update(self, updateTime=None, endDict=None, vsNames=None,
+                    conn=None):
+        """Update all the configured vsites, or those in `vsNames`.
+
+        Updates use `conn`, by default the agent's connection.  With
+        'vsite_update_workers' above one, the vsites are updated in
+        parallel, each on a worker connection."""
         for vh in self.vHandles.values():
             if self.is_bootstrapping:
                 vh.enable_bootstrap()
         self.is_bootstrapping = False
-        cur = self.get_cursor()
+        work = []
+        if vsNames is None:
+            items = self.vHandles.items()
+        else:
+            items = [(vsName, self.vHandles[vsName]) for vsName in vsNames]
+        for vsName, vh in items:
+            if updateTime is None or \
+               ( vh.retryUpdateTime is not None and \
+                 vh.retryUpdateTime <= updateTime ):
+                endTime = None
+                if endDict is not None and endDict.has_key(vsName):
+                    endTime = endDict[vsName]
+                work.append((vsName, vh, endTime))
+        if conn is None:
+            conn = self.get_connection()
+        cur = conn.cursor()
+        if updateTime is None and vsNames is None:
+            self.resyncTime = time.time() + self.update_heartbeat
+
+        # Timestamps set during the pass are written out together.
+        self.stateStore.hold()
         try:
-            for vsName, vh in self.vHandles.items():
-                if updateTime is None or \
-                   ( vh.retryUpdateTime is not None and \
-                     vh.retryUpdateTime <= updateTime ):
+            if self.vsiteUpdateWorkers > 1 and len(work) > 1:
+                cur.close()
+                self.parallel_site_update(work)
+                return
+            try:
+                for vsName, vh, endTime in work:
                     try:
-                        endTime = None
-                        if endDict is not None and endDict.has_key(vsName):
-                            endTime = endDict[vsName]
-                        if self.vsite_ready_escape == None:
-                            vh.vsite_update(cur, endTime)
-                        else:
-                            u = { 'vsite': vsName }
-                            rc = vh.run_escape(self.vsite_ready_escape,
-                                               'vsite_ready', u)
-                            if rc == 0:
-                                vh.vsite_update(cur, endTime)
-                            else:
-                                self.logger.warn('VSite %s is not ready', vsName)
+                        self.update_vsite(cur, vsName, vh, endTime)
                     except UpdateVSiteError:
                         self.logger.exception("Agent VSite update error.")
+            finally:
+                cur.close()
         finally:
-            cur.close()
+            self.stateStore.release()
+
+
+    def update_vsite(self, cur, vsName, vh, endTime):
+        """Update one vsite, if its readiness escape allows."""
+        if self.vsite_ready_escape == None:
+            self.run_vsite_update(cur, vsName, vh, endTime)
+        else:
+            u = { 'vsite': vsName }
+            rc = vh.run_escape(self.vsite_ready_escape,
+                               'vsite_ready', u)
+            if rc == 0:
+                self.run_vsite_update(cur, vsName, vh, endTime)
+            else:
+                self.logger.warn('VSite %s is not ready', vsName)
+
+
+    def run_vsite_update(self, cur, vsName, vh, endTime):
+        """Run vh.vsite_update, recording its time and result."""
+        started = time.time()
+        result = "error"
+        self.trace_event("update", started, vsName, vh.is_bootstrapping,
+                         endTime)
+        try:
+            try:
+                vh.vsite_update(cur, endTime)
+                result = "ok"
+            except DBDatabaseError:
+                result = "database_error"
+                raise
+            except UpdateVSiteError:
+                result = "agent_error"
+                raise
+        finally:
+            now = time.time()
+            if self.trace is not None:
+                self.trace.write(("done", now, vsName, result))
+                self.trace.flush()
+            _vsiteUpdateSeconds.observe(now - started, vsite=vsName)
+            _vsiteUpdates.inc(vsite=vsName, result=result)
+            if result == "ok":
+                _vsiteLastSuccess.set(now, vsite=vsName)
+
+
+    def parallel_site_update(self, work):
+        """Update vsites on the vsite worker pool.
+
+        Each worker updates one vsite at a time on its own connection.
+        Once all are done, their results are reconciled here: retry
+        times are set, and the slaves notified of the vsites updated."""
+        logger = self.logger
+        results = Queue.Queue()
+        logger.debug("Updating %d vsites with %d workers", len(work),
+                     min(self.vsiteUpdateWorkers, len(work)))
+        for vsName, vh, endTime in work:
+            self.vsiteWorkers.submit(self._site_update_worker,
+                                     (vsName, vh, endTime, results))
+
+        # Reconcile results.
+        for i in range(len(work)):
+            vsName, ok, retryTime, notified = results.get()
+            vh = self.vHandles[vsName]
+            vh.retryUpdateTime = retryTime
+            if not ok:
+                logger.info("VSite %s update failed; retry at %s",
+                            vsName, retryTime)
+            for n in notified:
+                self.notify_vsites(n)
+
+
+    def _site_update_worker(self, vsName, vh, endTime, results):
+        """Update one vsite, on a worker thread, and put
+        (vsName, ok, retryTime, notified) on `results`."""
+        logger = self.logger
+        state = self.workerState
+        state.notified = []
+        state.deferRetries = True
+        ok = False
+        retryTime = None
+        conn = cur = None
+        try:
+            try:
+                conn = self.get_worker_connection()
+                cur = conn.cursor()
+                self.update_vsite(cur, vsName, vh, endTime)
+                ok = True
+            except DBDatabaseError:
+                logger.exception("Database error updating VSite %s", vsName)
+                retryTime = time.time() + self.databaseRetryInterval
+                if conn is not None:
+                    self.release_worker_connection(conn, broken=True)
+                conn = cur = None
+            except UpdateVSiteError:
+                logger.exception("Agent VSite update error.")
+            except:
+                logger.exception("Unexpected error updating VSite %s", vsName)
+            if cur is not None:
+                try:
+                    cur.close()
+                except:
+                    pass
+            if conn is not None:
+                self.release_worker_connection(conn)
+            if retryTime is None:
+                retryTime = vh.retryUpdateTime
+        finally:
+            notified = state.notified
+            state.notified = None
+            state.deferRetries = False
+            results.put((vsName, ok, retryTime, notified))
+
+
+    # -- profiling --
+
+    def get_profile_filename(self, vsName=None, ext=".prof"):
+        """Name a profile output file, in the state directory."""
+        fn = self.agentKey + "-" + self.sitename + "-profile"
+        if vsName is not None:
+            fn = fn + "-" + vsName
+        return os.path.join(self.stateDir, fn + ext)
+
+
+    def profile_updates(self, cycles):
+        """Update every vsite `cycles` times under cProfile.
+
+        Each cycle starts from the same timestamps, which are left as
+        they were, so every cycle applies the same change set (the
+        sinks are really updated).  Each vsite's profile, summed over
+        the cycles, is dumped to the state directory, beside a text
+        summary of its top functions."""
+
+        logger = self.logger
+        cur = self.get_cursor()
+        if self.vSites is None:
+            self.get_vsites(cur)
+        bootstrap = self.is_bootstrapping
+        self.is_bootstrapping = False
+
+        profiles = {}
+        times = {}
+        for vsName in self.vSites:
+            profiles[vsName] = cProfile.Profile()
+            times[vsName] = []
+
+        baseStore = self.stateStore
+        self.stateStore = overlay = OverlayStateStore(baseStore)
+        try:
+            for cycle in range(cycles):
+                logger.info("Profiling update cycle %d of %d",
+                            cycle+1, cycles)
+                overlay.reset()
+                for vsName in self.vSites:
+                    vh = self.vHandles[vsName]
+                    if bootstrap:
+                        vh.enable_bootstrap()
+                    started = time.time()
+                    try:
+                        profiles[vsName].runcall(self.update_vsite, cur,
+                                                 vsName, vh, None)
+                    except (DBDatabaseError, UpdateVSiteError):
+                        logger.exception("Update of %s failed while "
+                                         "profiling", vsName)
+                        cur = self.get_connection().cursor()
+                    times[vsName].append(time.time() - started)
+        finally:
+            self.stateStore = baseStore
+
+        summary = open(self.get_profile_filename(ext=".txt"), "w")
+        try:
+            summary.write("Profile of %d update cycles of %s at %s\n" %
+                          (cycles, self.agentKey, time.ctime()))
+            for vsName in self.vSites:
+                fname = self.get_profile_filename(vsName)
+                profiles[vsName].dump_stats(fname)
+                t = times[vsName]
+                summary.write("\n=== vsite %s: %d cycles, "
+                              "mean %.3fs, min %.3fs, max %.3fs (%s)\n" %
+                              (vsName, len(t), sum(t)/len(t), min(t), max(t),
+                               fname))
+                stats = pstats.Stats(profiles[vsName], stream=summary)
+                stats.strip_dirs()
+                stats.sort_stats("cumulative").print_stats(25)
+                stats.sort_stats("time").print_stats(25)
+        finally:
+            summary.close()
+        logger.info("Profile summary written to %s",
+                    self.get_profile_filename(ext=".txt"))
+
+
+    # -- recording and replay --
+
+    def start_recording(self, fname):
+        """Record notifications and change sets to the trace `fname`."""
+        try:
+            self.trace = TraceWriter(fname, {"agent": self.agentKey,
+                                             "site": self.sitename})
+        except IOError, e:
+            self.logger.fatal("Cannot record to %s: %s", fname, e)
+            sys.exit(1)
+        self.logger.info("Recording change streams to %s", fname)
+
+
+    def trace_event(self, *record):
+        """Add a record to the trace, if recording."""
+        if self.trace is not None:
+            self.trace.write(record)
+
+
+    def replay_trace(self, fname, speed):
+        """Replay the vsite updates recorded in the trace `fname`.
+
+        Each update reads the change sets it read when recorded, from a
+        ReplayConnection, so no database is used; the sinks are really
+        updated.  Updates start at the recorded pace, `speed` times as
+        fast, or with no pauses if `speed` is 0.  As when profiling,
+        timestamps are kept in an overlay of the state store, and
+        discarded.  Each update's time is logged against the recorded
+        time, then a summary."""
+
+        logger = self.logger
+        try:
+            reader = TraceReader(fname)
+        except (IOError, ValueError), e:
+            logger.fatal("Cannot replay %s: %s", fname, e)
+            sys.exit(1)
+        logger.info("Replaying %s, recorded by %s for site %s at %s",
+                    fname, reader.header.get("agent"),
+                    reader.header.get("site"),
+                    time.ctime(reader.header["started"]))
+
+        conn = self.conn = ReplayConnection()
+        cur = conn.cursor()
+        def set_vsites(vsNames):
+            if self.vSites is None:
+                conn.vsites = vsNames
+                self.get_vsites(cur)
+
+        baseStore = self.stateStore
+        self.stateStore = OverlayStateStore(baseStore)
+        updates = failures = rows = 0
+        recorded = replayed = 0.0
+        first = None
+        started = time.time()
+        try:
+            for u in read_updates(reader, set_vsites):
+                vh = self.vSites is not None and self.vHandles.get(u.vsName)
+                if not vh:
+                    logger.warn("Skipping update of unknown vsite %s",
+                                u.vsName)
+                    continue
+                if first is None:
+                    first = u.time
+                if speed > 0:
+                    delay = started + (u.time - first)/speed - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+                if u.bootstrapping:
+                    vh.enable_bootstrap()
+                else:
+                    vh.is_bootstrapping = False
+                conn.set_update(u)
+                t = time.time()
+                try:
+                    self.update_vsite(cur, u.vsName, vh, u.end)
+                except (DBDatabaseError, UpdateVSiteError):
+                    logger.exception("Replayed update of %s failed",
+                                     u.vsName)
+                    failures += 1
+                t = time.time() - t
+                logger.info("Replayed update of %s: %d rows in %.3fs "
+                            "(recorded %.3fs, %s), after %d notifications",
+                            u.vsName, u.rows(), t, u.duration, u.result,
+                            len(u.notifies))
+                updates += 1
+                rows += u.rows()
+                recorded += u.duration
+                replayed += t
+        finally:
+            self.stateStore = baseStore
+            reader.close()
+            conn.set_update(None)
+            self.conn = None
+        logger.warn("Replayed %d updates (%d failed) of %d rows in %.3fs; "
+                    "recorded in %.3fs; %.1fs elapsed",
+                    updates, failures, rows, replayed, recorded,
+                    time.time() - started)
+
+
+    # -- diagnostics --
+
+    def run_diagnostic(self, fn):
+        """Run diagnostics between passes of the event loop, which the
+        signal wakes."""
+        loop = getattr(self, "eventLoop", None)
+        if loop is None:
+            Agent.run_diagnostic(self, fn)
+        else:
+            loop.call_soon_threadsafe(fn)
+
+
+    def start_sampler(self):
+        """Start the stack sampler, and stop it on time even if the
+        agent is idle, when no profiling tick would."""
+        Agent.start_sampler(self)
+        if self.sampler.deadline is not None:
+            self.eventLoop.schedule("sampler", self.sampler.deadline)
+
+
+    def stop_sampler(self):
+        self.eventLoop.cancel("sampler")
+        Agent.stop_sampler(self)
 
 
     # -- service interface --
 
     def main_loop(self):
-        """Event loop: Handle connections.  Kick off updates."""
+        """Event loop: Handle connections.  Kick off updates.
+
+        Sockets stay registered with the event loop while open, and
+        everything that must happen later (database reconnection, the
+        heartbeat, vsite retries, settled notifications, connecting to
+        masters) is a timer, so each pass costs time in proportion to
+        what is ready, not to the number of vsites or connections."""
 
         logger = self.logger
+        if self.options.replayFile is not None:
+            self.replay_trace(self.options.replayFile,
+                              self.options.replaySpeed)
+            return
+        if self.options.profileCycles:
+            self.profile_updates(self.options.profileCycles)
+            return
+        if self.options.recordFile is not None:
+            self.start_recording(self.options.recordFile)
         logger.debug("Entering main loop.")
+        loop = self.eventLoop
 
-        while True:
+        # A signal arriving just before the loop waits still wakes it.
+        signal.set_wakeup_fd(loop.wakeup_fd())
 
-            r = []
-            w = []
-            cur = None
+        loop.schedule("db-connect", self.reconnectDBTime)
+        if self.slaveAgentSet is not None:
+            self.slaveAgentSet.start(self)
+        if self.metricsInterval > 0:
+            loop.schedule("metrics", time.time())
+        if self.metricsListen is not None:
+            self.metricsServer = MetricsServer(self.metrics,
+                                               self.metricsListen)
+            self.metricsServer.start(loop)
 
-            # Get the time.  We'll compare to see if we need to
-            # attempt (re)connections.
+        while True:
             now = time.time()
+            timeout = loop.timeout(now, self.maximum_nap_time)
+            logger.debug("Select; timeout = %g", timeout)
+            loop.poll(timeout)
+
+            # Run the timers now due, allowing for a slightly early wake.
+            now = time.time() + 0.01
+            self.run_timers(loop.pop_due(now), now)
+
+            # Updates may have read notifies off the connection, which
+            # then will not show as readable.
+            if self.listening and self.conn.notifies:
+                self.handle_database_input(EVENT_READ)
+
+
+    def run_timers(self, keys, now):
+        """Handle the event loop timers named by `keys`."""
+
+        retries = []
+        dirty = False
+        for key in keys:
+            if key == "db-connect":
+                self.connect_database()
+            elif key == "heartbeat":
+                self.heartbeat(now)
+            elif key == "metrics":
+                self.write_metrics(now)
+            elif key == "sampler":
+                self.stop_sampler()
+            elif key[0] == "master":
+                key[1].work_if_ready(now, self)
+            elif key[0] == "retry":
+                retries.append(key[1])
+            elif key[0] == "dirty":
+                dirty = True
+
+        # Vsite updates need the database; without it, wait for the
+        # next attempt to reconnect.
+        if self.conn is None:
+            for vsName in retries:
+                vh = self.vHandles[vsName]
+                if vh.retryUpdateTime is not None:
+                    self.eventLoop.schedule(("retry", vsName),
+                                            max(vh.retryUpdateTime,
+                                                self.reconnectDBTime))
+            return
+        if dirty:
+            self.update_dirty_vsites(now)
+        if retries:
+            self.start_site_update(now, vsNames=retries)
+
+
+    def connect_database(self):
+        """Connect to the database, and bring the vsites up to date.
+
+        The first connection also learns the vsites served, and so
+        allows connecting to masters."""
 
-            # If it is time for a heartbeat, close the connection.  This
-            # will force the restart and update.
-            if self.conn is not None and \
-                   self.conn_reset_time <= now+0.5:
-                logger.debug("Time to reset database connection.")
-                self.close_connection(reconnectInterval=0)
-
-            # Check for the database connection.  If not present, see
-            # if it is time to create it.  If we do create it, then
-            # make sure we have the list of vsites we serve.  Finally,
-            # see if we can perform updates.
-            if self.conn is None and self.reconnectDBTime <= now+0.5:
-                try:
-                    cur = self.get_cursor()
-                    if self.vSites is None:
-                        self.get_vsites(cur)
-                    if  self.masterAgentSet is None:
-                        assert self.vSites is not None
-                        self.site_update()
-                except DBDatabaseError:
-                    # Database connection broken.  Wait.
-                    self.close_connection(cur=cur)
-                    cur = None
-                    logger.exception("Database connection broken; retry in %ds",
-                                     self.databaseRetryInterval)
-                except UpdateVSiteError:
-                    logger.exception("Agent VSite update error.")
-                    pass
+        logger = self.logger
+        if self.conn is not None:
+            return
+        cur = None
+        try:
+            cur = self.get_cursor()
+            if self.vSites is None:
+                self.get_vsites(cur)
+                if self.masterAgentSet is not None:
+                    self.masterAgentSet.schedule(self)
+            if self.masterAgentSet is None:
+                self.listen_for_notifies(cur)
+            cur.close()
+        except DBDatabaseError:
+            # Database connection broken.  Wait.
+            self.close_connection(cur=cur)
+            logger.exception("Database connection broken; retry in %ds",
+                             self.reconnectDBTime - time.time())
+            return
+        self.dbFailures = 0
+        if self.masterAgentSet is None:
+            self.start_site_update()
 
-            # See if any vSites are scheduled to be updated now.
-            if self.conn is not None and self.vSites is not None:
-                try:
-                    self.site_update(now)
-                except DBDatabaseError:
-                    self.close_connection(cur=cur)
-                    cur = None
-                    logger.warn("Database connection broken; retry in %ds",
-                                self.databaseRetryInterval)
-
-            # Watch the database connection.  If there is no master,
-            # then listen for events from the database (if connection
-            # is present).
-            if self.conn is not None and self.masterAgentSet is None:
-                assert self.vSites is not None
-                try:
-                    self.conn.set_isolation_level(0)
-                    cur = self.conn.cursor()
-                    assert self.masterAgentSet is None
-                    cur.execute("LISTEN hpcman_site")
-                except:
-                    # Connection dropped.
-                    self.close_connection(cur=cur)
-                    cur = None
-                    logger.warn("Database connection broken; retry in %ds",
-                                self.databaseRetryInterval)
-                else:
-                    if hasattr(cur, 'fileno'):
-                        r.append(cur)
-                    else:
-                        r.append(self.conn)
-		    #print 'Append: ', self.conn.fileno(), self.conn
-
-            # If there should be a master, see if the connection is
-            # present.  If not, check if it is time to connect.  If we
-            # succeed, then send the site name and a list of vSites;
-            # it is OK to block.  Switch to non-blocking for future
-            # reads.
-            if self.masterAgentSet is not None and \
-               self.vSites is not None:
-                self.masterAgentSet.work_if_ready(now, self)
-                self.masterAgentSet.prepare_select(r, w)
-
-            # Prepare for listening to connections to slaves, now that
-            # any notifies have been queued up.
-            if self.slaveAgentSet is not None:
-                self.slaveAgentSet.prepare_select(r,w)
-
-            # Compute timeout.  We have a maximum wait.
-            timeCheck = now + self.maximum_nap_time
-            logger.debug("timeout: now: %d", now)
-            logger.debug("timeout: nap time ends: %d", timeCheck)
-            if self.conn is None:
-                timeCheck = min(timeCheck, self.reconnectDBTime)
-                logger.debug("timeout: db reconnect: %d", timeCheck)
-            if self.conn is not None:
-                timeCheck = min(timeCheck, self.conn_reset_time)
-                logger.debug("timeout: db reset: %d", timeCheck)
-            if self.masterAgentSet is not None and \
-               self.vSites is not None:
-                timeCheck = self.masterAgentSet.compute_wake_time(timeCheck)
-                logger.debug("timeout: master reconnect: %d", timeCheck)
-            if self.vSites is not None:
-                for vh in self.vHandles.values():
-                    if vh.retryUpdateTime is not None:
-                        timeCheck = min(timeCheck, vh.retryUpdateTime)
-            if timeCheck < now:
-                timeout = 0.0
+
+    def heartbeat(self, now):
+        """Make sure the connection is alive; keep it if so.
+
+        Without a master, also resynchronize every vsite, in case a
+        notification went missing."""
+
+        logger = self.logger
+        if self.conn is None:
+            return
+        self.resyncTime = now + self.update_heartbeat
+        if not self.check_connection():
+            self.close_connection()
+            logger.warn("Database connection failed check; retry in %ds",
+                        self.reconnectDBTime - now)
+        elif self.masterAgentSet is None and self.vSites is not None:
+            logger.debug("Time to resynchronize vsites.")
+            self.start_site_update()
+
+
+    def handle_database_input(self, events):
+        """Take notifies from the database connection."""
+
+        logger = self.logger
+        try:
+            self.conn.poll()
+            notifies = self.conn.notifies[:]
+            del self.conn.notifies[:]
+        except DBDatabaseError:
+            # Apparently the connection died.
+            self.close_connection()
+            logger.info("Database connection died; restart at %d",
+                        self.reconnectDBTime)
+            return
+        self.handle_notifies(notifies)
+
+
+    def schedule_vsite_retry(self, vsName, t):
+        """Schedule (or, if `t` is None, cancel) a vsite update retry.
+        A vsite worker leaves this to parallel_site_update."""
+        if getattr(self.workerState, "deferRetries", False):
+            return
+        if t is None:
+            self.eventLoop.cancel(("retry", vsName))
+        else:
+            self.eventLoop.schedule(("retry", vsName), t)
+
+
+    def handle_notifies(self, notifies):
+        """Mark the vsites named by notifications from the database.
+
+        The payload of an 'hpcman_site' notification names a vsite,
+        optionally followed by ':' and the class of change ("user",
+        "group", "password", ...).  A notification with no payload
+        marks every vsite.  Vsites this agent does not serve are
+        ignored; the periodic resynchronization catches up anything
+        missed.  Marked vsites are updated by update_dirty_vsites."""
+
+        logger = self.logger
+        now = time.time()
+        for n in notifies:
+            if n[1] != "hpcman_site":
+                continue
+            self.notifiesReceived += 1
+            _notifiesReceived.inc()
+            payload = getattr(n, "payload", "")
+            if not payload:
+                logger.debug("Notified by DB of updates.")
+                vsNames = self.vSites
             else:
-                timeout = float(timeCheck - now)
-
-            # Select.
-            logger.debug("Select; timeout = %g, readers=%s, writers=%s",
-                         timeout, repr(r), repr(w))
-	    #print r,w,timeout
-            r,w,x = select.select(r,w,[],timeout)
-
-            # If we waited on a connection, restore isolation level.
-            if self.isolation_level is not None:
-                self.conn.set_isolation_level(self.isolation_level)
-
-            # Handle slave connections.
-            if self.slaveAgentSet is not None:
-                self.slaveAgentSet.read_if_ready(r, self)
-                self.slaveAgentSet.write_if_ready(w, self)
-
-            # Handle timestamps from master.
-            if self.masterAgentSet is not None:
-                self.masterAgentSet.read_if_ready(r, self)
-                self.masterAgentSet.write_if_ready(w, self)
-
-            # Handle notifies from the database.
-            if cur is not None and cur in r:
-                try:
-                    isReadyFlag = cur.isready()
-                except DBDatabaseError:
-                    # Apparently the connection died.
-                    self.close_connection(cur=cur)
-                    cur = None
-                    logger.info("Database connection died; restart at %d",
-                                self.reconnectDBTime)
+                vsName, sep, changeClass = payload.partition(":")
+                vsName = vsName.strip()
+                if vsName not in self.vHandles:
+                    logger.debug("Ignoring notification for vsite '%s'",
+                                 vsName)
+                    continue
+                logger.debug("Notified by DB of %s updates to vsite %s",
+                             changeClass.strip() or "all", vsName)
+                vsNames = [vsName]
+            for vsName in vsNames:
+                self.trace_event("notify", now, vsName, payload)
+            coalesced = True
+            for vsName in vsNames:
+                times = self.dirtyVSites.get(vsName)
+                if times is None:
+                    times = self.dirtyVSites[vsName] = [now, now]
+                    coalesced = False
                 else:
-                    try:
-                        if isReadyFlag:
-                            for n in self.conn.notifies:
-                                if n[1] == "hpcman_site":
-                                    logger.debug("Notified by DB of updates.")
-                                    self.site_update()
-                        else:
-                            self.close_connection(cur=cur)
-                            cur = None
-                            #FIXME: message
-                    except DBDatabaseError:
-                        # Connection died.
-                        self.close_connection(cur=cur)
-                        cur = None
-                        logger.exception("Database connection died; restart at %d",
-                                         self.reconnectDBTime)
-
-            # FIXME:
-#            try:
-#                for x in []: pass
-#            except DBDatabaseError:
-#                logger.exception("Weird exception encountered.")
+                    times[1] = now
+                self.eventLoop.schedule(("dirty", vsName),
+                                        self.dirty_vsite_due_time(times))
+            if coalesced:
+                self.notifiesCoalesced += 1
+                _notifiesCoalesced.inc()
+
+
+    def dirty_vsite_due_time(self, times):
+        """When a vsite marked at times [first, last] should be updated."""
+        return min(times[1] + self.notifyDebounce,
+                   times[0] + self.notifyMaxDelay)
+
+
+    def update_dirty_vsites(self, now):
+        """Update the marked vsites whose notifications have settled."""
+
+        due = [vsName for vsName, times in self.dirtyVSites.items()
+               if self.dirty_vsite_due_time(times) <= now+0.01]
+        if not due:
+            return
+        self.logger.debug("Updating %d notified vsites "
+                          "(%d notifications, %d coalesced so far)",
+                          len(due), self.notifiesReceived,
+                          self.notifiesCoalesced)
+        if len(due) == len(self.vHandles):
+            self.start_site_update()
+        else:
+            self.start_site_update(vsNames=due)
 
 
     def notify_vsites(self, vsName):
         """Notify all slave vsites that a vsite was updated."""
 
-        if self.slaveAgentSet is not None:
+        notified = getattr(self.workerState, "notified", None)
+        if notified is not None:
+            # Called from a vsite worker; returned with its result.
+            notified.append(vsName)
+        elif not self.eventLoop.is_loop_thread():
+            # Called from the update thread; slaves are served by the loop.
+            self.eventLoop.call_soon_threadsafe(self.notify_vsites, vsName)
+        elif self.slaveAgentSet is not None:
             #ts = self.vHandles[vsName].get_timestamp()
             self.slaveAgentSet.notify_vsite(vsName, self)
 
@@ -20,7 +20,8 @@ __all__ = [
 
 class VSiteAuthAgent(VSiteAgent):
 
-    def start_get_user_information(self, cur, start=None, end=None):
+    def start_get_user_information(self, cur, start=None, end=None,
+                                   resume=None):
 
         q = """SELECT uid,UserName,
                       gid,groupName,
@@ -38,13 +39,19 @@ class VSiteAuthAgent(VSiteAgent):
             q += "      AND modified > %(start)s"
         if end is not None:
             q += "      AND modified <= %(end)s"
-        q += " ORDER BY modified"
-        cur.execute(q,
-                    {"siteName": self.aHandle.sitename,
-                     "vsName": self.vsName,
-                     "passwordType": self.aHandle.passwordType,
-                     "start": start,
-                     "end": end})
+        if resume is not None:
+            q += "      AND (modified, uid) >= (%(resumeModified)s, %(resumeKey)s)"
+        q += " ORDER BY modified, uid"
+        shape = ("auth.users", start is not None, end is not None,
+                 resume is not None)
+        self.aHandle.statements.execute(cur, shape, q,
+                                        {"siteName": self.aHandle.sitename,
+                                         "vsName": self.vsName,
+                                         "passwordType": self.aHandle.passwordType,
+                                         "start": start,
+                                         "end": end,
+                                         "resumeModified": resume and resume[0],
+                                         "resumeKey": resume and resume[1]})
 
     def start_get_group_information(self, cur, start=None, end=None):
 
@@ -56,12 +63,51 @@ class VSiteAuthAgent(VSiteAgent):
             q += """      AND modified > %(start)s"""
         if end is not None:
             q += """      AND modified <= %(end)s"""
-        q += " ORDER BY modified"
-        cur.execute(q,
-                    {"siteName": self.aHandle.sitename,
-                     "vsName": self.vsName,
-                     "start": start,
-                     "end": end})
+        q += " ORDER BY modified, gid"
+        shape = ("auth.groups", start is not None, end is not None)
+        self.aHandle.statements.execute(cur, shape, q,
+                                        {"siteName": self.aHandle.sitename,
+                                         "vsName": self.vsName,
+                                         "start": start,
+                                         "end": end})
+
+    def start_get_group_membership(self, cur, start=None, end=None,
+                                   resume=None):
+        """Query changed groups, each with the list of its members.
+
+        The rows are those of start_get_group_information, with the
+        member user names (as from get_group_members) appended."""
+
+        memberCond = ""
+        groupCond = ""
+        if start is not None:
+            memberCond += "      AND m.modified > %(start)s"
+            groupCond += "      AND g.modified > %(start)s"
+        if end is not None:
+            memberCond += "      AND m.modified <= %(end)s"
+            groupCond += "      AND g.modified <= %(end)s"
+        q = """SELECT g.gid,g.groupName,g.groupState,g.modified,
+                      ARRAY(SELECT m.userName
+                            FROM vs_group_members m
+                            WHERE m.siteName=g.siteName
+                                  AND m.vsName=g.vsName
+                                  AND m.groupName=g.groupName""" + \
+            memberCond + """) AS members
+               FROM vs_groups g
+               WHERE g.siteName=%(siteName)s
+                     AND g.vsName=%(vsName)s""" + groupCond
+        if resume is not None:
+            q += "      AND (g.modified, g.gid) >= (%(resumeModified)s, %(resumeKey)s)"
+        q += " ORDER BY g.modified, g.gid"
+        shape = ("auth.membership", start is not None, end is not None,
+                 resume is not None)
+        self.aHandle.statements.execute(cur, shape, q,
+                                        {"siteName": self.aHandle.sitename,
+                                         "vsName": self.vsName,
+                                         "start": start,
+                                         "end": end,
+                                         "resumeModified": resume and resume[0],
+                                         "resumeKey": resume and resume[1]})
 
     # FIXME: Deprecated.
     def get_user_information(self, cur, start=None, end=None):
@@ -97,12 +143,13 @@ class VSiteAuthAgent(VSiteAgent):
         if end is not None:
             q += """      AND modified <= %(end)s"""
         try:
-            cur.execute(q, 
-                        {"siteName": self.aHandle.sitename,
-                         "vsName": self.vsName,
-                         "groupName": groupName,
-                         "start": start,
-                         "end": end})
+            shape = ("auth.members", start is not None, end is not None)
+            self.aHandle.statements.execute(cur, shape, q,
+                                            {"siteName": self.aHandle.sitename,
+                                             "vsName": self.vsName,
+                                             "groupName": groupName,
+                                             "start": start,
+                                             "end": end})
             return cur.fetchall()
         except DBDatabaseError:
             logger = self.aHandle.logger
@@ -15,14 +15,16 @@ __all__ = [
 
 class VSiteFSAgent(VSiteAgent):
 
-    def start_get_user_information(self, cur, start=None, end=None):
+    def start_get_user_information(self, cur, start=None, end=None,
+                                   resume=None):
 
         q = """SELECT uid,UserName,
                       gid,groupName,
                       homeDirectory,quota,
                       userAccountState,
                       projid,projName,projGroupName,
-                      lastActive,created
+                      lastActive,created,
+                      modified
                FROM vs_user_accounts
                WHERE siteName=%(siteName)s
                      AND vsName=%(vsName)s"""
@@ -30,13 +32,19 @@ class VSiteFSAgent(VSiteAgent):
             q += "      AND modified > %(start)s"
         if end is not None:
             q += "      AND modified <= %(end)s"
-        q += " ORDER BY modified"
-        cur.execute(q,
-                    {"siteName": self.aHandle.sitename,
-                     "vsName": self.vsName,
-                     # "passwordType": self.aHandle.passwordType,
-                     "start": start,
-                     "end": end})
+        if resume is not None:
+            q += "      AND (modified, uid) >= (%(resumeModified)s, %(resumeKey)s)"
+        q += " ORDER BY modified, uid"
+        shape = ("fs.users", start is not None, end is not None,
+                 resume is not None)
+        self.aHandle.statements.execute(cur, shape, q,
+                                        {"siteName": self.aHandle.sitename,
+                                         "vsName": self.vsName,
+                                         # "passwordType": self.aHandle.passwordType,
+                                         "start": start,
+                                         "end": end,
+                                         "resumeModified": resume and resume[0],
+                                         "resumeKey": resume and resume[1]})
 
 class SiteFSAgent(SiteAgent):
     pass
@@ -22,7 +22,8 @@ __all__ = [
 
 class VSiteProxyAgent(VSiteAgent):
 
-    def start_get_user_information(self, cur, start=None, end=None):
+    def start_get_user_information(self, cur, start=None, end=None,
+                                   resume=None):
 
         q = """SELECT uid,UserName,
                       gid,groupName,
@@ -41,13 +42,19 @@ class VSiteProxyAgent(VSiteAgent):
             q += "      AND modified > %(start)s"
         if end is not None:
             q += "      AND modified <= %(end)s"
-        q += " ORDER BY modified"
-        cur.execute(q,
-                    {"siteName": self.aHandle.sitename,
-                     "vsName": self.vsName,
-                     "passwordType": self.aHandle.passwordType,
-                     "start": start,
-                     "end": end})
+        if resume is not None:
+            q += "      AND (modified, uid) >= (%(resumeModified)s, %(resumeKey)s)"
+        q += " ORDER BY modified, uid"
+        shape = ("proxy.users", start is not None, end is not None,
+                 resume is not None)
+        self.aHandle.statements.execute(cur, shape, q,
+                                        {"siteName": self.aHandle.sitename,
+                                         "vsName": self.vsName,
+                                         "passwordType": self.aHandle.passwordType,
+                                         "start": start,
+                                         "end": end,
+                                         "resumeModified": resume and resume[0],
+                                         "resumeKey": resume and resume[1]})
 
     def start_get_group_information(self, cur, start=None, end=None):
 
@@ -59,12 +66,13 @@ class VSiteProxyAgent(VSiteAgent):
             q += """      AND modified > %(start)s"""
         if end is not None:
             q += """      AND modified <= %(end)s"""
-        q += " ORDER BY modified"
-        cur.execute(q,
-                    {"siteName": self.aHandle.sitename,
-                     "vsName": self.vsName,
-                     "start": start,
-                     "end": end})
+        q += " ORDER BY modified, gid"
+        shape = ("proxy.groups", start is not None, end is not None)
+        self.aHandle.statements.execute(cur, shape, q,
+                                        {"siteName": self.aHandle.sitename,
+                                         "vsName": self.vsName,
+                                         "start": start,
+                                         "end": end})
 
 
 
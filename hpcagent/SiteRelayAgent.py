@@ -0,0 +1,108 @@
+"""Site agents that relay notifications from a master to their slaves."""
+
+import logging, sys
+
+from SiteAgent import *
+from Metrics import registry
+
+__all__ = [
+    "VSiteRelayAgent", "SiteRelayAgent",
+    # From SiteAgent
+    "VSiteError", "UpdateVSiteError",
+    "SlaveError", "SlaveSiteError",
+    "SlaveConnectionError", "SlaveProtocolError",
+    "VSiteAgent", "SiteAgent",
+    # From Agent
+    "Agent", "AgentError", "AgentDatabaseError"
+    ]
+
+_notifiesRelayed = registry.counter(
+    "hpcagent_relay_notifies_total",
+    "New timestamps from the master passed on to slaves, by vsite.",
+    ("vsite",))
+
+
+class VSiteRelayAgent(VSiteAgent):
+    """A relayed vsite: only its timestamp, as the master last sent it."""
+
+    def relay(self, ts):
+        """Keep a timestamp from the master, and pass it on to the slaves
+        if it is new.  Returns whether it was."""
+        aHandle = self.aHandle
+        if aHandle.has_timestamp(self.vsName) and \
+           aHandle.get_timestamp(self.vsName) == ts:
+            return False
+        self.set_timestamp(None, ts)
+        aHandle.notify_vsites(self.vsName)
+        return True
+
+
+class SiteRelayAgent(SiteAgent):
+    """Relay notifications down a tree of agents, with no database.
+
+    A relay is a slave of its 'master_agent', and a master to the
+    slaves connecting to its 'slave_listener_port'.  It serves the
+    vsites listed by 'vsites', keeps the latest timestamp of each from
+    the master in its state store, and passes each new one on to the
+    slaves following that vsite.  A slave connecting is sent the
+    timestamps kept, even while the master is unreachable.  Relays can
+    be slaves of relays, so that no one agent serves more than a
+    bounded number of slaves."""
+
+    def __init__(self, agentKey, VSiteFactory=VSiteRelayAgent):
+        SiteAgent.__init__(self, agentKey, VSiteFactory)
+        if self.options.profileCycles or self.options.replayFile:
+            self.parser.error("a relay has no updates to profile or replay")
+
+        # The vsites are known from the start, to welcome slaves and to
+        # connect to the master.
+        self.vSites = self.relayVSites
+        self.vHandles = {}
+        for vsName in self.vSites:
+            self.vHandles[vsName] = self.VSiteFactory(self, vsName)
+        self.logger.info("VSites relayed: %s", str(self.vSites)[1:-1])
+
+    # -- get configuration data --
+
+    def get_config_data(self):
+        """Get configuration information."""
+        SiteAgent.get_config_data(self)
+        self.get_config_data_relay()
+
+    def get_config_data_relay(self):
+        """The vsites relayed, and the master and slaves to relay between."""
+        cp = self.configParser
+        try:
+            vs = cp.get(self.CONSECT, "vsites")
+        except:
+            logging.fatal("Missing vsites")
+            sys.exit(1)
+        self.relayVSites = [v.strip() for v in vs.split(",") if v.strip()]
+        if not self.relayVSites:
+            logging.fatal("Invalid value for 'vsites': %s", vs)
+            sys.exit(1)
+        if self.masterAgentSet is None:
+            logging.fatal("Missing master_agent")
+            sys.exit(1)
+        if self.slaveListenerPort is None:
+            logging.fatal("Missing slave_listener_port")
+            sys.exit(1)
+
+    # -- relaying --
+
+    def connect_database(self):
+        """A relay has no database: start connecting to the master."""
+        self.masterAgentSet.schedule(self)
+
+    def start_site_update(self, updateTime=None, endDict=None, vsNames=None):
+        """Pass the timestamps in `endDict`, from the master, on to the
+        slaves.  This runs in the loop's thread; there is nothing to
+        update."""
+        if endDict is None:
+            return
+        for vsName, ts in endDict.items():
+            vh = self.vHandles.get(vsName)
+            if vh is not None and vh.relay(ts):
+                _notifiesRelayed.inc(vsite=vsName)
+                self.logger.debug("Relayed timestamp %s of vsite %s",
+                                  ts, vsName)
@@ -0,0 +1,331 @@
+"""Traces of change streams, recorded from updates and replayed later.
+
+A trace is a gzipped sequence of pickled records:
+
+  ("header", {"version": 1, "agent": ..., "site": ..., "started": t})
+  ("vsites", t, [vsName, ...])
+  ("notify", t, vsName, payload)
+  ("update", t, vsName, bootstrapping, end)
+  ("query", t, vsName, stream)
+  ("columns", stream, (column, ...))
+  ("rows", stream, [row, ...])
+  ("done", t, vsName, result)
+
+Each change set read through VSiteAgent.open_stream() is a stream,
+numbered in the order its query was run; the rows follow, in batches,
+as the agent read them.  Replaying serves the recorded streams of each
+update, in order, from a ReplayConnection, so no database is needed."""
+
+import collections
+import cPickle
+import datetime
+import gzip
+import itertools
+import threading
+import time
+
+__all__ = [
+    "TraceWriter", "TraceReader", "RecordingCursor",
+    "ReplayConnection", "ReplayUpdate", "read_updates", "TRACE_VERSION"
+    ]
+
+TRACE_VERSION = 1
+
+# Rows written per record.
+_ROWS_PER_RECORD = 1000
+
+
+class TraceWriter(object):
+    """Append records to a trace file.  Safe to use from several threads."""
+
+    def __init__(self, fname, header):
+        self.fname = fname
+        self._f = gzip.open(fname, "wb")
+        self._lock = threading.Lock()
+        self._streams = itertools.count(1)
+        h = {"version": TRACE_VERSION, "started": time.time()}
+        h.update(header)
+        self.write(("header", h))
+
+    def new_stream(self):
+        return next(self._streams)
+
+    def write(self, record):
+        self._lock.acquire()
+        try:
+            cPickle.dump(record, self._f, 2)
+        finally:
+            self._lock.release()
+
+    def flush(self):
+        self._lock.acquire()
+        try:
+            self._f.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            self._f.close()
+        finally:
+            self._lock.release()
+
+
+class TraceReader(object):
+    """Iterate over the records of a trace file.
+
+    A trace cut short (e.g. by the agent being killed) ends at its last
+    complete record."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._f = gzip.open(fname, "rb")
+        self.header = self.next()
+        if self.header is None or self.header[0] != "header":
+            raise ValueError("%s is not a trace" % fname)
+        self.header = self.header[1]
+        if self.header.get("version") != TRACE_VERSION:
+            raise ValueError("%s has unknown trace version %s" %
+                             (fname, self.header.get("version")))
+
+    def next(self):
+        try:
+            return cPickle.load(self._f)
+        except (EOFError, IOError, ValueError, cPickle.UnpicklingError):
+            return None
+
+    def __iter__(self):
+        while True:
+            r = self.next()
+            if r is None:
+                return
+            yield r
+
+    def close(self):
+        self._f.close()
+
+
+class RecordingCursor(object):
+    """Record the rows read through a cursor, as a stream of a trace."""
+
+    def __init__(self, cur, trace, vsName):
+        self._cur = cur
+        self._trace = trace
+        self._vsName = vsName
+        self._stream = None
+        self._columns = False
+        self._rows = []
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def execute(self, q, params=None):
+        self._flush()
+        self._cur.execute(q, params)
+        # The PREPARE of a prepared statement returns nothing.
+        if q.lstrip()[:7].upper() != "PREPARE":
+            self._stream = self._trace.new_stream()
+            self._columns = False
+            self._trace.write(("query", time.time(), self._vsName,
+                               self._stream))
+
+    def _record(self, rows):
+        if self._stream is not None and rows:
+            # A server-side cursor has no description until fetched from.
+            if not self._columns:
+                self._trace.write(("columns", self._stream,
+                                   tuple([d[0] for d in self._cur.description])))
+                self._columns = True
+            self._rows.extend(rows)
+            if len(self._rows) >= _ROWS_PER_RECORD:
+                self._flush()
+        return rows
+
+    def _flush(self):
+        if self._rows:
+            self._trace.write(("rows", self._stream, self._rows))
+            self._rows = []
+
+    def fetchone(self):
+        r = self._cur.fetchone()
+        if r is not None:
+            self._record([r])
+        return r
+
+    def fetchmany(self, size=None):
+        if size is None:
+            return self._record(self._cur.fetchmany())
+        return self._record(self._cur.fetchmany(size))
+
+    def fetchall(self):
+        return self._record(self._cur.fetchall())
+
+    def __iter__(self):
+        while True:
+            r = self.fetchone()
+            if r is None:
+                return
+            yield r
+
+    def close(self):
+        self._flush()
+        self._stream = None
+        self._cur.close()
+
+
+class ReplayUpdate(object):
+    """One recorded vsite update: its streams, in the order opened."""
+
+    def __init__(self, t, vsName, bootstrapping, end):
+        self.time = t
+        self.vsName = vsName
+        self.bootstrapping = bootstrapping
+        self.end = end
+        self.streams = []       # [[columns, rows]]
+        self.notifies = []      # times of notifications since the last
+        self.duration = None
+        self.result = None
+
+    def rows(self):
+        return sum([len(s[1]) for s in self.streams])
+
+
+def read_updates(reader, vsitesFn=None):
+    """Yield the ReplayUpdates of a trace, as each is complete.
+
+    `vsitesFn(vsNames)` is called for each "vsites" record.  Each
+    update carries the times of the notifications for its vsite since
+    the previous one."""
+    current = {}            # vsName -> ReplayUpdate
+    streams = {}            # stream -> [columns, rows]
+    owned = collections.defaultdict(list)   # vsName -> [stream]
+    notifies = collections.defaultdict(list)
+    for r in reader:
+        kind = r[0]
+        if kind == "rows":
+            s = streams.get(r[1])
+            if s is not None:
+                s[1].extend(r[2])
+        elif kind == "columns":
+            s = streams.get(r[1])
+            if s is not None:
+                s[0] = r[2]
+        elif kind == "query":
+            u = current.get(r[2])
+            if u is not None:
+                s = streams[r[3]] = [(), []]
+                u.streams.append(s)
+                owned[r[2]].append(r[3])
+        elif kind == "update":
+            u = current[r[2]] = ReplayUpdate(r[1], r[2], r[3], r[4])
+            u.notifies = notifies.pop(r[2], [])
+        elif kind == "done":
+            u = current.pop(r[2], None)
+            if u is not None:
+                u.duration = r[1] - u.time
+                u.result = r[3]
+                for n in owned.pop(r[2], ()):
+                    streams.pop(n, None)
+                yield u
+        elif kind == "notify":
+            notifies[r[2]].append(r[1])
+        elif kind == "vsites" and vsitesFn is not None:
+            vsitesFn(r[2])
+
+
+class ReplayCursor(object):
+    """A cursor serving recorded streams."""
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+        self.description = None
+        self.itersize = 2000
+        self._rows = iter(())
+
+    def _set(self, columns, rows):
+        self.description = tuple([(c, None, None, None, None, None, None)
+                                  for c in columns]) or None
+        self._rows = iter(rows)
+
+    def execute(self, q, params=None):
+        words = q.split(None, 2)
+        word = words[0].upper()
+        if word in ("PREPARE", "LISTEN", "UNLISTEN", "DEALLOCATE"):
+            self._set((), ())
+        elif word == "SELECT" and words[1].lower().startswith("now()"):
+            self._set(("now",), [(datetime.datetime.now(),)])
+        elif word == "SELECT" and words[1] == "1":
+            self._set(("?column?",), [(1,)])
+        elif "virtual_sites_allowed" in q:
+            self._set(("vsname",), [(vs,) for vs in self.connection.vsites])
+        else:
+            columns, rows = self.connection.next_stream()
+            self._set(columns, rows)
+
+    def fetchone(self):
+        try:
+            return self._rows.next()
+        except StopIteration:
+            return None
+
+    def fetchmany(self, size=None):
+        return list(itertools.islice(self._rows, size or self.itersize))
+
+    def fetchall(self):
+        return list(self._rows)
+
+    def __iter__(self):
+        return self._rows
+
+    def close(self):
+        self._rows = iter(())
+
+
+class ReplayConnection(object):
+    """A stand-in for a database connection, serving recorded streams.
+
+    Set `update` to the ReplayUpdate being replayed; each query for a
+    change set then gets its next stream.  A query beyond the recorded
+    streams gets no rows."""
+
+    def __init__(self):
+        self.vsites = []
+        self.update = None
+        self.notifies = []
+        self.isolation_level = 0
+        self.closed = 0
+        self._next = 0
+        self.rowsServed = 0
+
+    def set_update(self, update):
+        self.update = update
+        self._next = 0
+
+    def next_stream(self):
+        u = self.update
+        if u is None or self._next >= len(u.streams):
+            return ((), [])
+        columns, rows = u.streams[self._next]
+        self._next += 1
+        self.rowsServed += len(rows)
+        return columns, rows
+
+    def cursor(self, name=None, withhold=False):
+        return ReplayCursor(self, name)
+
+    def set_isolation_level(self, level):
+        self.isolation_level = level
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def poll(self):
+        pass
+
+    def close(self):
+        self.closed = 1
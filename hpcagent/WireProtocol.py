@@ -0,0 +1,215 @@
+"""The messages between masters and slaves, and how they are framed.
+
+A slave sends a welcome, (sitename, [vsName, ...]); its master then
+sends notifications, (vsName, timestamp).  The fields are XDR encoded.
+
+In the "framed" protocol the slave first sends FRAME_MAGIC, and each
+message is preceded by the length of its body, as an XDR unsigned
+integer, so that a message is known to be complete before it is
+decoded, and one that does not decode to exactly its length is a
+protocol error.  The "xdr" protocol, spoken by older agents, sends the
+bodies alone; a message is then complete when it decodes, and only
+impossible lengths, or more than MAX_MESSAGE bytes failing to decode,
+show a protocol error.  A master learns which protocol a slave speaks
+from the first bytes it sends.  A master that only speaks "xdr" would
+take FRAME_MAGIC for the start of a welcome, and wait for it forever,
+so slaves speak "xdr" unless told their masters understand "framed".
+
+Input is received into a ReceiveBuffer, and decoded from it in place."""
+
+import struct
+import xdrlib
+
+__all__ = [
+    "ProtocolError", "ReceiveBuffer", "MessageReader",
+    "WIRE_PROTOCOLS", "FRAME_MAGIC", "MAX_MESSAGE",
+    "preamble", "frame",
+    "pack_welcome", "unpack_welcome", "pack_notify", "unpack_notify",
+    ]
+
+# Protocols, as named by the 'master_protocol' option.
+WIRE_PROTOCOLS = ("framed", "xdr")
+
+# Opens a framed stream.  Read as the length of an XDR string, as the
+# sitename of an "xdr" welcome, it would be over a gigabyte.
+FRAME_MAGIC = "HPC\x01"
+
+# The largest message accepted.
+MAX_MESSAGE = 1 << 20
+
+_uint = struct.Struct(">I")
+
+
+class ProtocolError(Exception):
+    """A peer sent something that is not a message."""
+
+
+class _Short(Exception):
+    """The data ends within a message."""
+
+
+class ReceiveBuffer(object):
+    """Bytes received and not yet decoded, in a bytearray.
+
+    recv_from() receives straight into the free space at the end; the
+    space of decoded messages is reused once the free space runs
+    short, and the buffer doubles when that is not enough."""
+
+    def __init__(self, size=8192):
+        self._buf = bytearray(size)
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def clear(self):
+        self._start = self._end = 0
+
+    def contents(self):
+        """The buffer, and the bounds of the bytes not yet decoded."""
+        return self._buf, self._start, self._end
+
+    def consume(self, n):
+        """Drop the first `n` bytes, which have been decoded."""
+        self._start += n
+        if self._start >= self._end:
+            self._start = self._end = 0
+
+    def recv_from(self, s, size=4096):
+        """Receive up to `size` bytes from socket `s`.  Returns the
+        number received; 0 means the peer closed the connection."""
+        buf = self._buf
+        if len(buf) - self._end < size:
+            n = self._end - self._start
+            if self._start:
+                buf[:n] = buf[self._start:self._end]
+                self._start, self._end = 0, n
+            if len(buf) - n < size:
+                buf.extend(bytearray(max(size, len(buf))))
+        n = s.recv_into(memoryview(buf)[self._end:], size)
+        self._end += n
+        return n
+
+
+class _Decoder(object):
+    """Decode XDR from buf[pos:end], without copying but for strings."""
+
+    def __init__(self, buf, pos, end):
+        self.buf = buf
+        self.pos = pos
+        self.end = end
+
+    def unpack_uint(self):
+        if self.pos + 4 > self.end:
+            raise _Short
+        v = _uint.unpack_from(self.buf, self.pos)[0]
+        self.pos += 4
+        return v
+
+    def unpack_string(self):
+        n = self.unpack_uint()
+        if n > MAX_MESSAGE:
+            raise ProtocolError("string of %d bytes" % n)
+        p = self.pos
+        q = p + ((n + 3) & ~3)
+        if q > self.end:
+            raise _Short
+        self.pos = q
+        return memoryview(self.buf)[p:p+n].tobytes()
+
+    def unpack_list(self, unpackItem):
+        R = []
+        while True:
+            x = self.unpack_uint()
+            if x == 0:
+                return R
+            if x != 1:
+                raise ProtocolError("list item marked %d" % x)
+            R.append(unpackItem())
+
+
+def pack_welcome(sitename, vsNames):
+    p = xdrlib.Packer()
+    p.pack_string(sitename)
+    p.pack_list(vsNames, p.pack_string)
+    return p.get_buffer()
+
+def unpack_welcome(d):
+    return (d.unpack_string(), d.unpack_list(d.unpack_string))
+
+def pack_notify(vsName, ts):
+    p = xdrlib.Packer()
+    p.pack_string(vsName)
+    p.pack_string(ts)
+    return p.get_buffer()
+
+def unpack_notify(d):
+    return (d.unpack_string(), d.unpack_string())
+
+
+def preamble(protocol):
+    """What a slave sends first in `protocol`."""
+    if protocol == "framed":
+        return FRAME_MAGIC
+    return ""
+
+def frame(body, protocol):
+    """The message with XDR `body`, as sent in `protocol`."""
+    if protocol == "framed":
+        return _uint.pack(len(body)) + body
+    return body
+
+
+class MessageReader(object):
+    """Take messages out of a ReceiveBuffer.
+
+    `unpack(decoder)` decodes the fields of a message.  `protocol` is
+    one of WIRE_PROTOCOLS, or None to tell from FRAME_MAGIC."""
+
+    def __init__(self, unpack, protocol=None):
+        self._unpack = unpack
+        self.protocol = protocol
+
+    def next_message(self, rbuf):
+        """The fields of the next complete message in `rbuf`, or None.
+        Raises ProtocolError if the input is not a message."""
+        buf, start, end = rbuf.contents()
+        if self.protocol is None:
+            if end - start < len(FRAME_MAGIC):
+                return None
+            if buf[start:start+len(FRAME_MAGIC)] == FRAME_MAGIC:
+                self.protocol = "framed"
+                rbuf.consume(len(FRAME_MAGIC))
+                buf, start, end = rbuf.contents()
+            else:
+                self.protocol = "xdr"
+
+        if self.protocol == "framed":
+            if end - start < 4:
+                return None
+            n = _uint.unpack_from(buf, start)[0]
+            if n > MAX_MESSAGE:
+                raise ProtocolError("message of %d bytes" % n)
+            if end - start - 4 < n:
+                return None
+            d = _Decoder(buf, start + 4, start + 4 + n)
+            try:
+                msg = self._unpack(d)
+            except _Short:
+                raise ProtocolError("message of %d bytes is truncated" % n)
+            if d.pos != d.end:
+                raise ProtocolError("%d bytes after message" %
+                                    (d.end - d.pos))
+            rbuf.consume(4 + n)
+            return msg
+
+        d = _Decoder(buf, start, end)
+        try:
+            msg = self._unpack(d)
+        except _Short:
+            if end - start > MAX_MESSAGE:
+                raise ProtocolError("no message in %d bytes" % (end - start))
+            return None
+        rbuf.consume(d.pos - start)
+        return msg
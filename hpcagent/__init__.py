@@ -1 +1,2 @@
-__all__ = ["Agent", "SiteAgent", "SiteAuthAgent", "SiteFSAgent", "SiteProxyAgent"]
+__all__ = ["Agent", "SiteAgent", "SiteAuthAgent", "SiteFSAgent", "SiteProxyAgent",
+           "SiteRelayAgent"]
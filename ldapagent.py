@@ -3,10 +3,10 @@
 """LDAP Agent"""
 
 import sys
-import ldap, ldap.modlist
 
 from hpcagent.SiteAuthAgent import *
 from hpcagent.DBHelpers import *
+from hpcagent.LdapBackend import *
 
 class LdapVSiteError(UpdateVSiteError): pass
 
@@ -37,6 +37,28 @@ class LdapVSite(VSiteAuthAgent):
         except:
             self.admin = 'cn=Manager,' + dn
         self.adminPass = cp.get(vsName, "password")
+        # How to reach the directory: "ldap" (python-ldap) or "memory",
+        # which adds 'backend_latency' seconds to each round trip.
+        try:
+            self.backend = cp.get(vsName, "backend").lower()
+        except:
+            self.backend = "ldap"
+        if self.backend not in LDAP_BACKENDS:
+            aHandle.logger.fatal("Invalid value for 'backend': %s",
+                                 self.backend)
+            sys.exit(1)
+        try:
+            bl = cp.get(vsName, "backend_latency")
+        except:
+            self.backendLatency = 0.0
+        else:
+            try:
+                self.backendLatency = float(bl)
+                assert self.backendLatency >= 0
+            except:
+                aHandle.logger.fatal("Invalid value for 'backend_latency': %s",
+                                     bl)
+                sys.exit(1)
         try:
             self.userOU = cp.get(vsName, "userbase")
         except:
@@ -92,7 +114,7 @@ class LdapVSite(VSiteAuthAgent):
                     "objectClass": ["dcObject", "organizationalUnit", "top"],
                     "ou": "rootobject"
                     }
-                l.add_s(dn, ldap.modlist.addModlist(d))
+                l.add(dn, d)
                 logger.debug("Created '%s' for '%s'", dn, vsName)
             except:
                 logger.exception("Failed to create '%s' for '%s'", dn, vsName)
@@ -109,7 +131,7 @@ class LdapVSite(VSiteAuthAgent):
                     "description": "People and virtual organizations",
                     "objectClass": "organizationalUnit"
                     }
-                l.add_s(self.userOU, ldap.modlist.addModlist(d))
+                l.add(self.userOU, d)
                 logger.debug("Created '%s' for '%s'", userOU, vsName)
             except:
                 logger.exception("Failed to create '%s' for '%s'",
@@ -127,7 +149,7 @@ class LdapVSite(VSiteAuthAgent):
                     "description": "Posix groups",
                     "objectClass": "organizationalUnit"
                     }
-                l.add_s(self.groupOU, ldap.modlist.addModlist(d))
+                l.add(self.groupOU, d)
                 logger.debug("Created '%s' for '%s'", groupOU, vsName)
             except:
                 logger.exception("Failed to create '%s' for '%s'",
@@ -140,9 +162,10 @@ class LdapVSite(VSiteAuthAgent):
         self.aHandle.logger.debug("Connecting to LDAP server '%s'",
                                   self.ldapURI)
         try:
-            l = ldap.initialize(self.ldapURI)
-            l.bind_s(self.admin, self.adminPass)
-        except ldap.LDAPError:
+            l = open_ldap_backend(self.backend, self.ldapURI,
+                                  self.admin, self.adminPass,
+                                  self.backendLatency)
+        except LdapError:
             raise LdapVSiteError,None,sys.exc_info()[2]
         return l
 
@@ -160,14 +183,15 @@ class LdapVSite(VSiteAuthAgent):
         cur = VSiteAuthAgent.prepare_update(self, cur)
         try:
             self.ldapHandle = self.connect_ldap()
-        except ldap.LDAPError,ei:
+        except LdapVSiteError,ei:
             logger.warning("Unable to connect to LDAP server '%s': %s",
-                           self.ldapURI, ei.message)
-            raise LdapVSiteError,None,sys.exc_info()[2]
+                           self.ldapURI, ei)
+            raise
         return cur
 
 
     def finish_update(self, cur, completed, end=None):
+        self.ldapHandle.unbind()
         del self.ldapHandle
         VSiteAuthAgent.finish_update(self, cur, completed, end)
 
@@ -185,25 +209,27 @@ class LdapVSite(VSiteAuthAgent):
         logger = aHandle.logger
         logger.info("Updating groups.")
 
-        # FIXME: Get a second cursor.
+        # Each group comes with its members, from a single query.
         # FIXME: Isolate database and ldap errors.
-        for g in self.get_group_information(cur, start=ts, end=end):
+        gcur = self.open_stream(cur)
+        self.start_get_group_membership(gcur, start=ts, end=end,
+                                        resume=self.get_resume_point("groups"))
+        for g in gcur:
+            self.checkpoint("groups", g[3], g[0])
             dn = 'cn=%s,%s' % (g[1], groupOU)
             d = {
                 'objectClass': ['posixGroup'],
                 'cn': [g[1]],
                 'gidNumber': [str(g[0])]}
-            d['memberUid'] = [m[0]
-                              for m in
-                              self.get_group_members(cur,g[1],start=ts,end=end)]
+            d['memberUid'] = list(g[4])
             try:
-                (odn,od) = l.search_s(dn, ldap.SCOPE_BASE)[0]
-            except ldap.NO_SUCH_OBJECT:
+                od = l.search_base(dn)
+            except NoSuchObject:
                 logger.debug("Creating group '%s'",g[1])
-                l.add_s(dn, ldap.modlist.addModlist(d))
+                l.add(dn, d)
             else:
                 logger.debug("Modifying group '%s'",g[1])
-                l.modify_s(dn, ldap.modlist.modifyModlist(od, d))
+                l.modify(dn, od, d)
 
     def update_users(self, cur, end=None):
         """Update users."""
@@ -218,18 +244,21 @@ class LdapVSite(VSiteAuthAgent):
         passwordType = aHandle.passwordType
         logger.info("Updating users.")
         try:
-            self.start_get_user_information(cur, start=ts, end=end)
+            ucur = self.open_stream(cur)
+            self.start_get_user_information(ucur, start=ts, end=end,
+                                            resume=self.get_resume_point("users"))
         except DBDatabaseError:
             logger.info("Unable to query user information.")
             raise
         while True:
             try:
-                u = DB_get_next_row(cur)
+                u = DB_get_next_row(ucur)
             except DBDatabaseError:
                 logger.info("Unable to fetch user information")
                 raise
             if u is None:
                 break
+            self.checkpoint("users", u['modified'], u['uid'])
             dn = 'uid=%s,%s' % (u[1], userOU)
             userAccountState = u[9]
             logger.debug("Process user '%s', state=%s, passwordMustChange=%s",
@@ -239,8 +268,8 @@ class LdapVSite(VSiteAuthAgent):
             try:
                 if userAccountState == "D":
                     try:
-                        (odn,od) = l.search_s(dn, ldap.SCOPE_BASE)[0]
-                    except ldap.NO_SUCH_OBJECT:
+                        od = l.search_base(dn)
+                    except NoSuchObject:
                         pass
                     else:
                         d = {
@@ -249,15 +278,14 @@ class LdapVSite(VSiteAuthAgent):
                         if od.has_key('userPassword'):
                             d['userPassword'] = ''
                         logger.debug("Disabling user '%s'",u[1])
-                        modList = ldap.modlist.modifyModlist(od, d, ignore_oldexistent=1)
+                        modList = l.modify(dn, od, d, ignoreOldExistent=1)
                         logger.debug("Modlist: %s",repr(modList))
-                        l.modify_s(dn, modList)
                         logger.debug("Disabling complete for '%s'",u[1])
                 elif userAccountState == "R":
                     try:
-                        l.delete_s(dn)
+                        l.delete(dn)
                         logger.debug("Deleted user '%s'", u[1])
-                    except ldap.NO_SUCH_OBJECT:
+                    except NoSuchObject:
                         pass
                 else: # userAccountState == 'A'
                     # FIXME: Disable passwords if password must be reset.
@@ -291,18 +319,17 @@ class LdapVSite(VSiteAuthAgent):
                     elif u[4] is not None:
                         d['userPassword'] = [encodePassword(passwordType, u[4])]
                     try:
-                        (odn,od) = l.search_s(dn, ldap.SCOPE_BASE)[0]
-                    except ldap.NO_SUCH_OBJECT:
+                        od = l.search_base(dn)
+                    except NoSuchObject:
                         logger.debug("Creating user '%s'",u[1])
-                        l.add_s(dn, ldap.modlist.addModlist(d))
+                        l.add(dn, d)
                         logger.debug("Creation complete for '%s'",u[1])
                     else:
                         logger.debug("Modifying user '%s'",u[1])
-                        modList = ldap.modlist.modifyModlist(od, d)
+                        modList = l.modify(dn, od, d)
                         logger.debug("Modlist: %s",repr(modList))
-                        l.modify_s(dn, modList)
                         logger.debug("Modification complete for '%s'",u[1])
-            except ldap.LDAPError:
+            except LdapError:
                 logger.exception("Unexpected LDAP error!")
                 raise LdapVSiteError,None,sys.exc_info()[2]
 
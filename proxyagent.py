@@ -155,7 +155,9 @@ class ProxyVSite(VSiteProxyAgent):
 
         # Get cursor to user information, filtered by timestamp.
         try:
-            self.start_get_user_information(cur, start=ts, end=end)
+            ucur = self.open_stream(cur)
+            self.start_get_user_information(ucur, start=ts, end=end,
+                                            resume=self.get_resume_point("users"))
         except DBDatabaseError:
             logger.info("Unable to query user information.")
             raise
@@ -163,12 +165,13 @@ class ProxyVSite(VSiteProxyAgent):
         # Iterate over selected users.
         while True:
             try:
-                u = DB_get_next_row(cur)
+                u = DB_get_next_row(ucur)
             except DBDatabaseError:
                 logger.info("Unable to fetch user information")
                 raise
             if u is None:
                 break
+            self.checkpoint("users", u['modified'], u['uid'])
 
             # See if we need to filter out this user, based on project.
             if projectFilterEscape is not None:
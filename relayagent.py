@@ -0,0 +1,18 @@
+#! /usr/bin/env python
+
+"""Relay agent: This agent passes notifications from a master agent on
+to its own slaves, with no database of its own, so that a master need
+not serve every slave of a large cluster directly."""
+
+from hpcagent.SiteRelayAgent import *
+
+
+def main():
+    # Get configuration; a relay never connects to the database.
+    aHandle = SiteRelayAgent("hpcrelay", VSiteRelayAgent)
+
+    aHandle.main_loop()
+
+
+if __name__ == "__main__":
+    main()